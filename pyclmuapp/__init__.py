@@ -4,10 +4,12 @@ from pyclmuapp.usp import *
 from pyclmuapp.pts import *
 #from pyclmuapp.clmu import get_clmuapp_frocing, get_urban_params, get_soil_params
 #from pyclmuapp.clmu import get_soil_params, get_urban_params, get_forcing
-from pyclmuapp.input_data import get_soil_params, get_urban_params, get_forcing
+from pyclmuapp.input_data import get_soil_params, get_urban_params, get_urban_params_batch, get_forcing, get_forcing_batch
 from pyclmuapp.era5_forcing import era5_to_forcing, era5_download, arco_era5_to_forcing
 from pyclmuapp.era_forcing import workflow_era5s_to_forcing
 from pyclmuapp.era5_forcing_gee import gee_era5s_to_forcing
+from pyclmuapp.ensemble import usp_ensemble
+from pyclmuapp.scheduler import job_array
 
 __all__ = ['clumapp', 'usp_clmu', 'pts_clmu', 'clmu']
 
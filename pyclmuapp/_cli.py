@@ -6,7 +6,7 @@
 
 import argparse
 from pyclmuapp import usp_clmu
-from pyclmuapp.clmu import get_forcing
+from pyclmuapp.input_data import get_forcing
 import numpy as np
 import shutil
 import os
@@ -280,6 +280,10 @@ def get_pypars(gr_l: dict = None):
                         type=str,
                         help='Param for get_forcing. Source, default is cds, can be arco_era5',
                         default='cds')
+    parser.add_argument('--forcing_profile',
+                        type=str,
+                        help='Param for get_forcing. NetCDF output profile, default is default, can be compressed',
+                        default='default')
 
     return parser.parse_args(gr_l) if gr_l is not None else parser.parse_args()
 
@@ -485,8 +489,8 @@ def _main_usp(args, usp):
         if not np.any(np.isin(np.array(args.forcing_var), [""])):
             print(args.forcing_var, args.forcing_action)
             action_f = {k: float(v) for k, v in zip(args.forcing_var, args.forcing_action)}
-            action_fr = {k: -float(v) for k, v in zip(args.forcing_var, args.forcing_action)}
-            usp.modify_forcing(action=action_f,mode="add")
+            # the perturbed copy is written from the baseline forcing, which is never changed
+            usp.perturb_forcing(action_f)
             forcing_mod = True
 
             ouput_modify_f = usp.run(
@@ -509,15 +513,15 @@ def _main_usp(args, usp):
                     logfile=args.logfile,
                 )
 
-            # recover the forcing data
-            usp.modify_forcing(action=action_fr,mode="add")
+            # back to the baseline forcing data
+            usp.perturb_forcing(None)
 
     ouput_modify_sf = False
     if sur_mod and forcing_mod:
 
         # modify the forcing data and surfdata
         usp.modify_surf(action=action_s,mode="add")
-        usp.modify_forcing(action=action_f,mode="add")
+        usp.perturb_forcing(action_f)
         ouput_modify_sf = usp.run(
                 output_prefix=args.output_prefix,
                 case_name=args.case_name,
@@ -538,7 +542,7 @@ def _main_usp(args, usp):
                 logfile=args.logfile,
             )
         # recover the forcing data and surfdata
-        usp.modify_forcing(action=action_fr,mode="add")
+        usp.perturb_forcing(None)
         usp.modify_surf(action=action_sr,mode="add")
 
     if args.clean == True:
@@ -599,6 +603,7 @@ def _main_create_forcing(args):
         lon=args.lon,
         zbot=args.zbot,
         source=args.source,
+        profile=args.forcing_profile,
     )
     
 def _main_create_surfdata(args):
@@ -610,11 +615,10 @@ def _main_create_surfdata(args):
     check_file(args.soildata)
     if args.lat is None or args.lon is None:
         raise ValueError("The latitude and longitude should be provided")
-    urb = xr.open_dataset(args.urbsurf)
-    soil = xr.open_dataset(args.soildata)
+    # the paths are given, the datasets are opened lazily once and shared
     urban = get_urban_params(
-        urban_ds=urb,
-        soil_ds=soil,
+        urban_ds=args.urbsurf,
+        soil_ds=args.soildata,
         template=os.path.join(os.path.dirname(__file__), 'usp/surfdata.nc'),
         lat=args.lat,
         lon=args.lon,
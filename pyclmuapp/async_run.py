@@ -0,0 +1,172 @@
+import asyncio
+import inspect
+import logging
+import logging.handlers
+import shlex
+import time
+from typing import Callable, Union
+
+
+def _now_time() -> str:
+    return "Current time: " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+
+
+class run_handle:
+
+    """
+    The handle of a command started by `start_command`.
+
+    The handle can be awaited for the return code of the command, and tells the progress
+    of the command while it runs.
+
+    Args:
+        command (str or list): The command.
+        coro (coroutine): The coroutine running the command, see `stream_command`.
+
+    Attributes:
+        command (str or list): The command.
+        task (asyncio.Task): The task running the command.
+        lines (int): The number of output lines so far.
+        last_line (str): The last output line.
+    """
+
+    def __init__(self, command: Union[str, list], coro):
+
+        self.command = command
+        self.lines = 0
+        self.last_line = None
+        self.task = asyncio.ensure_future(coro)
+
+    def _progress(self, stream: str, line: str) -> None:
+        self.lines += 1
+        self.last_line = line
+
+    def done(self) -> bool:
+        """
+        If the command has finished.
+        """
+        return self.task.done()
+
+    @property
+    def returncode(self) -> int:
+        """
+        The return code of the command, None while it runs.
+        """
+        if not self.task.done() or self.task.cancelled() or self.task.exception() is not None:
+            return None
+        return self.task.result()
+
+    def cancel(self) -> None:
+        """
+        Stop the command.
+        """
+        self.task.cancel()
+
+    def __await__(self):
+        return self.task.__await__()
+
+
+async def stream_command(command: Union[str, list],
+                         password: str = "None",
+                         logname: str = "None",
+                         iflog: bool = True,
+                         callback: Callable = None,
+                         max_bytes: int = 10 * 1024**2,
+                         backup_count: int = 5) -> int:
+    """
+    Run a command and stream its output line by line.
+
+    Each line of stdout and stderr is written to the log file as soon as it is printed,
+    and passed to `callback`. The log file is appended to and rotated once it grows
+    over `max_bytes` (logname.1, logname.2, ...), so nothing is held in memory.
+
+    Args:
+        command (str or list): The command to be run, a shell string or a list of arguments run without a shell.
+        password (str, optional): The password of the server, written to the command input.
+        logname (str, optional): The name of the log file. "None" to print the output instead.
+        iflog (bool, optional): If log is needed. Defaults to True.
+        callback (callable, optional): Called with (stream, line) for each line,
+            stream being "stdout" or "stderr". It may be a coroutine function.
+        max_bytes (int, optional): The size of the log file before it is rotated. Defaults to 10 MB.
+        backup_count (int, optional): The number of rotated log files kept. Defaults to 5.
+
+    Returns:
+        int: The return code of the command.
+    """
+
+    handler = None
+    if iflog and logname != "None":
+        handler = logging.handlers.RotatingFileHandler(logname, mode='a', maxBytes=max_bytes,
+                                                       backupCount=backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def _log(line: str) -> None:
+        if not iflog:
+            return
+        if handler is None:
+            print(line)
+        else:
+            handler.emit(logging.makeLogRecord({'msg': line}))
+
+    async def _pump(stream, name):
+        while True:
+            raw = await stream.readline()
+            if not raw:
+                break
+            line = raw.decode(errors='replace').rstrip('\n')
+            _log(line)
+            if callback is not None:
+                result = callback(name, line)
+                if inspect.isawaitable(result):
+                    await result
+
+    try:
+        pipes = dict(stdin=asyncio.subprocess.PIPE if password != "None" else asyncio.subprocess.DEVNULL,
+                     stdout=asyncio.subprocess.PIPE,
+                     stderr=asyncio.subprocess.PIPE,
+                     limit=2**20)
+        if isinstance(command, str):
+            _log(f"{_now_time()} {command}")
+            process = await asyncio.create_subprocess_shell(command, **pipes)
+        else:
+            _log(f"{_now_time()} {shlex.join(command)}")
+            process = await asyncio.create_subprocess_exec(*command, **pipes)
+        if password != "None":
+            process.stdin.write(password.encode())
+            await process.stdin.drain()
+            process.stdin.close()
+        try:
+            await asyncio.gather(_pump(process.stdout, 'stdout'), _pump(process.stderr, 'stderr'))
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        _log(f"{_now_time()} return code {returncode}")
+        return returncode
+    finally:
+        if handler is not None:
+            handler.close()
+
+
+def start_command(command: Union[str, list],
+                  callback: Callable = None,
+                  **kwargs) -> run_handle:
+    """
+    Start a command in the running event loop, see `stream_command` for the arguments.
+
+    Returns:
+        run_handle: The handle of the command, to be awaited for its return code.
+    """
+
+    asyncio.get_running_loop()
+    handle = None
+
+    def _callback(stream, line):
+        handle._progress(stream, line)
+        if callback is not None:
+            return callback(stream, line)
+
+    handle = run_handle(command, stream_command(command, callback=_callback, **kwargs))
+    return handle
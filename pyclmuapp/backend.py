@@ -0,0 +1,405 @@
+import os
+import re
+import json
+import shlex
+import hashlib
+import subprocess
+from typing import Union
+from pyclmuapp.clmu import run_command
+from pyclmuapp.async_run import run_handle, start_command
+
+# a template with one of these tokens needs a shell, and is kept as a shell string
+_SHELL_TOKENS = ('&&', '||', '|', ';', '>', '>>', '<')
+
+
+def parse_template(template: str) -> Union[list, str]:
+    """
+    Split a command template into its arguments.
+
+    Args:
+        template (str): The template, e.g. "docker exec {container_name} bash -c '{command}'".
+
+    Returns:
+        list or str: The argument templates, or the template itself if it needs a shell.
+    """
+    tokens = shlex.split(template)
+    if any(token in _SHELL_TOKENS for token in tokens):
+        return template
+    return tokens
+
+
+class container_backend:
+
+    """
+    The base class of the backends that run the commands of `pyclmuapp.container.clumapp`.
+
+    The command templates of a backend are read and parsed once, and a command is built as
+    a list of arguments, run without a shell. The templates that need a shell (e.g. with "&&")
+    are kept as shell strings.
+
+    Args:
+        image_name (str): The name of the image.
+
+    Attributes:
+        name (str): The container type of the backend.
+        image_name (str): The name of the image.
+        templates (dict): The command templates, keyed by command.
+        argv (dict): The parsed templates, keyed by command.
+    """
+
+    name = None
+    # the file of the templates in pyclmuapp/config
+    template_file = None
+
+    def __init__(self, image_name: str = None):
+
+        self.image_name = image_name
+        self.templates = self._load()
+        self.argv = {cmd: parse_template(template) for cmd, template in self.templates.items()}
+
+    def _load(self) -> dict:
+        with open(os.path.join(os.path.dirname(__file__), 'config', self.template_file)) as f:
+            return json.load(f)
+
+    def command(self,
+                cmd: str,
+                values: dict,
+                password: str = "None") -> Union[list, str]:
+        """
+        Build a command.
+
+        Args:
+            cmd (str): The name of the command, e.g. "usp".
+            values (dict): The values of the template fields (image_name, container_name, command, ...).
+            password (str, optional): The password for the sudo command. The default is "None".
+
+        Returns:
+            list or str: The arguments of the command, or the shell string of a shell template.
+        """
+        if cmd not in self.argv:
+            print(f"Command '{cmd}' is not supported.")
+            raise ValueError
+        template = self.argv[cmd]
+        if isinstance(template, str):
+            command = template
+            if os.name == 'nt':
+                command = command.replace("'", '"')
+            command = command.format(**values)
+            return "sudo -S " + command if password != "None" else command
+        argv = [token.format(**values) for token in template]
+        return ["sudo", "-S"] + argv if password != "None" else argv
+
+    def run(self,
+            command: Union[list, str],
+            password: str = "None",
+            logname: str = "None",
+            iflog: bool = True) -> None:
+        """
+        Run a command and wait for it, see `pyclmuapp.clmu.run_command`.
+        """
+        run_command(command=command, password=password, logname=logname, iflog=iflog)
+
+    def start(self,
+              command: Union[list, str],
+              callback=None,
+              **kwargs) -> run_handle:
+        """
+        Start a command in the running event loop, see `pyclmuapp.async_run.start_command`.
+        """
+        return start_command(command, callback=callback, **kwargs)
+
+    def call(self, command: Union[list, str]) -> int:
+        """
+        Run a command quietly, e.g. a health check.
+
+        Returns:
+            int: The return code.
+        """
+        return subprocess.run(command, shell=isinstance(command, str), text=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode
+
+
+class docker_backend(container_backend):
+
+    """
+    The docker backend.
+    """
+
+    name = "docker"
+    template_file = "ini_docker.json"
+
+    def _load(self) -> dict:
+        if self.image_name == "envdes/clmu-app:1.1":
+            self.template_file = "ini_docker_1.1.json"
+        return super()._load()
+
+
+class singularity_backend(container_backend):
+
+    """
+    The singularity backend. The container name is the path to the image file.
+    """
+
+    name = "singularity"
+    template_file = "ini_sing.json"
+
+    def _load(self) -> dict:
+        if self.image_name == "envdes/clmu-app:1.1":
+            self.template_file = "ini_sing_1.1.json"
+        return super()._load()
+
+
+class udocker_backend(container_backend):
+
+    """
+    The udocker backend.
+    """
+
+    name = "udocker"
+    template_file = "ini_udocker.json"
+
+
+class docker_in_backend(container_backend):
+
+    """
+    The backend inside the clmu-app container (docker-in-docker), the commands run directly.
+    """
+
+    name = "docker_in"
+    template_file = "ini_docker_in.json"
+
+    def _load(self) -> dict:
+        # the bare "{command}" templates are shell scripts
+        return {cmd: "bash -c '{command}'" if template.strip() == "{command}" else template
+                for cmd, template in super()._load().items()}
+
+
+class native_backend(container_backend):
+
+    """
+    The backend of a CTSM installed on the host, the commands run directly without a container.
+
+    The paths of the container layout (/p/...) in the commands and in the scripts they run
+    (usp.sh, pts.sh and the PTS case scripts) are mapped to host paths:
+
+        - /p/clmuapp, /p/scripts, /p/scratch/CESMDATAROOT/Archive and /p/scratch/CESMDATAROOT/CaseOutputs
+          to the input, scripts, output and log folders of the app, as the bind mounts of a container.
+        - the other prefixes with `paths`, e.g. /p/project/clm5.0 to the CTSM install and
+          /p/scratch/CESMDATAROOT/inputdata to the CESM input data. See config/native_paths.json.
+
+    The CESMDATAROOT of the runs is a folder next to the scripts folder, with links to the output
+    and log folders (Archive and CaseOutputs) and to the input data, so the CIME machine of the host
+    should set CIME_OUTPUT_ROOT, DIN_LOC_ROOT and DOUT_S_ROOT from $ENV{CESMDATAROOT}, as
+    config/cime_config/config_machines.xml. The scripts are run from a mapped copy (<script>.native.sh).
+
+    Args:
+        image_name (str): The name of the image, not used.
+        paths (dict or str, optional): The host path of each container prefix, or a JSON file of them.
+            The default is the JSON file $PYCLMUAPP_NATIVE_PATHS.
+
+    Attributes:
+        paths (dict): The host path of each container prefix given by the user.
+    """
+
+    name = "native"
+    template_file = "ini_native.json"
+    # the container prefixes mounted from the folders of the app
+    mounts = {
+        "/p/clmuapp": "input_path",
+        "/p/scripts": "scripts_path",
+        "/p/scratch/CESMDATAROOT/Archive": "output_path",
+        "/p/scratch/CESMDATAROOT/CaseOutputs": "log_path",
+    }
+
+    def __init__(self,
+                 image_name: str = None,
+                 paths: Union[dict, str] = None):
+
+        super().__init__(image_name)
+        if paths is None:
+            paths = os.environ.get('PYCLMUAPP_NATIVE_PATHS', {})
+        if isinstance(paths, str):
+            with open(paths) as f:
+                paths = json.load(f)
+        self.paths = {prefix.rstrip('/'): os.path.abspath(os.path.expanduser(path))
+                      for prefix, path in paths.items()}
+
+    def mapping(self, values: dict) -> dict:
+        """
+        The host path of each container prefix for the folders of an app.
+
+        Args:
+            values (dict): The values of the template fields, with the folders of the app.
+
+        Returns:
+            dict: The host path of each container prefix.
+        """
+        mapping = {prefix: os.path.abspath(values[field]) for prefix, field in self.mounts.items()}
+        mapping.update(self.paths)
+        if "/p/scratch/CESMDATAROOT" not in mapping:
+            mapping["/p/scratch/CESMDATAROOT"] = self._data_root(mapping)
+        if "/p/project/clm5.0" in mapping:
+            mapping.setdefault("/p/project", os.path.dirname(mapping["/p/project/clm5.0"]))
+        mapping.setdefault("/p/scratch", os.path.dirname(mapping["/p/scratch/CESMDATAROOT"]))
+        return mapping
+
+    def _data_root(self, mapping: dict) -> str:
+        """
+        The CESMDATAROOT folder of the app, with the links to its output, log and input data folders.
+        The folder is keyed by all the linked folders, as the apps that share a scripts folder
+        (e.g. the members of an ensemble) have their own output and log folders.
+        """
+        scripts = mapping["/p/scripts"]
+        targets = [scripts] + [str(mapping.get(f"/p/scratch/CESMDATAROOT/{name}"))
+                               for name in ("Archive", "CaseOutputs", "inputdata")]
+        key = hashlib.sha256("|".join(targets).encode()).hexdigest()[:12]
+        root = os.path.join(os.path.dirname(scripts), f".cesmdataroot_{key}")
+        os.makedirs(root, exist_ok=True)
+        for name in ("Archive", "CaseOutputs", "inputdata"):
+            target = mapping.get(f"/p/scratch/CESMDATAROOT/{name}")
+            link = os.path.join(root, name)
+            if target is None or (os.path.islink(link) and os.readlink(link) == target):
+                continue
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(target, link)
+        return root
+
+    def map_paths(self, text: str, mapping: dict) -> str:
+        """
+        Replace the container prefixes in a text by their host paths, the longest prefix first.
+
+        Args:
+            text (str): The text, e.g. a command or a script.
+            mapping (dict): The host path of each container prefix, see `mapping`.
+
+        Returns:
+            str: The mapped text.
+
+        Raises:
+            ValueError: If the text has a container path without a host path.
+        """
+        prefixes = sorted(mapping, key=len, reverse=True)
+        pattern = re.compile(r"(?<![\w./-])(" + "|".join(re.escape(p) for p in prefixes) + r")(?![\w.-])")
+        text = pattern.sub(lambda m: mapping[m.group(1)], text)
+        unmapped = sorted(set(re.findall(r"(?<![\w./-])/p/[\w.-]+(?:/[\w.-]+)?", text)))
+        if unmapped:
+            raise ValueError(f"No host path for {unmapped}, see the paths of `native_backend`.")
+        return text
+
+    def _map_scripts(self, text: str, mapping: dict) -> str:
+        """
+        Write a mapped copy of the scripts run by a command, and run the copies instead.
+        """
+        def _copy(match):
+            script = match.group(0)
+            if not os.path.isfile(script) or script.endswith('.native.sh'):
+                return script
+            native = script[:-len('.sh')] + '.native.sh'
+            with open(script) as f:
+                content = self.map_paths(f.read(), mapping)
+            tmp = f'{native}.{os.getpid()}.part'
+            with open(tmp, 'w') as f:
+                f.write(content)
+            os.chmod(tmp, os.stat(script).st_mode | 0o111)
+            os.replace(tmp, native)
+            return native
+        return re.sub(r"/[^\s'\"]+\.sh(?![\w.-])", _copy, text)
+
+    def command(self,
+                cmd: str,
+                values: dict,
+                password: str = "None") -> Union[list, str]:
+        """
+        Build a command with the container paths mapped to host paths,
+        see `container_backend.command` for the arguments.
+        """
+        command = super().command(cmd, values, password=password)
+        mapping = self.mapping(values)
+        if isinstance(command, str):
+            return self._map_scripts(self.map_paths(command, mapping), mapping)
+        return [self._map_scripts(self.map_paths(arg, mapping), mapping) for arg in command]
+
+
+class fake_backend(container_backend):
+
+    """
+    A backend that records the commands instead of running them, for tests and benchmarks.
+    The commands are built from the docker templates.
+
+    Args:
+        image_name (str): The name of the image.
+        returncode (int): The return code of every command. The default is 0.
+        handler (callable, optional): Called with the arguments of each command, e.g. to write
+            the output files of a run.
+
+    Attributes:
+        calls (list): The commands run so far.
+    """
+
+    name = "fake"
+    template_file = "ini_docker.json"
+
+    def __init__(self,
+                 image_name: str = None,
+                 returncode: int = 0,
+                 handler=None):
+
+        super().__init__(image_name)
+        self.returncode = returncode
+        self.handler = handler
+        self.calls = []
+
+    def call(self, command: Union[list, str]) -> int:
+        self.calls.append(command)
+        if self.handler is not None:
+            self.handler(command)
+        return self.returncode
+
+    def run(self, command, password="None", logname="None", iflog=True) -> None:
+        self.call(command)
+
+    def start(self, command, callback=None, **kwargs) -> run_handle:
+        async def _run():
+            return self.call(command)
+        return run_handle(command, _run())
+
+
+BACKENDS = {
+    "docker": docker_backend,
+    "singularity": singularity_backend,
+    "udocker": udocker_backend,
+    "docker_in": docker_in_backend,
+    "native": native_backend,
+    "fake": fake_backend,
+}
+
+_backends = {}
+
+
+def get_backend(container_type: str,
+                image_name: str = None,
+                paths: Union[dict, str] = None) -> container_backend:
+    """
+    The backend of a container type, created once per container type, image and paths.
+
+    Args:
+        container_type (str): One of BACKENDS.
+        image_name (str, optional): The name of the image.
+        paths (dict or str, optional): The host paths of the native backend, see `native_backend`.
+
+    Returns:
+        container_backend: The backend.
+    """
+    if container_type not in BACKENDS:
+        raise ValueError(f"Container type '{container_type}' is not supported.")
+    if paths is not None and container_type != "native":
+        raise ValueError(f"The paths are only for the native backend, not for '{container_type}'.")
+    key = (container_type, image_name,
+           json.dumps(paths, sort_keys=True) if isinstance(paths, dict) else paths)
+    if key not in _backends:
+        if container_type == "native":
+            _backends[key] = native_backend(image_name, paths=paths)
+        else:
+            _backends[key] = BACKENDS[container_type](image_name)
+    return _backends[key]
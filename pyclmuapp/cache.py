@@ -0,0 +1,356 @@
+import os
+import json
+import time
+import shutil
+import socket
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import date, timedelta
+from typing import Union
+try:
+    import fcntl
+except ImportError:
+    # no file lock on Windows, the manifest is then only guarded within a process
+    fcntl = None
+
+
+def _as_date(d: Union[str, date]) -> date:
+    if isinstance(d, date):
+        return d
+    return date.fromisoformat(str(d)[:10])
+
+
+def cache_root() -> str:
+    """
+    The default cache folder of pyclmuapp, $PYCLMUAPP_CACHE or ~/.cache/pyclmuapp.
+    """
+    return os.environ.get('PYCLMUAPP_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'pyclmuapp'))
+
+
+class era5_cache:
+
+    """
+    A local content-addressed cache for the raw ERA5 downloads and the converted forcing files.
+
+    Each entry is keyed on (kind, source, variable set, grid cell, time range, zbot, lapse_rate,
+    and the output profile and encoding of the converted forcing).
+    The grid cell is the point rounded to the grid of the source, so nearby sites that fall in the
+    same cell share the entries. The entries are listed in a JSON manifest in the cache folder,
+    and the least recently used ones are evicted once the cache grows over `max_size`.
+    The manifest is updated under a file lock (manifest.json.lock), so the processes of an ensemble
+    or of a job array can share the cache folder.
+
+    Args:
+        root (str, optional): The cache folder. Default is $PYCLMUAPP_CACHE or ~/.cache/pyclmuapp.
+        max_size (int): The maximum size of the cache in bytes. Default is 20 GB.
+
+    Attributes:
+        root (str): The cache folder.
+        max_size (int): The maximum size of the cache in bytes.
+        manifest_path (str): The path to the manifest file.
+    """
+
+    def __init__(self,
+                 root: str = None,
+                 max_size: int = 20 * 1024**3):
+
+        if root is None:
+            root = cache_root()
+        self.root = root
+        self.max_size = max_size
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def grid_cell(lat: float, lon: float, resolution: float = 0.25) -> tuple:
+        """
+        Round a point to the centre of its grid cell.
+
+        Args:
+            lat (float): The latitude of the point.
+            lon (float): The longitude of the point.
+            resolution (float): The grid resolution in degrees. Default is 0.25 (ERA5).
+
+        Returns:
+            tuple: (lat, lon) of the grid cell.
+        """
+        lat = round(round(float(lat) / resolution) * resolution, 6)
+        lon = round(round(float(lon) / resolution) * resolution, 6)
+        return lat, lon
+
+    @staticmethod
+    def _identity(kind, source, variables, lat, lon, zbot, lapse_rate, resolution,
+                  profile=None, encoding=None) -> dict:
+        """
+        The part of the key that does not depend on the time range.
+        """
+        cell = era5_cache.grid_cell(lat, lon, resolution)
+        return {
+            'kind': kind,
+            'source': source,
+            'variables': sorted(variables) if variables is not None else None,
+            'cell': list(cell),
+            'zbot': None if zbot is None else float(zbot),
+            'lapse_rate': None if lapse_rate is None else float(lapse_rate),
+            'profile': profile,
+            'encoding': encoding,
+        }
+
+    @staticmethod
+    def key(identity: dict, start, end) -> str:
+        """
+        The content address of an entry.
+
+        Args:
+            identity (dict): The entry parameters except the time range.
+            start (str): The first day of the entry, 'YYYY-MM-DD'.
+            end (str): The last day of the entry, 'YYYY-MM-DD'.
+
+        Returns:
+            str: The sha256 hex digest of the parameters.
+        """
+        params = dict(identity, start=_as_date(start).isoformat(), end=_as_date(end).isoformat())
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the lock of the manifest, across the threads and the processes that share the cache folder.
+        """
+        with self._lock:
+            with open(self.manifest_path + '.lock', 'a') as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # drop the entries whose file was removed outside the cache
+        return {k: v for k, v in manifest.items()
+                if os.path.exists(os.path.join(self.root, v['file']))}
+
+    def _save(self, manifest: dict) -> None:
+        tmp = f'{self.manifest_path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def _matching(self, manifest, identity) -> list:
+        return [(k, v) for k, v in manifest.items()
+                if all(v.get(p) == identity[p] for p in identity)]
+
+    def path(self, entry: dict) -> str:
+        """
+        The path to the file of an entry.
+        """
+        return os.path.join(self.root, entry['file'])
+
+    def get(self, kind: str, source: str, variables: list,
+            lat: float, lon: float, start, end,
+            zbot: float = None, lapse_rate: float = None,
+            resolution: float = 0.25, profile: str = None,
+            encoding: dict = None) -> Union[str, None]:
+        """
+        Find a cached file that covers the whole time range.
+
+        Args:
+            kind (str): "raw" for the downloaded ERA5 data, "forcing" for the converted forcing.
+            source (str): The data source, e.g. "cds", "arco-era5", "era5-land-ts", "gee".
+            variables (list): The variable names of the data.
+            lat (float): The latitude of the site.
+            lon (float): The longitude of the site.
+            start (str): The first day needed, 'YYYY-MM-DD'.
+            end (str): The last day needed, 'YYYY-MM-DD'.
+            zbot (float, optional): The bottom level height of the forcing.
+            lapse_rate (float, optional): The lapse rate of the forcing.
+            resolution (float): The grid resolution of the source in degrees. Default is 0.25.
+            profile (str, optional): The output profile of the converted forcing, e.g. "compressed".
+            encoding (dict, optional): The NetCDF encoding of the profile, see `pyclmuapp.forcing_io.FORCING_PROFILES`.
+
+        Returns:
+            str or None: The path to the cached file, which may cover a longer period, or None.
+        """
+        identity = self._identity(kind, source, variables, lat, lon, zbot, lapse_rate, resolution,
+                                  profile, encoding)
+        start, end = _as_date(start), _as_date(end)
+        with self._locked():
+            manifest = self._load()
+            found = None
+            for k, v in self._matching(manifest, identity):
+                if _as_date(v['start']) <= start and _as_date(v['end']) >= end:
+                    # the shortest covering entry is the cheapest to read
+                    if found is None or (_as_date(v['end']) - _as_date(v['start'])) < \
+                            (_as_date(manifest[found]['end']) - _as_date(manifest[found]['start'])):
+                        found = k
+            if found is None:
+                return None
+            manifest[found]['last_used'] = time.time()
+            self._save(manifest)
+            return self.path(manifest[found])
+
+    def overlapping(self, kind: str, source: str, variables: list,
+                    lat: float, lon: float, start, end,
+                    zbot: float = None, lapse_rate: float = None,
+                    resolution: float = 0.25, profile: str = None,
+                    encoding: dict = None) -> list:
+        """
+        Find the cached entries that overlap the time range, see `get` for the arguments.
+
+        Returns:
+            list: The overlapping entries (dict with 'file', 'start', 'end', ...), sorted by start.
+        """
+        identity = self._identity(kind, source, variables, lat, lon, zbot, lapse_rate, resolution,
+                                  profile, encoding)
+        start, end = _as_date(start), _as_date(end)
+        with self._locked():
+            manifest = self._load()
+            entries = []
+            for k, v in self._matching(manifest, identity):
+                if _as_date(v['start']) <= end and _as_date(v['end']) >= start:
+                    v['last_used'] = time.time()
+                    entries.append(dict(v))
+            if entries:
+                self._save(manifest)
+        return sorted(entries, key=lambda v: v['start'])
+
+    def missing(self, kind: str, source: str, variables: list,
+                lat: float, lon: float, start, end,
+                zbot: float = None, lapse_rate: float = None,
+                resolution: float = 0.25, profile: str = None,
+                encoding: dict = None) -> list:
+        """
+        The parts of the time range that are not in the cache, see `get` for the arguments.
+
+        Returns:
+            list: (start, end) tuples of 'YYYY-MM-DD' strings, both days included.
+        """
+        start, end = _as_date(start), _as_date(end)
+        gaps = []
+        cur = start
+        for v in self.overlapping(kind, source, variables, lat, lon, start, end,
+                                  zbot=zbot, lapse_rate=lapse_rate, resolution=resolution,
+                                  profile=profile, encoding=encoding):
+            v_start, v_end = _as_date(v['start']), _as_date(v['end'])
+            if v_start > cur:
+                gaps.append((cur.isoformat(), min(v_start - timedelta(days=1), end).isoformat()))
+            cur = max(cur, v_end + timedelta(days=1))
+            if cur > end:
+                break
+        if cur <= end:
+            gaps.append((cur.isoformat(), end.isoformat()))
+        return gaps
+
+    def put(self, file: str, kind: str, source: str, variables: list,
+            lat: float, lon: float, start, end,
+            zbot: float = None, lapse_rate: float = None,
+            resolution: float = 0.25, profile: str = None,
+            encoding: dict = None, move: bool = True) -> str:
+        """
+        Add a file to the cache, see `get` for the arguments.
+
+        Args:
+            file (str): The file to add.
+            move (bool): Move the file into the cache. If False, the file is copied
+                and left in place. Default is True.
+
+        Returns:
+            str: The path to the cached file.
+        """
+        identity = self._identity(kind, source, variables, lat, lon, zbot, lapse_rate, resolution,
+                                  profile, encoding)
+        k = self.key(identity, start, end)
+        name = k + os.path.splitext(file)[1]
+        target = os.path.join(self.root, name)
+        tmp = f'{target}.{os.getpid()}.{threading.get_ident()}.part'
+        if move:
+            shutil.move(file, tmp)
+        else:
+            shutil.copy2(file, tmp)
+        os.replace(tmp, target)
+
+        with self._locked():
+            manifest = self._load()
+            now = time.time()
+            manifest[k] = dict(identity,
+                               start=_as_date(start).isoformat(),
+                               end=_as_date(end).isoformat(),
+                               file=name,
+                               size=os.path.getsize(target),
+                               created=now,
+                               last_used=now)
+            self._evict(manifest, keep=k)
+            self._save(manifest)
+        return target
+
+    def _evict(self, manifest: dict, keep: str = None, max_size: int = None) -> None:
+        max_size = self.max_size if max_size is None else max_size
+        total = sum(v['size'] for v in manifest.values())
+        for k, v in sorted(manifest.items(), key=lambda kv: kv[1]['last_used']):
+            if total <= max_size:
+                break
+            if k == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.root, v['file']))
+            except FileNotFoundError:
+                pass
+            total -= v['size']
+            del manifest[k]
+
+    def evict(self, max_size: int = None) -> None:
+        """
+        Remove the least recently used entries until the cache is smaller than max_size.
+
+        Args:
+            max_size (int, optional): The size limit in bytes. Default is `self.max_size`.
+        """
+        with self._locked():
+            manifest = self._load()
+            self._evict(manifest, max_size=max_size)
+            self._save(manifest)
+
+    def size(self) -> int:
+        """
+        The total size of the cached files in bytes.
+        """
+        with self._locked():
+            return sum(v['size'] for v in self._load().values())
+
+    def clear(self) -> None:
+        """
+        Remove all the cached files and the manifest.
+        """
+        self.evict(max_size=0)
+
+
+def get_cache(cache: Union[bool, str, era5_cache] = True) -> Union[era5_cache, None]:
+    """
+    Resolve the `cache` argument of the forcing functions.
+
+    Args:
+        cache (bool, str or era5_cache): True for the default cache, False or None for no cache,
+            a folder path for a cache in that folder, or an era5_cache instance.
+
+    Returns:
+        era5_cache or None: The cache to use.
+    """
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return era5_cache()
+    if isinstance(cache, str):
+        return era5_cache(root=cache)
+    return cache
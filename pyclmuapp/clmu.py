@@ -13,6 +13,7 @@ import numpy as np
 from typing import Union, List, Dict
 import time
 import gc
+from pyclmuapp.nc_patch import patch_netcdf, label_index
 
 # Set the path of the CESM2
 class cesm_run():
@@ -183,7 +184,7 @@ class cesm_run():
 
         return ds
     
-    def modify_surf(self, var, action, numurbl=None) -> str:
+    def modify_surf(self, var, action, numurbl=None, inplace=True) -> str:
             
         """
         Modify the surface data file.
@@ -197,11 +198,27 @@ class cesm_run():
             numurbl (int, optional): The number of urban land units. Defaults to None. 
                 None means the action will be implemented to all the urban land units.
                 numurbl 0 --> TBD urban, numurbl 1 --> HD urban, numurbl 2 --> MD urban
+            inplace (bool, optional): Revise the variables in the file, see `pyclmuapp.nc_patch.patch_netcdf`.
+                Defaults to True. False to rewrite the whole file.
 
         Returns:
             str: The modified surface data file path.
         """
 
+        if inplace:
+            if numurbl is None:
+                param_location = dict(lsmlat=0, lsmlon=0)
+            else:
+                param_location = dict(lsmlat=0, lsmlon=0, numurbl=numurbl)
+            values, modes = self._patch_action(var, action, (float, np.float64, np.float32))
+            try:
+                patch_netcdf(self.config['local_fsurdat'], values, mode=modes,
+                             index=label_index(self.config['local_fsurdat'], param_location))
+                return self.config['local_fsurdat']
+            except OSError as e:
+                # e.g. the file is still open in this process, the whole file is rewritten
+                print(f"Can not revise {self.config['local_fsurdat']} in place ({e}), rewriting it.")
+
         # Open the file
         ds = xr.open_dataset(self.config['local_fsurdat'])
         # Modify the file
@@ -259,7 +276,25 @@ class cesm_run():
         gc.collect()
 
 
-    def modify_forcing(self, var, action, forcing_location) -> None:
+    @staticmethod
+    def _patch_action(var, action, numbers) -> tuple:
+
+        """
+        The values and the modes of `patch_netcdf` of an action of `modify_surf` or `modify_forcing`.
+        The numbers are added to the variables and the arrays replace them.
+        """
+
+        if not isinstance(action, dict):
+            action = {var: action}
+        values, modes = {}, {}
+        for i in action.keys():
+            if isinstance(action[i], numbers):
+                values[i], modes[i] = action[i], 'add'
+            elif isinstance(action[i], np.ndarray):
+                values[i], modes[i] = action[i], 'replace'
+        return values, modes
+
+    def modify_forcing(self, var, action, forcing_location, inplace=True) -> None:
 
 
         """
@@ -272,10 +307,21 @@ class cesm_run():
                 - if action is a dict, the key is the variable name, the value is the action.
                 - if action is a float, the action will be added to the variable.
                 - if action is a np.ndarray, the variable will be replaced by the action.
+            inplace (bool, optional): Revise the variables in the file, see `pyclmuapp.nc_patch.patch_netcdf`.
+                Defaults to True. False to rewrite the whole file.
         Returns:
             None
         """
 
+        if inplace:
+            values, modes = self._patch_action(var, action, (int, float, np.float64, np.float32))
+            try:
+                patch_netcdf(forcing_location, values, mode=modes)
+                return
+            except OSError as e:
+                # e.g. the file is still open in this process, the whole file is rewritten
+                print(f"Can not revise {forcing_location} in place ({e}), rewriting it.")
+
         ds = xr.open_dataset(forcing_location)
         if isinstance(action, float) or isinstance(action, int) or isinstance(action, np.float64) or isinstance(action, np.float32):
             ds[var].loc[:] = ds[var].loc[:].values + action
@@ -321,7 +367,7 @@ def run_command(command, password="None", logname="None", iflog=True) -> None:
     The loges will be saved in the log_ppo.txt file.
 
     Args:
-        command (str): The command to be run.
+        command (str or list): The command to be run, a shell string or a list of arguments run without a shell.
         password (str, optional): The password of the server.
         logname (str, optional): The name of the log file. Defaults to "cmdlog.txt".
         iflog (bool, optional): If log is needed. Defaults to True.
@@ -330,12 +376,13 @@ def run_command(command, password="None", logname="None", iflog=True) -> None:
         None
     """
     
+    shell = isinstance(command, str)
     try:
         if password == "None":
             
-            result = subprocess.run(command, text=True, check=True, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            result = subprocess.run(command, text=True, check=True, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         else:    
-            result = subprocess.run(command, input=password, text=True, check=True, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            result = subprocess.run(command, input=password, text=True, check=True, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
         if iflog:
             if logname == "None":
@@ -1,6 +1,10 @@
 import os
-import json
+import atexit
+import hashlib
+import time
 from pyclmuapp.clmu import *
+from pyclmuapp.async_run import run_handle
+from pyclmuapp.backend import container_backend, get_backend
 from datetime import datetime
 #from pyclmuapp.config.scripts import *
 from typing import Union
@@ -18,6 +22,9 @@ class clumapp:
         container_type (str): The type of the container for CLMU-App. The supported types are:
             - docker: The docker container.
             - singularity: The singularity container.
+            See `pyclmuapp.backend.BACKENDS` for the others.
+        native_paths (dict or str, optional): The host paths of the container type "native",
+            see `pyclmuapp.backend.native_backend`.
 
     Attributes:
         - input_path (str): The path to the folder for the input of CLMU-App.
@@ -30,6 +37,7 @@ class clumapp:
         - save_name (str): The name of the output file.
         - caseconfig (dict): The configuration of the case to be built.
         - clmu_run (cesm_run): The object for running CLMU-App.
+        - backend (container_backend): The backend building and running the commands, see `pyclmuapp.backend`.
 
     """
 
@@ -39,7 +47,8 @@ class clumapp:
                  output_path: str = "outputfolder",
                  log_path: str = "logfolder",
                  scripts_path: str = "scriptsfolder",
-                 container_type: str = "docker"
+                 container_type: str = "docker",
+                 native_paths: Union[dict, str] = None
                  ):
         """
         
@@ -55,6 +64,11 @@ class clumapp:
                 - singularity: The singularity container. [for HPC users]
                 - docker_in: The docker-in-docker container.
                 - udocker: The udocker container. [only for Linux users, if you using Linux OS, we recommend using this option]
+                - native: No container, the commands run on a host CTSM install, see `pyclmuapp.backend.native_backend`.
+                - fake: No command is run, the commands are recorded. [for tests]
+            native_paths (dict or str, optional): The host path of each container prefix for the container type "native",
+                e.g. {"/p/project/clm5.0": "/home/user/ctsm"}, or a JSON file of them. The default is None,
+                the JSON file $PYCLMUAPP_NATIVE_PATHS, see `pyclmuapp.backend.native_backend`.
                 
         
         """
@@ -81,6 +95,11 @@ class clumapp:
         self.image_name = "junjieyuuom/clmu-app:1.2"
         self.container_name = "myclmu"
         self.container_type = container_type
+        # the warm container of the runs, see `session`
+        self._session = None
+        # the backend of the container type, see `backend`
+        self._backend = None
+        self.native_paths = native_paths
 
         if container_type == "docker":
             self.container_name = "myclmu"
@@ -99,6 +118,8 @@ class clumapp:
             self.container_name = "myclmu"
         elif container_type == "udocker":
             self.container_name = "myclmu"
+        elif container_type in ("native", "fake"):
+            self.container_name = "myclmu"
         else:
             raise ValueError(f"Container type '{container_type}' is not supported.")
 
@@ -124,6 +145,23 @@ class clumapp:
         return folder_path
 
 
+    @property
+    def backend(self) -> container_backend:
+
+        """
+        The backend building and running the commands of the container type and image,
+        see `pyclmuapp.backend.get_backend`. It can be replaced, e.g. by a `fake_backend` in tests.
+        """
+
+        if self._backend is not None:
+            return self._backend
+        return get_backend(self.container_type, self.image_name,
+                           paths=self.native_paths if self.container_type == "native" else None)
+
+    @backend.setter
+    def backend(self, backend: container_backend) -> None:
+        self._backend = backend
+
     def docker(self,
                cmd: str = "run",
                iflog : bool = True,
@@ -141,6 +179,7 @@ class clumapp:
                 - chmod: Change the mode of a file.
                 - run: create a docker container.
                 - exec: Execute the docker command.
+                - usp: Run a usp case, in the container of the active session if any.
             iflog (bool, optional): If log is needed. The default is True.
             password (str, optional): The password for the sudo command. The default is "None".
             cmdlogfile (str, optional): The name of the log file. The default is "dockercmd.log".
@@ -150,57 +189,116 @@ class clumapp:
         if cmdlogfile is None:
             cmdlogfile = os.path.join(self.pwd, "dockercmd.log")
 
-        if self.container_type == "docker":
-            if self.image_name == "envdes/clmu-app:1.1":
-                with open(os.path.join(os.path.dirname(__file__),'./config/ini_docker_1.1.json')) as f:
-                    config = json.load(f)
-            else:
-                with open(os.path.join(os.path.dirname(__file__),'./config/ini_docker.json')) as f:
-                    config = json.load(f)
-        elif self.container_type == "singularity":
-            if self.image_name == "envdes/clmu-app:1.1":
-                with open(os.path.join(os.path.dirname(__file__),'./config/ini_sing_1.1.json')) as f:
-                    config = json.load(f)
-            else:
-                with open(os.path.join(os.path.dirname(__file__),'./config/ini_sing.json')) as f:
-                    config = json.load(f)
-        elif self.container_type == "docker_in":
-            with open(os.path.join(os.path.dirname(__file__),'./config/ini_docker_in.json')) as f:
-                config = json.load(f)
-        elif self.container_type == "udocker":
-            with open(os.path.join(os.path.dirname(__file__),'./config/ini_udocker.json')) as f:
-                config = json.load(f)
+        # the runs go through the warm container of an active session, see `session`
+        if cmd == "usp" and getattr(self, '_session', None) is not None:
+            cmd = "session-exec"
 
+        command = self._command(cmd, password=password, dockersript=dockersript)
 
-        if cmd in config.keys():
+        #print(f"Running the docker command: '{command}'")
+        self.backend.run(command=command,
+                         password=password,
+                         logname=cmdlogfile,
+                         iflog=iflog
+                         )
 
-            if password != "None":
-                command = "sudo -S " + config[cmd]
-            else:
-                command = config[cmd]
-                
-            if os.name == 'nt':
-                command = command.replace("'", '"')
-
-            command = command.format(
-                image_name=self.image_name,
-                container_name=self.container_name,
-                input_path=self.input_path,
-                output_path=self.output_path,
-                log_path=self.log_path,
-                scripts_path=self.scripts_path,
-                command=dockersript
-            )
-            
-            #print(f"Running the docker command: '{command}'")
-            run_command(command=command,
-                        password=password,
-                        logname=cmdlogfile,
-                        iflog=iflog
-                        )
-        else:
-            print(f"Command '{cmd}' is not supported.")
-            raise ValueError
+    def docker_async(self,
+                     cmd: str = "run",
+                     iflog: bool = True,
+                     password: str = "None",
+                     cmdlogfile: str = None,
+                     dockersript: str = "docker.sh",
+                     callback=None) -> run_handle:
+
+        """
+        Start the docker command without waiting for it, in the running event loop.
+
+        The output is streamed line by line to the log file, which is appended to and rotated,
+        and to `callback`, see `pyclmuapp.async_run.stream_command`.
+
+        Args:
+            cmd (str): The docker command to be run, see `docker`.
+            iflog (bool, optional): If log is needed. The default is True.
+            password (str, optional): The password for the sudo command. The default is "None".
+            cmdlogfile (str, optional): The name of the log file. The default is "dockercmd.log".
+            dockersript (str, optional): The name of the docker script. The default is "docker.sh".
+            callback (callable, optional): Called with (stream, line) for each output line.
+
+        Returns:
+            run_handle: The handle of the command, to be awaited for its return code.
+        """
+
+        if cmdlogfile is None:
+            cmdlogfile = os.path.join(self.pwd, "dockercmd.log")
+
+        if cmd == "usp" and getattr(self, '_session', None) is not None:
+            cmd = "session-exec"
+
+        command = self._command(cmd, password=password, dockersript=dockersript)
+        return self.backend.start(command, callback=callback, password=password,
+                                  logname=cmdlogfile, iflog=iflog)
+
+    def _config(self) -> dict:
+
+        """
+        The command templates of the container type.
+        """
+
+        return self.backend.templates
+
+    def _command(self,
+                 cmd: str,
+                 password: str = "None",
+                 dockersript: str = "docker.sh") -> Union[list, str]:
+
+        """
+        Build the command `cmd` with the backend, see `docker` for the arguments.
+
+        Returns:
+            list or str: The arguments of the command, or a shell string, see `pyclmuapp.backend.container_backend.command`.
+        """
+
+        session = getattr(self, '_session', None)
+        values = dict(
+            image_name=self.image_name,
+            container_name=self.container_name,
+            session_name=session.name if session is not None else self.session_name(),
+            input_path=self.input_path,
+            output_path=self.output_path,
+            log_path=self.log_path,
+            scripts_path=self.scripts_path,
+            command=dockersript
+        )
+        return self.backend.command(cmd, values, password=password)
+
+    def session_name(self) -> str:
+
+        """
+        The name of the warm container of this working directory.
+        The folders are mounted when the container starts, so each set of folders has its own container.
+        """
+
+        folders = "|".join([self.input_path, self.output_path, self.log_path, self.scripts_path])
+        return "pyclmuapp_" + hashlib.sha256(folders.encode()).hexdigest()[:12]
+
+    def session(self, **kwargs) -> 'container_session':
+
+        """
+        A long-lived container reused by the runs, see `container_session`.
+
+        Examples:
+            >>> with usp.session():
+            ...     usp.run(...)
+            ...     usp.run(...)
+
+        Args:
+            **kwargs: The arguments of `container_session`.
+
+        Returns:
+            container_session: The session, started when the `with` block is entered.
+        """
+
+        return container_session(self, **kwargs)
 
     def case_scripts(self, mode: str = "usp") -> None:
 
@@ -272,3 +370,111 @@ class clumapp:
         
         if os.path.exists(os.path.join(self.input_path, 'usp')):
             shutil.rmtree(os.path.join(self.input_path, 'usp'))
+
+
+class container_session:
+
+    """
+    A long-lived container for repeated runs.
+
+    The container is started once, with the folders of the app mounted, and checked until it
+    answers. While the session is active, the runs of the app (`usp_clmu.run` with crun_type "usp")
+    go through `exec` in this container instead of starting a new container each time.
+    The container is removed when the `with` block exits, by `stop`, or at the end of the process.
+    Supported for the docker and singularity containers, and the fake backend.
+
+    Args:
+        app (clumapp): The app whose runs use the session.
+        retries (int): The number of health checks after the start. The default is 30.
+        interval (float): The seconds between two health checks. The default is 1.
+
+    Attributes:
+        name (str): The name of the container (docker) or instance (singularity).
+        active (bool): If the session is started.
+    """
+
+    def __init__(self,
+                 app: clumapp,
+                 retries: int = 30,
+                 interval: float = 1.0):
+
+        if app.container_type not in ("docker", "singularity", "fake"):
+            raise ValueError(f"The container type '{app.container_type}' does not support sessions.")
+        self.app = app
+        self.name = app.session_name()
+        self.retries = retries
+        self.interval = interval
+        self.active = False
+
+    def _call(self, cmd: str, check: bool = False) -> bool:
+        returncode = self.app.backend.call(self.app._command(cmd))
+        if check and returncode != 0:
+            raise RuntimeError(f"The command '{cmd}' of the session {self.name} failed with return code {returncode}.")
+        return returncode == 0
+
+    def healthy(self) -> bool:
+        """
+        If the container of the session answers a command.
+        """
+        return self._call("session-check")
+
+    def start(self) -> 'container_session':
+        """
+        Start the container, or reuse it if it is already running, and wait until it is healthy.
+
+        Returns:
+            container_session: The session.
+        """
+        if self.active:
+            return self
+        if not self.healthy():
+            # a stopped container of a previous session is removed first
+            self._call("session-stop")
+            self._call("session-start", check=True)
+            for i in range(self.retries):
+                if self.healthy():
+                    break
+                time.sleep(self.interval)
+            else:
+                self._call("session-stop")
+                raise RuntimeError(f"The container {self.name} did not start.")
+        self.active = True
+        self.app._session = self
+        atexit.register(self.stop)
+        print(f"The container session {self.name} is started.")
+        return self
+
+    def exec(self,
+             command: str,
+             iflog: bool = True,
+             cmdlogfile: str = None) -> None:
+        """
+        Run a command in the container of the session.
+
+        Args:
+            command (str): The command.
+            iflog (bool, optional): If log is needed. The default is True.
+            cmdlogfile (str, optional): The name of the log file, see `clumapp.docker`.
+        """
+        if not self.active:
+            raise RuntimeError(f"The session {self.name} is not started.")
+        self.app.docker(cmd="session-exec", iflog=iflog, cmdlogfile=cmdlogfile, dockersript=command)
+
+    def stop(self) -> None:
+        """
+        Remove the container of the session.
+        """
+        if not self.active:
+            return
+        self._call("session-stop")
+        self.active = False
+        if getattr(self.app, '_session', None) is self:
+            self.app._session = None
+        atexit.unregister(self.stop)
+        print(f"The container session {self.name} is stopped.")
+
+    def __enter__(self) -> 'container_session':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
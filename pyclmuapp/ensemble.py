@@ -0,0 +1,143 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pyclmuapp.usp import usp_clmu
+
+# the inputs of a member are staged by the ensemble, not by `usp_clmu.run`
+_staged_args = ('SURF', 'FORCING', 'ATM_DOM')
+
+
+def member_names(scenarios: list, run_kwargs: dict = None) -> list:
+    """
+    Check the scenarios of an ensemble and get the names of the members.
+
+    Args:
+        scenarios (list): The scenarios, see `usp_ensemble`.
+        run_kwargs (dict, optional): The arguments of `usp_clmu.run` shared by all the members.
+
+    Returns:
+        list: The name of each member, "member<i>" by default.
+    """
+
+    names = []
+    for i, scenario in enumerate(scenarios):
+        name = scenario.get('name', f"member{i:03d}")
+        if name in names:
+            raise ValueError(f"The name {name} is used by more than one scenario.")
+        names.append(name)
+    for args in [run_kwargs or {}] + [s.get('run', {}) for s in scenarios]:
+        staged = [k for k in _staged_args if k in args]
+        if staged:
+            raise ValueError(f"The arguments {staged} are given to the ensemble, not to the runs.")
+    return names
+
+
+def stage_member(pwd: str,
+                 scenario: dict,
+                 forcing: str,
+                 surfdata: str = None,
+                 domain: str = None,
+                 container_type: str = "docker",
+                 scripts_path: str = "scriptsfolder") -> usp_clmu:
+    """
+    Stage the inputs of a member of an ensemble in its own working directory.
+
+    Args:
+        pwd (str): The working directory of the member.
+        scenario (dict): The scenario of the member, see `usp_ensemble`.
+        forcing (str): The path to the baseline forcing data file.
+        surfdata (str, optional): The path to the baseline surface data file. The default is None, the default surface data.
+        domain (str, optional): The path to the domain data file. The default is None, the domain of the surface data.
+        container_type (str): The type of the container. The default is "docker".
+        scripts_path (str): The scripts folder of the member, relative to pwd or absolute.
+            The members that share a scripts folder share the built case, see `usp_clmu.build_case_name`.
+            The default is "scriptsfolder", the own folder of the member.
+
+    Returns:
+        usp_clmu: The member, ready to run.
+    """
+
+    member = usp_clmu(pwd=pwd, container_type=container_type, scripts_path=scripts_path)
+    if surfdata is not None:
+        # the default surface data is read by usp_clmu itself
+        member.check_surf(usr_surfdata=surfdata)
+    if scenario.get('surf'):
+        member.modify_surf(action=scenario['surf'], mode=scenario.get('surf_mode', 'add'))
+    member.check_forcing(usr_forcing=forcing)
+    if scenario.get('forcing'):
+        member.perturb_forcing(scenario['forcing'])
+    member.check_domain(usr_domain=domain)
+    member.flush_surf()
+    return member
+
+
+def usp_ensemble(scenarios: list,
+                 forcing: str,
+                 pwd: str = os.path.join(os.getcwd(), 'ensemble'),
+                 surfdata: str = None,
+                 domain: str = None,
+                 case_name: str = "usp_case",
+                 container_type: str = "docker",
+                 max_workers: int = None,
+                 **run_kwargs) -> dict:
+    """
+    Run an ensemble of urban single point scenarios with a bounded pool of concurrent containers.
+
+    Each member gets its own working directory (pwd/<name>, with its own input, output and log
+    folders) and its own case name (<case_name>_<name>). The members share one scripts folder
+    (pwd/scriptsfolder), where the case of each member is set up next to the built case they are
+    all cloned from, so the model is built once for the ensemble, see `usp_clmu.build_case_name`.
+    The inputs of all the members are staged first, one after the other, because the NetCDF
+    library is not thread safe. The runs are then started in up to `max_workers` concurrent
+    container invocations, each `usp_clmu.run` waiting on its own container process.
+
+    Args:
+        scenarios (list): The scenarios, a dict per member with the optional keys:
+            - "name" (str): The name of the member. The default is "member<i>".
+            - "surf" (dict): The revision of the surface data, see `usp_clmu.modify_surf`.
+            - "surf_mode" (str): The mode of the surface revision. The default is "add".
+            - "forcing" (dict): The perturbation of the forcing data, see `pyclmuapp.forcing_io.perturb_forcing`.
+            - "run" (dict): The arguments of `usp_clmu.run` for this member, e.g. the run window
+              {"RUN_STARTDATE": "2012-08-08", "STOP_OPTION": "ndays", "STOP_N": "10"}.
+        forcing (str): The path to the baseline forcing data file.
+        pwd (str): The working directory of the ensemble. The default is pwd+"ensemble".
+        surfdata (str, optional): The path to the baseline surface data file. The default is None, the default surface data.
+        domain (str, optional): The path to the domain data file. The default is None, the domain of the surface data.
+        case_name (str): The prefix of the case names. The default is "usp_case".
+        container_type (str): The type of the container, see `pyclmuapp.container.clumapp`. The default is "docker".
+        max_workers (int, optional): The maximum number of concurrent runs. The default is the number of CPUs.
+        **run_kwargs: The arguments of `usp_clmu.run` shared by all the members.
+
+    Returns:
+        dict: The list of the output files of each member, keyed by name. A failed member has an empty list.
+    """
+
+    names = member_names(scenarios, run_kwargs)
+
+    # stage the inputs of every member, in this thread
+    members = {}
+    for name, scenario in zip(names, scenarios):
+        members[name] = stage_member(os.path.join(pwd, name), scenario, forcing, surfdata=surfdata,
+                                     domain=domain, container_type=container_type,
+                                     scripts_path=os.path.join(pwd, 'scriptsfolder'))
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    def _run(name, scenario):
+        kwargs = dict(run_kwargs, **scenario.get('run', {}))
+        kwargs['case_name'] = f"{case_name}_{name}"
+        return members[name].run(**kwargs)
+
+    outputs = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = {pool.submit(_run, name, scenario): name for name, scenario in zip(names, scenarios)}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                outputs[name] = future.result()
+                print(f"The member {name} is done.")
+            except Exception as e:
+                outputs[name] = []
+                print(f"The member {name} failed: {e}")
+
+    return {name: outputs[name] for name in names}
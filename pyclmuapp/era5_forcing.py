@@ -3,9 +3,12 @@ import os
 import xarray as xr
 import numpy as np
 from typing import Union
-import tempfile
-import zipfile
-import shutil
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from pyclmuapp.forcing_kernel import era5_forcing_dataset, era5_forcing_kernel, forcing_dataset
+from pyclmuapp.forcing_io import append_netcdf, open_zip_netcdf
 
 variable=[
             '10m_u_component_of_wind', '10m_v_component_of_wind', '2m_dewpoint_temperature',
@@ -25,8 +28,135 @@ era5_var_dict = {
     'forecast_surface_roughness': 'fsr'
 }
 
+def era5_paths(year, month, lat, lon, outputfolder='./data', area=None):
+    """
+    The paths of the downloaded zip and of the merged NetCDF of one month.
+
+    Args:
+        year (int): The year of the data.
+        month (int): The month of the data.
+        lat (float): The latitude of the data.
+        lon (float): The longitude of the data.
+        outputfolder (str): The folder of the downloaded data.
+        area (list, optional): The [north, west, south, east] region of the data, see `era5_area`.
+            If given, lat and lon are not used.
+
+    Returns:
+        tuple: (single, single_nc), the zip path and the NetCDF path.
+    """
+    months_str = str(month).zfill(2)
+    if area is not None:
+        name = f'era5_region_{year}_{months_str}_' + '_'.join(str(a) for a in area)
+    else:
+        name = f'era5_single_{year}_{months_str}_{lat}_{lon}'
+    single = os.path.join(outputfolder, name + '.zip')
+    single_nc = os.path.join(outputfolder, name + '.nc')
+    return single, single_nc
+
+
+def era5_area(lats, lons, resolution=0.25):
+    """
+    The smallest ERA5 region that holds the nearest grid cell of every site.
+
+    Args:
+        lats (array-like): The latitudes of the sites.
+        lons (array-like): The longitudes of the sites.
+        resolution (float): The grid resolution in degrees. Default is 0.25.
+
+    Returns:
+        list: The [north, west, south, east] area of the CDS request.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    # the nearest grid cell of a site is at most one grid step away in each direction
+    north = min(np.ceil(lats.max() / resolution) * resolution, 90.)
+    south = max(np.floor(lats.min() / resolution) * resolution, -90.)
+    west = np.floor(lons.min() / resolution) * resolution
+    east = np.ceil(lons.max() / resolution) * resolution
+    return [round(float(a), 6) for a in (north, west, south, east)]
+
+
+def era5_retrieve(year, month, lat, lon,
+                  outputfolder='./data',
+                  client=None,
+                  area=None):
+    """
+    Retrieve the zip of one month of ERA5 single level data from the CDS.
+    Nothing is requested if the zip or the merged NetCDF already exists.
+
+    The zip is written under a temporary name and renamed once complete,
+    so an interrupted request never leaves a broken zip behind.
+
+    Args:
+        year (int): The year of the data to download.
+        month (int): The month of the data to download.
+        lat (float): The latitude of the data to download.
+        lon (float): The longitude of the data to download.
+        outputfolder (str): The folder to save the downloaded data to.
+        client (cdsapi.Client, optional): The CDS client used for the request. Default is a new `cdsapi.Client()`.
+        area (list, optional): The [north, west, south, east] region to download, see `era5_area`.
+            Default is the 0.5 degree box around (lat, lon).
+
+    Returns:
+        str: The path to the downloaded zip, or to the NetCDF if it already exists.
+    """
+    single, single_nc = era5_paths(year, month, lat, lon, outputfolder, area=area)
+    if os.path.exists(single_nc):
+        print(f'file exists: {single_nc}')
+        return single_nc
+    if os.path.exists(single):
+        print(f'file exists: {single}')
+        return single
+
+    c = cdsapi.Client() if client is None else client
+    print(f'download: {single}')
+    os.makedirs(outputfolder, exist_ok=True)
+    c.retrieve(
+    'reanalysis-era5-single-levels',
+    {
+        'product_type': ["reanalysis"],
+        "download_format": "zip",
+        'data_format': 'netcdf',
+        'variable': variable,
+        'year': [str(year)],
+        'month': [str(month).zfill(2)],
+        #'month': [str(i).zfill(2) for i in months],
+        'day': [str(i).zfill(2) for i in range(1, 32)],
+        'time': [str(i).zfill(2)+':00' for i in range(24)],
+        'area': [
+            lat+0.25, lon-0.25, lat-0.25, lon+0.25,
+        ] if area is None else list(area),
+    },
+    single + '.part')
+    os.replace(single + '.part', single)
+    return single
+
+
+def era5_unzip(single, single_nc):
+    """
+    Merge the NetCDF files of a downloaded CDS zip into one NetCDF file and remove the zip.
+    The members are read from the zip in memory, nothing is extracted to disk.
+
+    Args:
+        single (str): The path to the downloaded zip.
+        single_nc (str): The path to the merged NetCDF file.
+
+    Returns:
+        str: The path to the merged NetCDF file.
+    """
+    single_ds = open_zip_netcdf(single)
+    single_ds = single_ds.rename({'valid_time': 'time'})
+    single_ds = single_ds.drop_vars(['expver','number'], errors='ignore')
+    # written under a temporary name, so an interrupted write never leaves a broken file behind
+    single_ds.to_netcdf(single_nc + '.part')
+    os.replace(single_nc + '.part', single_nc)
+    os.remove(single)
+    return single_nc
+
+
 def era5_download(year, month,lat, lon, 
-                  outputfolder='./data'):
+                  outputfolder='./data',
+                  client=None):
 
     """
     This function `era5_download` is designed to download ERA5 reanalysis data for 
@@ -39,6 +169,7 @@ def era5_download(year, month,lat, lon,
         lat (float): The latitude of the data to download.
         lon (float): The longitude of the data to download.
         outputfolder (str): The folder to save the downloaded data to.
+        client (cdsapi.Client, optional): The CDS client used for the request. Default is a new `cdsapi.Client()`.
         
     Returns:
         pres (str): The path to the downloaded pressure level data.
@@ -46,64 +177,316 @@ def era5_download(year, month,lat, lon,
     
     """
     
-    c = cdsapi.Client()
-    
-    #months_str = "-".join([str(i).zfill(2) for i in months])
-    months_str = str(month).zfill(2)
-    single = os.path.join(outputfolder, f'era5_single_{year}_{months_str}_{lat}_{lon}.zip')
-    single_nc = os.path.join(outputfolder, f'era5_single_{year}_{months_str}_{lat}_{lon}.nc')
-    if os.path.exists(single_nc):
-        print(f'file exists: {single_nc}')
-    else:
-        print(f'download: {single}')
-        os.makedirs(outputfolder, exist_ok=True)
-        c.retrieve(
-        'reanalysis-era5-single-levels',
-        {
-            'product_type': ["reanalysis"],
-            "download_format": "zip",
-            'data_format': 'netcdf',
-            'variable': variable,
-            'year': [str(year)],
-            'month': [str(month).zfill(2)],
-            #'month': [str(i).zfill(2) for i in months],
-            'day': [str(i).zfill(2) for i in range(1, 32)],
-            'time': [str(i).zfill(2)+':00' for i in range(24)],
-            'area': [
-                lat+0.25, lon-0.25, lat-0.25, lon+0.25,
-            ],
-        },
-        single)
-
-        with zipfile.ZipFile(single, 'r') as zip_ref:
-            os.makedirs(f'{outputfolder}/single_temp', exist_ok=True)
-            zip_ref.extractall(f'{outputfolder}/single_temp')
-            ds_ls = []
-            for file in zip_ref.namelist():
-                if file.endswith('.nc'):
-                    single_ds = f'{outputfolder}/single_temp/{file}'
-                    ds = xr.open_dataset(single_ds)
-                    ds_ls.append(ds)
-                    
-            single_ds = xr.merge(ds_ls)
-            
-            single_ds = single_ds.rename({'valid_time': 'time'})
-            single_ds = single_ds.drop_vars(['expver','number'])
-            single_ds.to_netcdf(single_nc)
-            
-        shutil.rmtree(f'{outputfolder}/single_temp')
-        os.remove(single)        
+    single, single_nc = era5_paths(year, month, lat, lon, outputfolder)
+    if era5_retrieve(year, month, lat, lon, outputfolder, client=client) == single:
+        era5_unzip(single, single_nc)
                 
     return single_nc
 
 
+def month_range(start_year, start_month, end_year, end_month):
+    """
+    List the (year, month) pairs from start_year-start_month to end_year-end_month, both included.
+
+    Args:
+        start_year (int): The start year.
+        start_month (int): The start month.
+        end_year (int): The end year.
+        end_month (int): The end month.
+
+    Returns:
+        list: The list of (year, month) tuples in time order.
+    """
+    months = []
+    year, month = int(start_year), int(start_month)
+    while (year, month) <= (int(end_year), int(end_month)):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def month_bounds(year, month):
+    """
+    The first and the last day of a month.
+
+    Args:
+        year (int): The year.
+        month (int): The month.
+
+    Returns:
+        tuple: (first, last) as 'YYYY-MM-DD' strings.
+    """
+    first = date(int(year), int(month), 1)
+    after = date(first.year + 1, 1, 1) if first.month == 12 else date(first.year, first.month + 1, 1)
+    return first.isoformat(), (after - timedelta(days=1)).isoformat()
+
+
+def retry_call(func,
+               retries: int = 3,
+               backoff: float = 30,
+               label: str = 'request',
+               on_error=None):
+    """
+    Call a function, and retry a failed call with an exponential backoff.
+
+    Args:
+        func (callable): The function to call, without arguments.
+        retries (int): The number of retries of a failed call. Default is 3.
+        backoff (float): The wait in seconds before the first retry, doubled at each retry. Default is 30.
+        label (str): The name of the call in the messages. Default is 'request'.
+        on_error (callable, optional): Called with the error and whether it was the last attempt.
+
+    Returns:
+        The result of the function.
+
+    Raises:
+        Exception: The error of the last attempt.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if on_error is not None:
+                on_error(e, attempt == retries)
+            if attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt
+            print(f'{label} failed ({e}), retry in {wait} s')
+            time.sleep(wait)
+
+
+class era5_download_pool:
+
+    """
+    Download the monthly ERA5 data of a location with a bounded pool of concurrent CDS requests.
+
+    Each month is retrieved with `era5_retrieve` in a worker thread. A failed request is retried
+    with an exponential backoff. The state of each month is kept in `status`, and `download` yields
+    the months in time order as soon as they are ready, so the conversion of a month overlaps with
+    the download of the next ones.
+
+    Args:
+        lat (float): The latitude of the data to download.
+        lon (float): The longitude of the data to download.
+        outputfolder (str): The folder to save the downloaded data to.
+        area (list, optional): The [north, west, south, east] region to download instead of the box
+            around (lat, lon), see `era5_area`. Default is None.
+        max_workers (int): The maximum number of concurrent CDS requests. Default is 4.
+        retries (int): The number of retries of a failed request. Default is 3.
+        backoff (float): The wait in seconds before the first retry, doubled at each retry. Default is 30.
+        client_factory (callable, optional): Return the CDS client used by a request. Default is `cdsapi.Client`.
+            A stub client can be given here for tests.
+        cache (era5_cache, optional): The cache of the downloaded months, see `pyclmuapp.cache`.
+            The point is moved to the centre of its ERA5 grid cell, the cached months are not requested
+            and the new ones are moved into the cache. Only used without area. Default is None (no cache).
+
+    Attributes:
+        status (dict): The state of each (year, month): "pending", "downloading", "retrying",
+            "downloaded", "done" or "failed". A month is "done" once its zip is merged into the NetCDF file.
+        files (dict): The downloaded file of each (year, month) once done.
+        errors (dict): The last error of each (year, month) that failed.
+    """
+
+    def __init__(self,
+                 lat: float = None,
+                 lon: float = None,
+                 outputfolder: str = './data',
+                 area: list = None,
+                 max_workers: int = 4,
+                 retries: int = 3,
+                 backoff: float = 30,
+                 client_factory=None,
+                 cache=None):
+
+        self.area = area
+        self.cache = cache if area is None else None
+        if self.cache is not None:
+            lat, lon = cache.grid_cell(lat, lon)
+        self.lat = lat
+        self.lon = lon
+        self.outputfolder = outputfolder
+        self.max_workers = max(1, int(max_workers))
+        self.retries = retries
+        self.backoff = backoff
+        self.client_factory = cdsapi.Client if client_factory is None else client_factory
+        self.status = {}
+        self.files = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def _set_status(self, key, state):
+        with self._lock:
+            self.status[key] = state
+
+    def _download_month(self, year, month):
+        """
+        Retrieve one month from the CDS, with retries.
+        """
+        key = (year, month)
+
+        def _retrieve():
+            self._set_status(key, "downloading")
+            return era5_retrieve(year=year, month=month,
+                                 lat=self.lat, lon=self.lon,
+                                 outputfolder=self.outputfolder,
+                                 client=self.client_factory(),
+                                 area=self.area)
+
+        def _failed(e, last):
+            # the error and the status are changed together
+            with self._lock:
+                self.errors[key] = e
+                self.status[key] = "failed" if last else "retrying"
+
+        single = retry_call(_retrieve, retries=self.retries, backoff=self.backoff,
+                            label=f'download of {year}-{str(month).zfill(2)}', on_error=_failed)
+        self._set_status(key, "downloaded")
+        return single
+
+    def download(self, months: list):
+        """
+        Download the months and yield them in the given order.
+
+        Args:
+            months (list): The (year, month) tuples to download, see `month_range`.
+
+        Yields:
+            tuple: (year, month, single) where single is the path to the downloaded NetCDF file.
+        """
+        os.makedirs(self.outputfolder, exist_ok=True)
+        cached = {}
+        for year, month in months:
+            self._set_status((year, month), "pending")
+            if self.cache is not None:
+                hit = self.cache.get('raw', 'cds', variable, self.lat, self.lon,
+                                     *month_bounds(year, month))
+                if hit is not None:
+                    cached[(year, month)] = hit
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [(year, month, None if (year, month) in cached else
+                        pool.submit(self._download_month, year, month))
+                       for year, month in months]
+            try:
+                for year, month, future in futures:
+                    if future is None:
+                        self.files[(year, month)] = single = cached[(year, month)]
+                        self._set_status((year, month), "done")
+                        yield year, month, single
+                        continue
+                    single = future.result()
+                    # HDF5 is not thread safe, the zip is merged here rather than in the workers
+                    zip_path, single_nc = era5_paths(year, month, self.lat, self.lon, self.outputfolder,
+                                                     area=self.area)
+                    if single == zip_path:
+                        single = era5_unzip(zip_path, single_nc)
+                    if self.cache is not None:
+                        single = self.cache.put(single, 'raw', 'cds', variable, self.lat, self.lon,
+                                                *month_bounds(year, month))
+                    self.files[(year, month)] = single
+                    self._set_status((year, month), "done")
+                    yield year, month, single
+            finally:
+                for _, _, future in futures:
+                    if future is not None:
+                        future.cancel()
+
+
+def era5_batch_to_forcing(sites: list,
+                          start_year: int, start_month: int,
+                          end_year: int, end_month: int,
+                          outputfolder: str = './era5_data',
+                          lapse_rate: float = 0.006,
+                          max_workers: int = 4,
+                          client_factory=None,
+                          profile: str = 'default'):
+    """
+    Make the forcing of many sites from one regional ERA5 download per month.
+
+    The region that covers all the sites is downloaded once per month with `era5_download_pool`.
+    The nearest grid cell of every site is selected at once and converted with one call of
+    `era5_forcing_kernel` on (time, site) arrays, then each month is appended to the forcing file of each site.
+
+    Args:
+        sites (list): The (lat, lon, zbot) of each site.
+        start_year (int): The start year.
+        start_month (int): The start month.
+        end_year (int): The end year.
+        end_month (int): The end month.
+        outputfolder (str): The folder of the forcing files. The regional data is saved in `era5_single` inside it.
+        lapse_rate (float): The lapse rate of the forcing data. Default is 0.006.
+        max_workers (int): The maximum number of concurrent CDS requests. Default is 4.
+        client_factory (callable, optional): Return the CDS client used by a request, see `era5_download_pool`.
+        profile (str or dict): The NetCDF output profile, "default" or "compressed", see `pyclmuapp.forcing_io.forcing_encoding`. Default is "default".
+
+    Returns:
+        list: The path to the forcing file of each site, in the order of `sites`.
+    """
+    sites = [tuple(site) for site in sites]
+    if not sites:
+        raise ValueError("At least one (lat, lon, zbot) site is required.")
+    lats = np.array([site[0] for site in sites], dtype=float)
+    lons = np.array([site[1] for site in sites], dtype=float)
+    zbots = np.array([site[2] for site in sites], dtype=float)
+
+    os.makedirs(outputfolder, exist_ok=True)
+    outfiles = [os.path.join(outputfolder,
+                             f'era5_forcing_{lat}_{lon}_{zbot}_{start_year}_{start_month}_{end_year}_{end_month}.nc')
+                for lat, lon, zbot in sites]
+    partfiles = [outfile + '.part' for outfile in outfiles]
+    for partfile in set(partfiles):
+        if os.path.exists(partfile):
+            os.remove(partfile)
+
+    pool = era5_download_pool(area=era5_area(lats, lons),
+                              outputfolder=os.path.join(outputfolder, 'era5_single'),
+                              max_workers=max_workers, client_factory=client_factory)
+    months = month_range(start_year, start_month, end_year, end_month)
+    for year, month, single in pool.download(months):
+        with xr.open_dataset(single) as region:
+            cells = region.sel(latitude=xr.DataArray(lats, dims='site'),
+                               longitude=xr.DataArray(lons, dims='site'),
+                               method='nearest')
+            cells = cells.sortby('time').transpose('time', 'site').load()
+        fields = era5_forcing_kernel(
+            cells['t2m'].values, cells['d2m'].values, cells['sp'].values,
+            cells['u10'].values, cells['v10'].values,
+            cells['ssrd'].values, cells['strd'].values, cells['tp'].values,
+            fsr=cells['fsr'].values, zbot=zbots, lapse_rate=lapse_rate,
+            wind_profile="log", clip_lwdown=True)
+        written = set()
+        for i, partfile in enumerate(partfiles):
+            # the same site may be listed twice
+            if partfile in written:
+                continue
+            written.add(partfile)
+            site = forcing_dataset({var: field[:, i] for var, field in fields.items()},
+                                   cells['time'], attrs=cells.attrs)
+            append_netcdf(site, partfile, dim='time', profile=profile)
+
+    for partfile, outfile in zip(partfiles, outfiles):
+        if os.path.exists(partfile):
+            os.replace(partfile, outfile)
+    return outfiles
+
+
+ARCO_ERA5_STORE = 'gs://gcp-public-data-arco-era5/ar/full_37-1h-0p25deg-chunk-1.zarr-v3'
+
+
 def arco_era5_to_forcing(start_year, end_year, 
                 start_month, end_month,
-                lat, lon, zbot,outputfile,lapse_rate=0.006):
+                lat, lon, zbot,outputfile,lapse_rate=0.006,
+                store: Union[str, xr.Dataset] = ARCO_ERA5_STORE,
+                storage_options: dict = None,
+                block_size: int = 744,
+                profile: str = 'default'):
 
     """
     Converts ERA5 data to forcing data for a specified time period and location using a lapse rate.
 
+    The Zarr store is opened lazily and only the point is selected, so nothing is read before the conversion.
+    The period is then read, converted and appended to the output file block by block,
+    so a long period is never held in memory and the data is written only once.
+
     Args:
         start_year (int): The beginning year for the data extraction process. Specifies the starting year for the time period from which data will be extracted.
         end_year (int): Specifies the ending year for the data range you want to process. Used to indicate the last year for which the data will be processed.
@@ -114,22 +497,133 @@ def arco_era5_to_forcing(start_year, end_year,
         zbot (float): Likely refers to the bottom level of the atmosphere or the height above the surface at which the atmospheric data is being extracted. Represents the altitude or depth at which the atmospheric variables are measured or calculated.
         outputfile (str): The name of the file where the output data will be saved or written to. This file will contain the processed data based on the input parameters provided to the function.
         lapse_rate (float, optional): Represents the lapse rate used for calculating temperature at different altitudes. The lapse rate is the rate at which atmospheric temperature decreases with an increase in altitude. Defaults to 0.
+        store (str or xarray.Dataset, optional): The ARCO-ERA5 Zarr store, or an already opened dataset with the same layout.
+            Default is the public ARCO-ERA5 store on Google Cloud. A local Zarr store can be given for tests.
+        storage_options (dict, optional): The storage options of the store. Default is anonymous access for gs:// stores.
+        block_size (int, optional): The number of hours read and converted at once. Default is 744 (31 days).
+        profile (str or dict): The NetCDF output profile, "default" or "compressed", see `pyclmuapp.forcing_io.forcing_encoding`. Default is "default".
+
+    Returns:
+        str: The path to the forcing file.
     """
     
-    ar_full_37_1h = xr.open_zarr(
-                    'gs://gcp-public-data-arco-era5/ar/full_37-1h-0p25deg-chunk-1.zarr-v3',
-                    chunks=None,
-                    storage_options=dict(token='anon'),)
+    if isinstance(store, xr.Dataset):
+        ar_full_37_1h = store
+    else:
+        if storage_options is None and str(store).startswith('gs://'):
+            storage_options = dict(token='anon')
+        ar_full_37_1h = xr.open_zarr(
+                        store,
+                        chunks=None,
+                        storage_options=storage_options,)
+    # the ARCO-ERA5 longitudes are from 0 to 360
+    if float(ar_full_37_1h.longitude.max()) > 180:
+        lon = lon % 360
+    first_day = month_bounds(start_year, start_month)[0]
+    last_day = month_bounds(end_year, end_month)[1]
     single = ar_full_37_1h[variable]\
-            .sel(time=slice(f'{start_year}-{start_month}', f'{end_year}-{end_month}'))\
-            .sel(longitude=lon, latitude=lat, method='nearest')
-            
-    with tempfile.NamedTemporaryFile() as temp_file:
-        single.to_netcdf(temp_file.name)
-        single = xr.open_dataset(temp_file.name)
-        for var in era5_var_dict:
-            single = single.rename({var: era5_var_dict[var]})
-        forcing = era5_to_forcing(single, lat, lon, zbot, outputfile, lapse_rate=lapse_rate)
+            .sel(longitude=lon, latitude=lat, method='nearest')\
+            .sel(time=slice(first_day, f'{last_day}T23:59:59'))\
+            .rename(era5_var_dict)
+    
+    # the records are appended to a partial file, which replaces the output once complete
+    partfile = outputfile + '.part'
+    if os.path.exists(partfile):
+        os.remove(partfile)
+    n = single.sizes['time']
+    if n == 0:
+        raise ValueError(f"No ARCO-ERA5 data from {first_day} to {last_day}.")
+    for i0 in range(0, n, block_size):
+        # only this block is read from the store
+        block = single.isel(time=slice(i0, i0 + block_size)).load()
+        forcing = era5_forcing_dataset(block, zbot=zbot, lapse_rate=lapse_rate,
+                                       wind_profile="log", clip_lwdown=True)
+        append_netcdf(forcing, partfile, dim='time', profile=profile)
+    if os.path.exists(outputfile):
+        os.remove(outputfile)
+    os.replace(partfile, outputfile)
+    return outputfile
+
+
+def select_point(era5: xr.Dataset,
+                 lat: float, lon: float) -> xr.Dataset:
+    """
+    Select the nearest grid cell of a location. A dimension that is already a single point is kept as is.
+
+    Args:
+        era5 (xarray.Dataset): The ERA5 data.
+        lat (float): The latitude of the location.
+        lon (float): The longitude of the location.
+
+    Returns:
+        xarray.Dataset: The ERA5 data for the location.
+    """
+    if era5.latitude.values.shape:
+        
+        if era5.longitude.values.shape:
+            era5 = era5.sel(latitude=lat,longitude=lon,method='nearest')
+        else:
+            era5 = era5.sel(latitude=lat,method='nearest')
+    
+    elif era5.longitude.values.shape:
+        era5 = era5.sel(longitude=lon,method='nearest')
+    
+    return era5
+
+
+def _open_point(path: str, lat: float, lon: float) -> xr.Dataset:
+    """
+    Open one ERA5 file and read only the nearest grid cell of the location.
+    """
+    with xr.open_dataset(path) as ds:
+        if 'valid_time' in ds.dims:
+            ds = ds.rename({'valid_time': 'time'})
+        return select_point(ds, lat, lon).load()
+
+
+def open_era5_folder(folder: str,
+                     lat: float, lon: float) -> xr.Dataset:
+    """
+    Open all the ERA5 NetCDF files of a folder (and its subfolders) for one location.
+
+    The nearest grid cell is selected in each file before any data is read, so only the
+    time series of the location is loaded, never the full grid of a file.
+    With dask installed, the files are opened in parallel with `xr.open_mfdataset` and stay lazy.
+    The files are combined by their coordinates, so monthly files and files split by variable
+    (as in the CDS zips) can be mixed, and the result is ordered by time.
+
+    Args:
+        folder (str): The folder of the ERA5 NetCDF files.
+        lat (float): The latitude of the location.
+        lon (float): The longitude of the location.
+
+    Returns:
+        xarray.Dataset: The ERA5 data for the location.
+    """
+    files = sorted(os.path.join(root, file)
+                   for root, dirs, names in os.walk(folder)
+                   for file in names if file.endswith('.nc'))
+    if not files:
+        raise ValueError(f"No NetCDF file in the folder {folder}.")
+
+    try:
+        import dask
+    except ImportError:
+        dask = None
+
+    if dask is not None:
+        def preprocess(ds):
+            if 'valid_time' in ds.dims:
+                ds = ds.rename({'valid_time': 'time'})
+            return select_point(ds, lat, lon)
+        forcing = xr.open_mfdataset(files, combine='by_coords', parallel=True,
+                                    preprocess=preprocess,
+                                    data_vars='minimal', coords='minimal', compat='override')
+    else:
+        # HDF5 is not thread safe, the files are read one by one without dask
+        forcing = xr.combine_by_coords([_open_point(file, lat, lon) for file in files],
+                                       data_vars='minimal', coords='minimal', compat='override')
+    return forcing.sortby('time')
 
 
 def check_era5(era5: Union[str, xr.Dataset],
@@ -138,6 +632,7 @@ def check_era5(era5: Union[str, xr.Dataset],
     The `check_era5` function is a helper function that takes in a variable `era5`, 
     latitude `lat`, and longitude `lon`. It checks the type of the `era5` variable and based on its type, 
     it opens the dataset if it's a file path or uses it directly if it's already an xarray Dataset.
+    A folder is opened with `open_era5_folder`.
 
     Args:
         era5 (Union[str, xr.Dataset]): The ERA5 data.
@@ -149,33 +644,21 @@ def check_era5(era5: Union[str, xr.Dataset],
     """
     if isinstance(era5, str):
         if os.path.isfile(era5):
-            forcing = xr.open_dataset(era5)
+            # only the point is read, and the file is closed
+            return _open_point(era5, lat, lon)
             
         elif os.path.isdir(era5):
-            for root, dirs, files in os.walk(era5):
-                for file in files:
-                    forcing_ls = []
-                    if file.endswith(".nc"):
-                        _forcing = xr.open_dataset(os.path.join(root, file))
-                        forcing_ls.append(_forcing)
-            forcing = xr.concat(forcing_ls, dim='time').sortby('time')
+            return open_era5_folder(era5, lat, lon)
+        
+        else:
+            raise ValueError(f"The file or folder {era5} does not exist.")
     
     elif isinstance(era5, xr.Dataset):
         forcing = era5
     else:
         raise ValueError("The era5 should be a xarray dataset or a file path.")
     
-    if forcing.latitude.values.shape:
-        
-        if forcing.longitude.values.shape:
-            forcing = forcing.sel(latitude=lat,longitude=lon,method='nearest')
-        else:
-            forcing = forcing.sel(latitude=lat,method='nearest')
-    
-    elif forcing.longitude.values.shape:
-        forcing = forcing.sel(longitude=lon,method='nearest')
-    
-    return forcing
+    return select_point(forcing, lat, lon)
 
 
 def era5_to_forcing(
@@ -205,127 +688,8 @@ def era5_to_forcing(
     # Check the type of the input data
     single = check_era5(single, lat, lon)
     
-    #-------------------Constants-------------------
-    SHR_CONST_BOLTZ   = 1.38065e-23  # Boltzmann's constant ~ J/K/molecule
-    SHR_CONST_AVOGAD  = 6.02214e26   # Avogadro's number ~ molecules/kmole
-    SHR_CONST_RGAS    = SHR_CONST_AVOGAD*SHR_CONST_BOLTZ       # Universal gas constant ~ J/K/kmole
-    SHR_CONST_MWDAIR  = 28.966       # molecular weight dry air ~ kg/kmole
-    SHR_CONST_MWWV    = 18.016       # molecular weight water vapor
-    SHR_CONST_RDAIR   = SHR_CONST_RGAS/SHR_CONST_MWDAIR        # Dry air gas constant     ~ J/K/kg
-    SHR_CONST_G       = 9.80616      # acceleration of gravity ~ m/s^2
-
-    rair              = SHR_CONST_RDAIR
-    grav              = SHR_CONST_G
-    # Pritchard et al. (GRL, 35, 2008) use 0.006
-    #lapse_rate = 0.006 # https://github.com/ESCOMP/CTSM/blob/a9433779f0ae499d60ad118d2ec331628f0eaaa8/bld/namelist_files/namelist_defaults_ctsm.xml#L197
-    
-    
-    # costants for saturation vapor pressure for Qair
-    a0 =  6.11213476
-    a1 =  0.444007856
-    a2 =  0.143064234e-01
-    a3 =  0.264461437e-03
-    a4 =  0.305903558e-05
-    a5 =  0.196237241e-07
-    a6 =  0.892344772e-10
-    a7 = -0.373208410e-12
-    a8 =  0.209339997e-15
-
-    c0 =  6.11123516
-    c1 =  0.503109514
-    c2 =  0.188369801e-01
-    c3 =  0.420547422e-03
-    c4 =  0.614396778e-05
-    c5 =  0.602780717e-07
-    c6 =  0.387940929e-09
-    c7 =  0.149436277e-11
-    c8 =  0.262655803e-14
-    # -------------------Constants-------------------
-    
-    #tbot_c = tbot_g-lapse_rate*(hsurf_c-hsurf_g)
-    #Hbot  = rair*0.5*(tbot_g+tbot_c)/grav
-    #pbot_c = pbot_g*np.exp(-(hsurf_c-hsurf_g)/Hbot)
-    
-    single['Tair'] = single['t2m']/1.0
-    single['Tair'] = single['Tair'] - lapse_rate * (zbot - 2.0)
-    single['Tair'].attrs['units'] = 'K'
-    single['Tair'].attrs['long_name'] = 'Air temperature'
-    
-    Hbot = rair * single['Tair'] / grav
-    single['PSurf'] = single['sp']/1.0
-    single['PSurf'] = single['PSurf'] * np.exp(-(zbot - 2.0) / Hbot)
-    single['PSurf'].attrs['units'] = 'Pa'
-    single['PSurf'].attrs['long_name'] = 'Surface pressure at 950 hPa'
-
-    single['Wind'] = (single['u10']**2 + single['v10']**2)**0.5
-    # ref: https://doi.org/10.5194/essd-14-5157-2022
-    single['Wind'] = single['Wind'] * (np.log(zbot / single['fsr']) / np.log(10 / single['fsr']))
-    #single['Wind'] = single['Wind'] * (xr.ufuncs.log(2 / single['fsr']) / xr.ufuncs.log(10 / single['fsr']))
-    single['Wind'] = single['Wind'].assign_attrs(units='m/s')
-    single['Wind'] = single['Wind'].assign_attrs(long_name='Wind speed')
-
-    # ref1: https://github.com/ESCOMP/CTSM/blob/75b34d2d8770461e3e28cee973a39f1737de091d/doc/source/tech_note/Land-Only_Mode/CLM50_Tech_Note_Land-Only_Mode.rst#L113
-    # ref2: https://journals.ametsoc.org/view/journals/apme/57/6/jamc-d-17-0334.1.xml
-    # ref3: https://github.com/ESCOMP/CTSM/blob/75b34d2d8770461e3e28cee973a39f1737de091d/src/biogeophys/QSatMod.F90
-    # Reference:  Polynomial approximations from:
-    #             Piotr J. Flatau, et al.,1992:  Polynomial fits to saturation
-    #             vapor pressure.  Journal of Applied Meteorology, 31, 1507-1513.
-    lapse_rate_dew = 1.8/1000 # ref: https://commons.erau.edu/cgi/viewcontent.cgi?article=1374&context=ijaaa
-    # DPLR of moist air at temperature of 20oC (293 K) and dew point of 12oC(285 K) has RH of approximately 60%. 
-    # DP-depression D is 8oC (8 K). Using Eq. (38), whileneglecting specific humidity contribution, 
-    # DPLR yields about 0.546 K/1,000 ft (1.8 K/km). Thisis valid result as measured DPLRs are normally in the range 1.6-2.0 K/km or 0.50 to 0.6 K/1,000ft.
-    # for simple, we use lapse_rate_dew = 1.8/1000, which is the middle of the range.
-    # also: Pilot’s Handbook of Aeronautical Knowledge : "When lifted, ... the dew point temperature decreases at a rate of 1 °F per 1,000 feet."
-    # ~ 0.555556 K/1000 ft or 1.8 K/km.
-    # ref: https://www.faa.gov/sites/faa.gov/files/14_phak_ch12.pdf
-    # pdf is in src/CLMU_literatures/14_phak_ch12.pdf
-    single['d2m'] = single['d2m'] - 273.15 - lapse_rate_dew * (zbot - 2.0)
-    # es_water
-    single['es_water'] = a0 + single['d2m']*(a1 + single['d2m']*(a2 + single['d2m']*(a3 + single['d2m']*(a4 
-            + single['d2m']*(a5 + single['d2m']*(a6 + single['d2m']*(a7 + single['d2m']*a8)))))))
-    single['es_water'] = single['es_water'] * 100
-    # es_ice
-    single['es_ice'] = c0 + single['d2m']*(c1 + single['d2m']*(c2 + single['d2m']*(c3 + single['d2m']*(c4 
-            + single['d2m']*(c5 + single['d2m']*(c6 + single['d2m']*(c7 + single['d2m']*c8)))))))
-    single['es_ice'] = single['es_ice'] * 100   
-    # es 
-    single['es'] = xr.where(single['d2m'] >= 0, single['es_water'],single['es_ice'])
-    # Qair
-    single['Qair'] = 0.622 * single['es'] / (single['PSurf'] - (1 - 0.622) * single['es'])
-    single['Qair'] = single['Qair'].where(single['Qair'] > 0, 1e-16)
-    single['Qair'].attrs['units'] = 'kg/kg'
-    single['Qair'].attrs['long_name'] = 'Specific humidity'
-    
-    single['Zbot'] = single['sp'] /1.0
-    single['Zbot'].values = np.ones(single['Zbot'].shape) * zbot
-    single['Zbot'].attrs['units'] = 'm'
-    single['Zbot'].attrs['long_name'] = 'Geopotential height'
-    
-    single['SWdown'] = single['ssrd']/ 3600 
-    single['SWdown'] = single['SWdown'].where(single['SWdown'] > 0, 1e-16)
-    single['SWdown'].attrs['units'] = 'W/m^2'
-    single['SWdown'].attrs['long_name'] = 'Surface solar radiation downwards'
-    single['LWdown'] = single['strd']/ 3600 
-    single['LWdown'] = single['LWdown'].where(single['LWdown'] > 0, 1e-16)
-    single['LWdown'].attrs['units'] = 'W/m^2'
-    single['LWdown'].attrs['long_name'] = 'Surface thermal radiation downwards'
-    
-    single['Prectmms'] = single['tp'] * 1000 / 3600
-    single['Prectmms'] = single['Prectmms'].where(single['Prectmms'] > 0, 1e-16)
-    single['Prectmms'].attrs['units'] = 'mm/s'
-    single['Prectmms'].attrs['long_name'] = 'Total precipitation'
-    for var in ['PSurf', 'Qair', 'Wind', 'Tair', 'Zbot', 'SWdown', 'LWdown', 'Prectmms']:
-        single[var] = single[var].assign_attrs(_FillValue=1.e36)
-    single['x'] = 1
-    single['y'] = 1
-    single = single.assign_coords(x=1,y=1)
-    for var in single.data_vars:
-        single[var] = single[var].expand_dims('x',axis=1).expand_dims('y',axis=1)
-        
-    del single['latitude'], single['longitude'], single['d2m'], \
-        single['sp'], single['ssrd'], single['strd'], single['tp'], \
-        single['u10'], single['v10'], single['fsr'], \
-        single['t2m'], single['es_water'], single['es_ice'], single['es']
+    single = era5_forcing_dataset(single, zbot=zbot, lapse_rate=lapse_rate,
+                                  wind_profile="log", clip_lwdown=True)
     
     #single.to_netcdf(outputfile)
     return single
\ No newline at end of file
@@ -4,13 +4,18 @@ try:
 except ImportError:
     raise ImportError("The 'ee' module is required. Please install the Earth Engine Python API with 'pip install earthengine-api'.")
 
-import pandas as pd
 import xarray as xr
 import numpy as np
 from typing import Union    
 import datetime
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from pyclmuapp.forcing_kernel import era5_forcing_dataset
+from pyclmuapp.forcing_io import write_forcing
+from pyclmuapp.era5_forcing import retry_call
 
 def get_era5_ee(ee, lat, lon, start_YY_MM, end_YY_MM):
     
@@ -63,13 +68,16 @@ def get_era5_ee(ee, lat, lon, start_YY_MM, end_YY_MM):
     
     time_series = dataset.getRegion(point, 1000).getInfo()
 
+    # the response is a header row and one row per image, it is read column by column
     headers = time_series[0]
-    data = time_series[1:]
-    df = pd.DataFrame(data, columns=headers).rename(columns=era5_var_dict).drop(columns=['id'])
-    df['time'] = pd.to_datetime(df['time'], unit='ms')
-    df = df.set_index('time')
-    df = df.sort_index()
-    ds = df.to_xarray()
+    columns = dict(zip(headers, zip(*time_series[1:]))) if len(time_series) > 1 \
+        else {name: () for name in headers}
+    times = np.asarray(columns.pop('time'), dtype='int64').astype('datetime64[ms]').astype('datetime64[ns]')
+    columns.pop('id')
+    order = np.argsort(times, kind='stable')
+    data_vars = {era5_var_dict.get(name, name): ('time', np.asarray(values, dtype=float)[order])
+                 for name, values in columns.items()}
+    ds = xr.Dataset(data_vars, coords={'time': times[order]})
     return ds
 
 def era5_to_forcing(
@@ -93,129 +101,9 @@ def era5_to_forcing(
     Returns:
         xarray.Dataset: The forcing data.
     """
-
-    
-    #-------------------Constants-------------------
-    SHR_CONST_BOLTZ   = 1.38065e-23  # Boltzmann's constant ~ J/K/molecule
-    SHR_CONST_AVOGAD  = 6.02214e26   # Avogadro's number ~ molecules/kmole
-    SHR_CONST_RGAS    = SHR_CONST_AVOGAD*SHR_CONST_BOLTZ       # Universal gas constant ~ J/K/kmole
-    SHR_CONST_MWDAIR  = 28.966       # molecular weight dry air ~ kg/kmole
-    SHR_CONST_MWWV    = 18.016       # molecular weight water vapor
-    SHR_CONST_RDAIR   = SHR_CONST_RGAS/SHR_CONST_MWDAIR        # Dry air gas constant     ~ J/K/kg
-    SHR_CONST_G       = 9.80616      # acceleration of gravity ~ m/s^2
-
-    rair              = SHR_CONST_RDAIR
-    grav              = SHR_CONST_G
-    # Pritchard et al. (GRL, 35, 2008) use 0.006
-    #lapse_rate = 0.006 # https://github.com/ESCOMP/CTSM/blob/a9433779f0ae499d60ad118d2ec331628f0eaaa8/bld/namelist_files/namelist_defaults_ctsm.xml#L197
-    
-    
-    # costants for saturation vapor pressure for Qair
-    a0 =  6.11213476
-    a1 =  0.444007856
-    a2 =  0.143064234e-01
-    a3 =  0.264461437e-03
-    a4 =  0.305903558e-05
-    a5 =  0.196237241e-07
-    a6 =  0.892344772e-10
-    a7 = -0.373208410e-12
-    a8 =  0.209339997e-15
-
-    c0 =  6.11123516
-    c1 =  0.503109514
-    c2 =  0.188369801e-01
-    c3 =  0.420547422e-03
-    c4 =  0.614396778e-05
-    c5 =  0.602780717e-07
-    c6 =  0.387940929e-09
-    c7 =  0.149436277e-11
-    c8 =  0.262655803e-14
-    # -------------------Constants-------------------
-    
-    #tbot_c = tbot_g-lapse_rate*(hsurf_c-hsurf_g)
-    #Hbot  = rair*0.5*(tbot_g+tbot_c)/grav
-    #pbot_c = pbot_g*np.exp(-(hsurf_c-hsurf_g)/Hbot)
-    
-    single['Tair'] = single['t2m']/1.0
-    single['Tair'] = single['Tair'] - lapse_rate * (zbot - 2.0)
-    single['Tair'].attrs['units'] = 'K'
-    single['Tair'].attrs['long_name'] = 'Air temperature'
-    
-    Hbot = rair * single['Tair'] / grav
-    single['PSurf'] = single['sp']/1.0
-    single['PSurf'] = single['PSurf'] * np.exp(-(zbot - 2.0) / Hbot)
-    single['PSurf'].attrs['units'] = 'Pa'
-    single['PSurf'].attrs['long_name'] = 'Surface pressure at 950 hPa'
-
-    single['Wind'] = (single['u10']**2 + single['v10']**2)**0.5
-    # ref: https://doi.org/10.5194/essd-14-5157-2022
-    single['Wind'] = single['Wind'] * (np.log(zbot / single['fsr']) / np.log(10 / single['fsr']))
-    #single['Wind'] = single['Wind'] * (xr.ufuncs.log(2 / single['fsr']) / xr.ufuncs.log(10 / single['fsr']))
-    single['Wind'] = single['Wind'].assign_attrs(units='m/s')
-    single['Wind'] = single['Wind'].assign_attrs(long_name='Wind speed')
-
-    # ref1: https://github.com/ESCOMP/CTSM/blob/75b34d2d8770461e3e28cee973a39f1737de091d/doc/source/tech_note/Land-Only_Mode/CLM50_Tech_Note_Land-Only_Mode.rst#L113
-    # ref2: https://journals.ametsoc.org/view/journals/apme/57/6/jamc-d-17-0334.1.xml
-    # ref3: https://github.com/ESCOMP/CTSM/blob/75b34d2d8770461e3e28cee973a39f1737de091d/src/biogeophys/QSatMod.F90
-    # Reference:  Polynomial approximations from:
-    #             Piotr J. Flatau, et al.,1992:  Polynomial fits to saturation
-    #             vapor pressure.  Journal of Applied Meteorology, 31, 1507-1513.
-    lapse_rate_dew = 1.8/1000 # ref: https://commons.erau.edu/cgi/viewcontent.cgi?article=1374&context=ijaaa
-    # DPLR of moist air at temperature of 20oC (293 K) and dew point of 12oC(285 K) has RH of approximately 60%. 
-    # DP-depression D is 8oC (8 K). Using Eq. (38), whileneglecting specific humidity contribution, 
-    # DPLR yields about 0.546 K/1,000 ft (1.8 K/km). Thisis valid result as measured DPLRs are normally in the range 1.6-2.0 K/km or 0.50 to 0.6 K/1,000ft.
-    # for simple, we use lapse_rate_dew = 1.8/1000, which is the middle of the range.
-    # also: Pilot’s Handbook of Aeronautical Knowledge : "When lifted, ... the dew point temperature decreases at a rate of 1 °F per 1,000 feet."
-    # ~ 0.555556 K/1000 ft or 1.8 K/km.
-    # ref: https://www.faa.gov/sites/faa.gov/files/14_phak_ch12.pdf
-    # pdf is in src/CLMU_literatures/14_phak_ch12.pdf
-    single['d2m'] = single['d2m'] - 273.15 - lapse_rate_dew * (zbot - 2.0)
-    # es_water
-    single['es_water'] = a0 + single['d2m']*(a1 + single['d2m']*(a2 + single['d2m']*(a3 + single['d2m']*(a4 
-            + single['d2m']*(a5 + single['d2m']*(a6 + single['d2m']*(a7 + single['d2m']*a8)))))))
-    single['es_water'] = single['es_water'] * 100
-    # es_ice
-    single['es_ice'] = c0 + single['d2m']*(c1 + single['d2m']*(c2 + single['d2m']*(c3 + single['d2m']*(c4 
-            + single['d2m']*(c5 + single['d2m']*(c6 + single['d2m']*(c7 + single['d2m']*c8)))))))
-    single['es_ice'] = single['es_ice'] * 100   
-    # es 
-    single['es'] = xr.where(single['d2m'] >= 0, single['es_water'],single['es_ice'])
-    # Qair
-    single['Qair'] = 0.622 * single['es'] / (single['PSurf'] - (1 - 0.622) * single['es'])
-    single['Qair'] = single['Qair'].where(single['Qair'] > 0, 1e-16)
-    single['Qair'].attrs['units'] = 'kg/kg'
-    single['Qair'].attrs['long_name'] = 'Specific humidity'
-    
-    single['Zbot'] = single['sp'] /1.0
-    single['Zbot'].values = np.ones(single['Zbot'].shape) * zbot
-    single['Zbot'].attrs['units'] = 'm'
-    single['Zbot'].attrs['long_name'] = 'Geopotential height'
     
-    single['SWdown'] = single['ssrd']/ 3600 
-    single['SWdown'] = single['SWdown'].where(single['SWdown'] > 0, 1e-16)
-    single['SWdown'].attrs['units'] = 'W/m^2'
-    single['SWdown'].attrs['long_name'] = 'Surface solar radiation downwards'
-    single['LWdown'] = single['strd']/ 3600 
-    single['LWdown'] = single['LWdown'].where(single['LWdown'] > 0, 1e-16)
-    single['LWdown'].attrs['units'] = 'W/m^2'
-    single['LWdown'].attrs['long_name'] = 'Surface thermal radiation downwards'
-    
-    single['Prectmms'] = single['tp'] * 1000 / 3600
-    single['Prectmms'] = single['Prectmms'].where(single['Prectmms'] > 0, 1e-16)
-    single['Prectmms'].attrs['units'] = 'mm/s'
-    single['Prectmms'].attrs['long_name'] = 'Total precipitation'
-    for var in ['PSurf', 'Qair', 'Wind', 'Tair', 'Zbot', 'SWdown', 'LWdown', 'Prectmms']:
-        single[var] = single[var].assign_attrs(_FillValue=1.e36)
-    single['x'] = 1
-    single['y'] = 1
-    single = single.assign_coords(x=1,y=1)
-    for var in single.data_vars:
-        single[var] = single[var].expand_dims('x',axis=1).expand_dims('y',axis=1)
-        
-    del single['latitude'], single['longitude'], single['d2m'], \
-        single['sp'], single['ssrd'], single['strd'], single['tp'], \
-        single['u10'], single['v10'], single['fsr'], \
-        single['t2m'], single['es_water'], single['es_ice'], single['es']
+    single = era5_forcing_dataset(single, zbot=zbot, lapse_rate=lapse_rate,
+                                  wind_profile="log", clip_lwdown=True)
     
     #single.to_netcdf(outputfile)
     return single
@@ -239,24 +127,82 @@ def month_chunks(start_date: str, end_date: str):
         cur = nxt
     return chunks
 
-def gee_era5s_to_forcing(ee, lat, lon, start_date, end_date, zbot=30, outputfile='./forcing.nc'):
+class rate_limiter:
+
+    """
+    Space out the calls of several threads to at most `rate` calls per second.
+
+    Args:
+        rate (float): The maximum number of calls per second. None or 0 for no limit.
+    """
+
+    def __init__(self, rate: float = None):
+        self.interval = 1.0 / rate if rate else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the next call is allowed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def gee_era5s_to_forcing(ee, lat, lon, start_date, end_date, zbot=30, outputfile='./forcing.nc', lapse_rate=0.006,
+                         max_workers=8, max_rate=5, profile='default', retries=3, backoff=10):
+    """
+    Get the ERA5 data of a location from Google Earth Engine and convert it to forcing data.
+
+    The period is fetched month by month, with the months requested concurrently.
+    A failed request of a month is retried with an exponential backoff, see `pyclmuapp.era5_forcing.retry_call`.
+
+    Args:
+        ee (module): The Google Earth Engine module.
+        lat (float): The latitude of the location.
+        lon (float): The longitude of the location.
+        start_date (str): The start date in 'YYYY-MM-DD' format.
+        end_date (str): The end date (excluded) in 'YYYY-MM-DD' format.
+        zbot (int, float): The bottom level of the forcing data.
+        outputfile (str): The path to save the forcing data.
+        lapse_rate (int, float): The lapse rate of the forcing data. Default is 0.006.
+        max_workers (int): The maximum number of concurrent Earth Engine requests. Default is 8.
+        max_rate (float): The maximum number of requests started per second. Default is 5.
+        profile (str or dict): The NetCDF output profile, "default" or "compressed", see `pyclmuapp.forcing_io.forcing_encoding`. Default is "default".
+        retries (int): The number of retries of a failed request. Default is 3.
+        backoff (float): The wait in seconds before the first retry, doubled at each retry. Default is 10.
+
+    Returns:
+        xarray.Dataset: The forcing data.
+    """
 
     print(f'Get ERA5 data from {start_date} to {end_date} for ({lat}, {lon})')
 
-    chunks = month_chunks(start_date, end_date)
-    
-    datasets = []
-    for s, e in chunks:
-        if s != e:
-            print(f'  - {s} ~ {e}')
-            ds = get_era5_ee(ee, lat, lon, s, e)
-            datasets.append(ds)
+    chunks = [(s, e) for s, e in month_chunks(start_date, end_date) if s != e]
+    limiter = rate_limiter(max_rate)
+
+    def request(chunk):
+        # a retry waits for its turn too, so the retries keep to max_rate
+        limiter.wait()
+        return get_era5_ee(ee, lat, lon, *chunk)
+
+    def fetch(chunk):
+        print(f'  - {chunk[0]} ~ {chunk[1]}')
+        return retry_call(lambda: request(chunk), retries=retries, backoff=backoff,
+                          label=f'request of {chunk[0]} ~ {chunk[1]}')
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        datasets = list(pool.map(fetch, chunks))
     ds_all = xr.concat(datasets, dim='time')
     ds_all = ds_all.sortby('time')
-    ds_forcing = era5_to_forcing(ds_all, zbot=zbot)
+    ds_forcing = era5_to_forcing(ds_all, zbot=zbot, lapse_rate=lapse_rate)
     if os.path.exists(outputfile):
         os.remove(outputfile)
-    ds_forcing.to_netcdf(outputfile)
+    write_forcing(ds_forcing, outputfile, profile)
     return ds_forcing
 
 if __name__ == '__main__':
@@ -2,10 +2,23 @@ import cdsapi
 import xarray as xr
 import numpy as np
 from typing import Union
-import zipfile
 import re
 from datetime import datetime
 import os
+from pyclmuapp.forcing_kernel import era5_forcing_dataset
+from pyclmuapp.cache import get_cache
+from pyclmuapp.forcing_io import open_zip_netcdf, forcing_encoding
+
+land_variable = [
+            "2m_dewpoint_temperature",
+            "2m_temperature",
+            "surface_pressure",
+            "total_precipitation",
+            "surface_solar_radiation_downwards",
+            "surface_thermal_radiation_downwards",
+            "10m_v_component_of_wind",
+            "10m_u_component_of_wind",
+        ]
 
 
 def download_era5_land_data(lat: float, lon: float, start_date: str, end_date: str, output_file: str = None):
@@ -34,16 +47,7 @@ def download_era5_land_data(lat: float, lon: float, start_date: str, end_date: s
         raise ValueError("Start date and end date must be provided.")
     
     request = {
-        "variable": [
-            "2m_dewpoint_temperature",
-            "2m_temperature",
-            "surface_pressure",
-            "total_precipitation",
-            "surface_solar_radiation_downwards",
-            "surface_thermal_radiation_downwards",
-            "10m_v_component_of_wind",
-            "10m_u_component_of_wind",
-        ],
+        "variable": land_variable,
         "location": {"longitude": lon, "latitude": lat},
         "date": [f"{start_date}/{end_date}"],
         "data_format": "netcdf"
@@ -55,25 +59,23 @@ def download_era5_land_data(lat: float, lon: float, start_date: str, end_date: s
     return output_file
 
 def get_nc_from_zip(zip_path):
-    with zipfile.ZipFile(zip_path, 'r') as z:
-        # 获取压缩包内的第一个文件名
-        file_name = z.namelist()
-        # 打开并读取 CSV 文件
-        xr_ls = []
-        for name in file_name:
-            if name.endswith('.nc'):
-                _xr = xr.open_dataset(z.open(name))
-                xr_ls.append(_xr)
-        # 合并所有的 xarray 数据集
-        if xr_ls:
-            ds = xr.merge(xr_ls)
-    return ds
+    """
+    Read the ERA5-Land data of a downloaded zip, see `pyclmuapp.forcing_io.open_zip_netcdf`.
+
+    Args:
+        zip_path (str): The path to the downloaded zip.
+
+    Returns:
+        xarray.Dataset: The merged dataset of the NetCDF files in the zip.
+    """
+    return open_zip_netcdf(zip_path)
 
 def era5s_to_forcing(
                     single: Union[str, xr.Dataset], 
                     zbot: int = 30,
                     outputfile: str = './forcing.nc',
-                    lapse_rate: int = 0.006
+                    lapse_rate: int = 0.006,
+                    profile: str = 'default'
                     ):
     
     """
@@ -87,152 +89,31 @@ def era5s_to_forcing(
         zbot (int, float): The bottom level of the forcing data.
         outputfile (str): The path to save the forcing data.
         lapse_rate (int, float): The lapse rate of the forcing data. default is 0.006, from Pritchard et al. (GRL, 35, 2008) of CTSM 
+        profile (str or dict): The NetCDF output profile, "default" or "compressed", see `pyclmuapp.forcing_io.forcing_encoding`. Default is "default".
 
     Returns:
         xarray.Dataset: The forcing data.
     """
     
-    #-------------------Constants-------------------
-    SHR_CONST_BOLTZ   = 1.38065e-23  # Boltzmann's constant ~ J/K/molecule
-    SHR_CONST_AVOGAD  = 6.02214e26   # Avogadro's number ~ molecules/kmole
-    SHR_CONST_RGAS    = SHR_CONST_AVOGAD*SHR_CONST_BOLTZ       # Universal gas constant ~ J/K/kmole
-    SHR_CONST_MWDAIR  = 28.966       # molecular weight dry air ~ kg/kmole
-    SHR_CONST_MWWV    = 18.016       # molecular weight water vapor
-    SHR_CONST_RDAIR   = SHR_CONST_RGAS/SHR_CONST_MWDAIR        # Dry air gas constant     ~ J/K/kg
-    SHR_CONST_G       = 9.80616      # acceleration of gravity ~ m/s^2
-
-    rair              = SHR_CONST_RDAIR
-    grav              = SHR_CONST_G
-    # Pritchard et al. (GRL, 35, 2008) use 0.006
-    #lapse_rate = 0.006 # https://github.com/ESCOMP/CTSM/blob/a9433779f0ae499d60ad118d2ec331628f0eaaa8/bld/namelist_files/namelist_defaults_ctsm.xml#L197
-    
-    
-    # costants for saturation vapor pressure for Qair
-    a0 =  6.11213476
-    a1 =  0.444007856
-    a2 =  0.143064234e-01
-    a3 =  0.264461437e-03
-    a4 =  0.305903558e-05
-    a5 =  0.196237241e-07
-    a6 =  0.892344772e-10
-    a7 = -0.373208410e-12
-    a8 =  0.209339997e-15
-
-    c0 =  6.11123516
-    c1 =  0.503109514
-    c2 =  0.188369801e-01
-    c3 =  0.420547422e-03
-    c4 =  0.614396778e-05
-    c5 =  0.602780717e-07
-    c6 =  0.387940929e-09
-    c7 =  0.149436277e-11
-    c8 =  0.262655803e-14
-    # -------------------Constants-------------------
-    
-    #tbot_c = tbot_g-lapse_rate*(hsurf_c-hsurf_g)
-    #Hbot  = rair*0.5*(tbot_g+tbot_c)/grav
-    #pbot_c = pbot_g*np.exp(-(hsurf_c-hsurf_g)/Hbot)
-    
     if isinstance(single, str):
-        single = xr.open_dataset(single)
+        with xr.open_dataset(single) as ds:
+            single = ds.load()
         
     single = single.rename({'valid_time': 'time'})
-    single['Tair'] = single['t2m']/1.0
-    single['Tair'] = single['Tair'] - lapse_rate * (zbot - 2.0)
-    single['Tair'].attrs['units'] = 'K'
-    single['Tair'].attrs['long_name'] = 'Air temperature'
-    
-    Hbot = rair * single['Tair'] / grav
-    single['PSurf'] = single['sp']/1.0
-    single['PSurf'] = single['PSurf'] * np.exp(-(zbot - 2.0) / Hbot)
-    single['PSurf'].attrs['units'] = 'Pa'
-    single['PSurf'].attrs['long_name'] = 'Surface pressure at 950 hPa'
-
-    single['Wind'] = (single['u10']**2 + single['v10']**2)**0.5
+    # ERA5-Land has no forecast surface roughness, the wind is moved to zbot with the 1/7 power law
     # ref: https://www.bilibili.com/opus/963995230578671683
     # ref: https://www.calculatoratoz.com/en/wind-speed-at-standard-10-m-reference-level-calculator/Calc-23764
     # ref: https://baike.baidu.com/item/%E9%A3%8E%E5%88%87%E5%8F%98%E6%8C%87%E6%95%B0/5192431
-    single['Wind'] = single['Wind'] * (zbot / 10.0)**(1/7)  # Convert to wind
-    #single['Wind'] = single['Wind'] * (xr.ufuncs.log(2 / single['fsr']) / xr.ufuncs.log(10 / single['fsr']))
-    single['Wind'] = single['Wind'].assign_attrs(units='m/s')
-    single['Wind'] = single['Wind'].assign_attrs(long_name='Wind speed')
-
-    # ref1: https://github.com/ESCOMP/CTSM/blob/75b34d2d8770461e3e28cee973a39f1737de091d/doc/source/tech_note/Land-Only_Mode/CLM50_Tech_Note_Land-Only_Mode.rst#L113
-    # ref2: https://journals.ametsoc.org/view/journals/apme/57/6/jamc-d-17-0334.1.xml
-    # ref3: https://github.com/ESCOMP/CTSM/blob/75b34d2d8770461e3e28cee973a39f1737de091d/src/biogeophys/QSatMod.F90
-    # Reference:  Polynomial approximations from:
-    #             Piotr J. Flatau, et al.,1992:  Polynomial fits to saturation
-    #             vapor pressure.  Journal of Applied Meteorology, 31, 1507-1513.
-    lapse_rate_dew = 1.8/1000 # ref: https://commons.erau.edu/cgi/viewcontent.cgi?article=1374&context=ijaaa
-    # DPLR of moist air at temperature of 20oC (293 K) and dew point of 12oC(285 K) has RH of approximately 60%. 
-    # DP-depression D is 8oC (8 K). Using Eq. (38), whileneglecting specific humidity contribution, 
-    # DPLR yields about 0.546 K/1,000 ft (1.8 K/km). Thisis valid result as measured DPLRs are normally in the range 1.6-2.0 K/km or 0.50 to 0.6 K/1,000ft.
-    # for simple, we use lapse_rate_dew = 1.8/1000, which is the middle of the range.
-    # pdf is in src/CLMU_literatures/On Atmospheric Lapse Rates.pdf
-    # also: Pilot’s Handbook of Aeronautical Knowledge : "When lifted, ... the dew point temperature decreases at a rate of 1 °F per 1,000 feet."
-    # ~ 0.555556 K/1000 ft or 1.8 K/km.
-    # ref: https://www.faa.gov/sites/faa.gov/files/14_phak_ch12.pdf
-    # pdf is in src/CLMU_literatures/14_phak_ch12.pdf
-    single['d2m'] = single['d2m'] - 273.15 - lapse_rate_dew * (zbot - 2.0)
-    # es_water
-    single['es_water'] = a0 + single['d2m']*(a1 + single['d2m']*(a2 + single['d2m']*(a3 + single['d2m']*(a4 
-            + single['d2m']*(a5 + single['d2m']*(a6 + single['d2m']*(a7 + single['d2m']*a8)))))))
-    single['es_water'] = single['es_water'] * 100
-    # es_ice
-    single['es_ice'] = c0 + single['d2m']*(c1 + single['d2m']*(c2 + single['d2m']*(c3 + single['d2m']*(c4 
-            + single['d2m']*(c5 + single['d2m']*(c6 + single['d2m']*(c7 + single['d2m']*c8)))))))
-    single['es_ice'] = single['es_ice'] * 100   
-    # es 
-    single['es'] = xr.where(single['d2m'] >= 0, single['es_water'],single['es_ice'])
-    # Qair
-    single['Qair'] = 0.622 * single['es'] / (single['PSurf'] - (1 - 0.622) * single['es'])
-    single['Qair'] = single['Qair'].where(single['Qair'] > 0, 1e-16)
-    single['Qair'].attrs['units'] = 'kg/kg'
-    single['Qair'].attrs['long_name'] = 'Specific humidity'
-    
-    
-    single['Zbot'] = single['sp'] /1.0
-    single['Zbot'].values = np.ones(single['Zbot'].shape) * zbot
-    single['Zbot'].attrs['units'] = 'm'
-    single['Zbot'].attrs['long_name'] = 'Geopotential height'
-    
-    single['SWdown'] = single['ssrd']/ 3600 
-    single['SWdown'] = single['SWdown'].where(single['SWdown'] > 0, 1e-16)
-    single['SWdown'].attrs['units'] = 'W/m^2'
-    single['SWdown'].attrs['long_name'] = 'Surface solar radiation downwards'
-    
-    # es == ea in this case, as we calculate the es using d2m
-    #single['eair'] = 1.24 * (single['es']/100 / single['t2m']) ** (1/7) # ref: W Brutsaert - Water resources research, 1975
-    single['eair'] = 0.70 + 5.95e-5 * (0.01 * single['es']) * np.exp(1500.0 / single['t2m'])  # eIdso, S.B. 1981. A set of equations for ...
-    # from https://escomp.github.io/CTSM/tech_note/References/CLM50_Tech_Note_References.html
-    #single['LWdown'] = single['eair'] * (single['t2m'] ** 4) * 5.67e-8 # ref : W Brutsaert - Water resources research, 1975
-    #
-    #single['LWdown'] = single['LWdown'].where(single['LWdown'] > 0, 1e-16)
-    single['LWdown'] = single['strd']/ 3600 
-    single['LWdown'].attrs['units'] = 'W/m^2'
-    single['LWdown'].attrs['long_name'] = 'Surface thermal radiation downwards'
-    
-    single['Prectmms'] = single['tp'] * 1000 / 3600
-    single['Prectmms'] = single['Prectmms'].where(single['Prectmms'] > 0, 1e-16)
-    single['Prectmms'].attrs['units'] = 'mm/s'
-    single['Prectmms'].attrs['long_name'] = 'Total precipitation'
-    for var in ['PSurf', 'Qair', 'Wind', 'Tair', 'Zbot', 'SWdown', 'LWdown', 'Prectmms']:
-        single[var] = single[var].assign_attrs(_FillValue=1.e36)
-    single['x'] = 1
-    single['y'] = 1
-    single = single.assign_coords(x=1,y=1)
-    for var in single.data_vars:
-        single[var] = single[var].expand_dims('x',axis=1).expand_dims('y',axis=1)
-        
-    del single['latitude'], single['longitude'], single['d2m'], \
-        single['sp'], single['ssrd'], single['tp'], \
-        single['u10'], single['v10'], \
-        single['t2m'], single['es_water'], single['es_ice'], single['es'], single['eair']
+    single = era5_forcing_dataset(single, zbot=zbot, lapse_rate=lapse_rate,
+                                  wind_profile="power", clip_lwdown=False)
     
+    # a bad profile raises here, before any write
+    encoding = forcing_encoding(single, profile)
     try:
-        single.to_netcdf(outputfile)
-    except Exception as e:
-        single.to_netcdf(outputfile, format='h5netcdf')
+        single.to_netcdf(outputfile, encoding=encoding)
+    except (OSError, RuntimeError):
+        # the netCDF4 library failed, write with h5netcdf and the same profile
+        single.to_netcdf(outputfile, engine='h5netcdf', encoding=encoding)
     return single
 
 
@@ -252,10 +133,14 @@ def workflow_era5s_to_forcing(
                     lat: float, lon: float, start_date: str, end_date: str, # for download_era5_land_data
                     zbot: int = 30,
                     outputfile: str = './forcing.nc',
-                    lapse_rate: int = 0.006
+                    lapse_rate: int = 0.006,
+                    cache=False,
+                    profile: str = 'default'
                     ):
     """
     A workflow function to download ERA5 land data and convert it to forcing data.
+    With a cache, only the days that are not cached yet are downloaded, see `pyclmuapp.cache`.
+
     Args:
         lat (float): Latitude of the location.
         lon (float): Longitude of the location.
@@ -264,6 +149,9 @@ def workflow_era5s_to_forcing(
         zbot (int, float): The bottom level of the forcing data.
         outputfile (str): The path to save the forcing data.
         lapse_rate (int, float): The lapse rate of the forcing data. default is 0.006, from Pritchard et al. (GRL, 35, 2008) of CTSM
+        cache (bool, str or era5_cache): The cache of the downloaded data, see `pyclmuapp.cache.get_cache`.
+            If False, the downloaded zip in the current folder is used and removed as before. Default is False.
+        profile (str or dict): The NetCDF output profile, "default" or "compressed", see `pyclmuapp.forcing_io.forcing_encoding`. Default is "default".
     Returns:
         xarray.Dataset: The forcing data.
         ds (xarray.Dataset): The dataset containing the downloaded ERA5 land data.
@@ -271,6 +159,33 @@ def workflow_era5s_to_forcing(
     lat = round(float(lat), 1)
     lon = round(float(lon), 1)
     
+    cache = get_cache(cache)
+    if cache is not None:
+        key = dict(kind='raw', source='era5-land-ts', variables=land_variable,
+                   lat=lat, lon=lon, resolution=0.1)
+        for gap_start, gap_end in cache.missing(start=start_date, end=end_date, **key):
+            print(f"Downloading data for {lat}, {lon}, {gap_start} to {gap_end}...")
+            zip_path = f"era5_land_{lat}_{lon}_{gap_start}_{gap_end}.zip"
+            download_era5_land_data(lat, lon, gap_start, gap_end, output_file=zip_path)
+            nc_path = zip_path[:-len('.zip')] + '.nc'
+            get_nc_from_zip(zip_path).to_netcdf(nc_path)
+            os.remove(zip_path)
+            cache.put(nc_path, start=gap_start, end=gap_end, **key)
+        
+        # the cached periods may overlap, the first copy of a time step is kept
+        cached = [xr.open_dataset(cache.path(v))
+                  for v in cache.overlapping(start=start_date, end=end_date, **key)]
+        try:
+            ds = xr.concat(cached, dim='valid_time')
+            ds = ds.isel(valid_time=~ds.get_index('valid_time').duplicated()).sortby('valid_time')
+            ds = ds.sel(valid_time=slice(start_date, f"{end_date}T23:59:59")).load()
+        finally:
+            # the point data is in memory, the cached files are not kept open
+            for cached_ds in cached:
+                cached_ds.close()
+        era5s_to_forcing(ds, zbot=zbot, outputfile=outputfile, lapse_rate=lapse_rate, profile=profile)
+        return outputfile, ds
+    
     # Check if the file already exists and is within the date range
     found = False
     for fname in os.listdir("."):
@@ -288,7 +203,7 @@ def workflow_era5s_to_forcing(
         
         
     ds = get_nc_from_zip(zip_path)
-    forcing_data = era5s_to_forcing(ds, zbot=zbot, outputfile=outputfile, lapse_rate=lapse_rate)
+    forcing_data = era5s_to_forcing(ds, zbot=zbot, outputfile=outputfile, lapse_rate=lapse_rate, profile=profile)
     os.remove(zip_path)
     return outputfile, ds
 
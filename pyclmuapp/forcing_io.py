@@ -0,0 +1,302 @@
+import os
+import shutil
+import zipfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+from typing import Union
+from pyclmuapp.nc_patch import patch_netcdf
+
+# NetCDF output profiles of the forcing files
+# "default": the data is written as is, without compression
+# "compressed": zlib with shuffle, float32 storage and chunks of one month of hours along time,
+#     which matches the sequential reads of DATM
+FORCING_PROFILES = {
+    'default': {},
+    'compressed': {'zlib': True, 'complevel': 4, 'shuffle': True, 'dtype': 'float32', 'chunk': 744},
+}
+
+
+def forcing_encoding(ds: xr.Dataset,
+                     profile: Union[str, dict] = 'default',
+                     dim: str = 'time',
+                     unlimited: bool = False) -> dict:
+    """
+    The `to_netcdf` encoding of the floating point variables of a dataset for an output profile.
+
+    Args:
+        ds (xarray.Dataset): The dataset to write.
+        profile (str or dict): The name of a profile in FORCING_PROFILES, or the profile itself
+            with the keys zlib, complevel, shuffle, dtype and chunk (all optional). Default is 'default'.
+        dim (str): The dimension chunked along. Default is 'time'.
+        unlimited (bool): If `dim` is unlimited. The chunks then do not depend on the current length.
+
+    Returns:
+        dict: The encoding keyed by variable name.
+    """
+
+    if isinstance(profile, str):
+        if profile not in FORCING_PROFILES:
+            raise ValueError(f"The profile should be one of {list(FORCING_PROFILES)}, got {profile}.")
+        profile = FORCING_PROFILES[profile]
+
+    encoding = {}
+    for name in ds.data_vars:
+        da = ds[name]
+        if not np.issubdtype(da.dtype, np.floating):
+            continue
+        enc = {}
+        if profile.get('zlib'):
+            enc.update(zlib=True,
+                       complevel=profile.get('complevel', 4),
+                       shuffle=profile.get('shuffle', True))
+        if 'dtype' in profile:
+            enc['dtype'] = profile['dtype']
+        if 'chunk' in profile and dim in da.dims:
+            enc['chunksizes'] = tuple(
+                (profile['chunk'] if unlimited else min(profile['chunk'], da.sizes[d])) if d == dim
+                else da.sizes[d] for d in da.dims)
+        if enc:
+            encoding[name] = enc
+    return encoding
+
+
+def write_forcing(ds: xr.Dataset,
+                  path: str,
+                  profile: Union[str, dict] = 'default') -> str:
+    """
+    Write a forcing dataset to a NetCDF file with an output profile, see `forcing_encoding`.
+
+    Args:
+        ds (xarray.Dataset): The forcing data.
+        path (str): The path to the NetCDF file.
+        profile (str or dict): The output profile. Default is 'default'.
+
+    Returns:
+        str: The path to the NetCDF file.
+    """
+
+    ds.to_netcdf(path, encoding=forcing_encoding(ds, profile))
+    return path
+
+
+def append_netcdf(ds: xr.Dataset,
+                  path: str,
+                  dim: str = 'time',
+                  profile: Union[str, dict] = 'default') -> str:
+    """
+    Append a dataset to a NetCDF file along an unlimited dimension.
+
+    The first call creates the file with `dim` as the unlimited dimension.
+    The following calls only write the new records at the end of the file,
+    so the data already written is never read back or held in memory.
+
+    Args:
+        ds (xarray.Dataset): The dataset to append, e.g. one month of forcing data.
+        path (str): The path to the NetCDF file.
+        dim (str): The record dimension. Default is 'time'.
+        profile (str or dict): The output profile used when the file is created, see `forcing_encoding`.
+
+    Returns:
+        str: The path to the NetCDF file.
+    """
+
+    if not os.path.exists(path):
+        encoding = forcing_encoding(ds, profile, dim=dim, unlimited=True)
+        if dim in ds.coords and np.issubdtype(ds[dim].dtype, np.datetime64):
+            # float so that the appended records are not truncated by the integer encoding
+            encoding[dim] = {'dtype': 'float64'}
+        ds.to_netcdf(path, unlimited_dims=[dim], encoding=encoding)
+        return path
+
+    with netCDF4.Dataset(path, 'a') as nc:
+        n = len(nc.dimensions[dim])
+        k = ds.sizes[dim]
+        for name in list(ds.coords) + list(ds.data_vars):
+            da = ds[name]
+            if dim not in da.dims:
+                continue
+            if name not in nc.variables:
+                raise ValueError(f"The variable {name} is not in the file {path}.")
+            var = nc.variables[name]
+            if np.issubdtype(da.dtype, np.datetime64):
+                times = pd.to_datetime(da.values).to_pydatetime()
+                values = netCDF4.date2num(times, var.units,
+                                          getattr(var, 'calendar', 'standard'))
+            else:
+                values = da.transpose(*var.dimensions).values
+            index = tuple(slice(n, n + k) if d == dim else slice(None) for d in var.dimensions)
+            var[index] = values
+
+    return path
+
+
+def forcing_time_range(path: str, dim: str = 'time') -> tuple:
+    """
+    The first and the last time of a forcing file.
+
+    Args:
+        path (str): The path to the NetCDF file.
+        dim (str): The time dimension. Default is 'time'.
+
+    Returns:
+        tuple: (first, last) as pandas.Timestamp.
+    """
+
+    with xr.open_dataset(path) as ds:
+        times = ds[dim].values
+    if len(times) == 0:
+        raise ValueError(f"The file {path} has no {dim}.")
+    return pd.Timestamp(times.min()), pd.Timestamp(times.max())
+
+
+def splice_forcing(path: str,
+                   ds: xr.Dataset,
+                   dim: str = 'time',
+                   profile: Union[str, dict] = 'default') -> str:
+    """
+    Add the records of a dataset that are outside the time range of a forcing file.
+
+    The records after the end of the file are appended in place when the time dimension
+    of the file is unlimited, so extending a file only writes the new data.
+    Otherwise (records before the start, or a fixed time dimension) the file is rewritten once
+    through a partial file, with an unlimited time dimension so the next extensions are appended.
+
+    Args:
+        path (str): The path to the forcing file.
+        ds (xarray.Dataset): The new forcing data.
+        dim (str): The time dimension. Default is 'time'.
+        profile (str or dict): The output profile used if the file is rewritten, see `forcing_encoding`.
+
+    Returns:
+        str: The path to the forcing file.
+    """
+
+    first, last = forcing_time_range(path, dim)
+    with xr.open_dataset(path) as old:
+        unlimited = dim in old.encoding.get('unlimited_dims', ())
+    times = ds.get_index(dim)
+    before = ds.isel({dim: np.flatnonzero(times < first)}).sortby(dim)
+    after = ds.isel({dim: np.flatnonzero(times > last)}).sortby(dim)
+
+    if before.sizes[dim] == 0 and unlimited:
+        if after.sizes[dim] > 0:
+            append_netcdf(after, path, dim=dim)
+        return path
+
+    partfile = path + '.part'
+    if os.path.exists(partfile):
+        os.remove(partfile)
+    with xr.open_dataset(path) as old:
+        merged = xr.concat([before, old.load(), after], dim=dim, data_vars='minimal', coords='minimal',
+                           compat='override', join='override')
+    append_netcdf(merged, partfile, dim=dim, profile=profile)
+    os.replace(partfile, path)
+    return path
+
+
+def open_zip_netcdf(zip_path: str) -> xr.Dataset:
+    """
+    Read and merge the NetCDF members of a zip archive, e.g. a CDS download.
+
+    Each member is read into memory and opened from there with netCDF4,
+    so nothing is extracted to disk. The data is loaded and every handle
+    (members, NetCDF files and the zip) is closed before returning.
+
+    Args:
+        zip_path (str): The path to the zip archive.
+
+    Returns:
+        xarray.Dataset: The merged dataset of all the NetCDF members.
+    """
+
+    datasets = []
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        for name in z.namelist():
+            if not name.endswith('.nc'):
+                continue
+            store = xr.backends.NetCDF4DataStore(
+                netCDF4.Dataset(name, mode='r', memory=z.read(name)))
+            try:
+                datasets.append(xr.open_dataset(store).load())
+            finally:
+                store.close()
+    if not datasets:
+        raise ValueError(f"No NetCDF file in the zip {zip_path}.")
+    return xr.merge(datasets)
+
+
+def perturb_forcing(source: str,
+                    path: str,
+                    perturbation: dict,
+                    dim: str = 'time',
+                    block_size: int = 744) -> str:
+    """
+    Write a perturbed copy of a forcing file, e.g. for a sensitivity run.
+
+    The source file is copied as is, and only the perturbed variables of the copy are revised,
+    block by block along time, see `pyclmuapp.nc_patch.patch_netcdf`. The source file is never
+    changed, so every scenario starts from the same baseline and nothing has to be undone after a run.
+
+    Args:
+        source (str): The path to the baseline forcing file.
+        path (str): The path to the perturbed forcing file.
+        perturbation (dict): The perturbation of each variable, keyed by variable name.
+            A number is added to the variable. A dict may have the keys:
+                - "scale": the variable is multiplied by the number, first.
+                - "add": the number is added to the variable.
+                - "delta": a time-varying addition, an array with one value per time step,
+                  or an xarray.DataArray along `dim` selected at the times of the file.
+            e.g. {"Tair": 1.0, "Prectmms": {"scale": 1.1}, "SWdown": {"delta": delta}}
+        dim (str): The time dimension. Default is 'time'.
+        block_size (int): The number of time steps revised at once. Default is 744.
+
+    Returns:
+        str: The path to the perturbed forcing file.
+    """
+
+    if os.path.abspath(source) == os.path.abspath(path):
+        raise ValueError("The perturbed forcing file should not be the baseline forcing file.")
+
+    with netCDF4.Dataset(source, 'r') as nc:
+        dims = {name: nc.variables[name].dimensions for name in perturbation if name in nc.variables}
+
+    scale, add = {}, {}
+    times = None
+    for name, spec in perturbation.items():
+        if name not in dims:
+            raise ValueError(f"The variable {name} is not in the file {source}.")
+        if not isinstance(spec, dict):
+            spec = {'add': spec}
+        unknown = set(spec) - {'scale', 'add', 'delta'}
+        if unknown:
+            raise ValueError(f"The perturbation of {name} should have the keys scale, add or delta, got {unknown}.")
+        if 'scale' in spec:
+            scale[name] = float(spec['scale'])
+        value = np.float64(spec.get('add', 0.0))
+        if 'delta' in spec:
+            delta = spec['delta']
+            if dims[name][0] != dim:
+                raise ValueError(f"The first dimension of {name} should be {dim} for a time-varying delta.")
+            if isinstance(delta, xr.DataArray):
+                if times is None:
+                    with xr.open_dataset(source) as ds:
+                        times = ds[dim].values
+                delta = delta.sel({dim: times}).values
+            delta = np.asarray(delta, dtype=np.float64)
+            value = value + delta.reshape(delta.shape + (1,) * (len(dims[name]) - delta.ndim))
+        if np.any(value != 0):
+            add[name] = value
+
+    partfile = path + '.part'
+    shutil.copyfile(source, partfile)
+    try:
+        # a fresh copy, it is thrown away if the revision fails
+        patch_netcdf(partfile, scale, mode='scale', block_size=block_size, journal=False)
+        patch_netcdf(partfile, add, mode='add', block_size=block_size, journal=False)
+    except BaseException:
+        os.remove(partfile)
+        raise
+    os.replace(partfile, path)
+    return path
@@ -0,0 +1,272 @@
+import numpy as np
+import xarray as xr
+
+#-------------------Constants-------------------
+SHR_CONST_BOLTZ   = 1.38065e-23  # Boltzmann's constant ~ J/K/molecule
+SHR_CONST_AVOGAD  = 6.02214e26   # Avogadro's number ~ molecules/kmole
+SHR_CONST_RGAS    = SHR_CONST_AVOGAD*SHR_CONST_BOLTZ       # Universal gas constant ~ J/K/kmole
+SHR_CONST_MWDAIR  = 28.966       # molecular weight dry air ~ kg/kmole
+SHR_CONST_MWWV    = 18.016       # molecular weight water vapor
+SHR_CONST_RDAIR   = SHR_CONST_RGAS/SHR_CONST_MWDAIR        # Dry air gas constant     ~ J/K/kg
+SHR_CONST_G       = 9.80616      # acceleration of gravity ~ m/s^2
+
+rair              = SHR_CONST_RDAIR
+grav              = SHR_CONST_G
+
+# Pritchard et al. (GRL, 35, 2008) use 0.006
+# https://github.com/ESCOMP/CTSM/blob/a9433779f0ae499d60ad118d2ec331628f0eaaa8/bld/namelist_files/namelist_defaults_ctsm.xml#L197
+LAPSE_RATE = 0.006
+
+# ref: https://commons.erau.edu/cgi/viewcontent.cgi?article=1374&context=ijaaa
+# DPLR of moist air at temperature of 20oC (293 K) and dew point of 12oC(285 K) has RH of approximately 60%.
+# DP-depression D is 8oC (8 K). Using Eq. (38), whileneglecting specific humidity contribution,
+# DPLR yields about 0.546 K/1,000 ft (1.8 K/km). Thisis valid result as measured DPLRs are normally in the range 1.6-2.0 K/km or 0.50 to 0.6 K/1,000ft.
+# for simple, we use lapse_rate_dew = 1.8/1000, which is the middle of the range.
+# pdf is in src/CLMU_literatures/On Atmospheric Lapse Rates.pdf
+# also: Pilot’s Handbook of Aeronautical Knowledge : "When lifted, ... the dew point temperature decreases at a rate of 1 °F per 1,000 feet."
+# ~ 0.555556 K/1000 ft or 1.8 K/km.
+# ref: https://www.faa.gov/sites/faa.gov/files/14_phak_ch12.pdf
+LAPSE_RATE_DEW = 1.8/1000
+
+# costants for saturation vapor pressure for Qair
+# ref1: https://github.com/ESCOMP/CTSM/blob/75b34d2d8770461e3e28cee973a39f1737de091d/doc/source/tech_note/Land-Only_Mode/CLM50_Tech_Note_Land-Only_Mode.rst#L113
+# ref2: https://journals.ametsoc.org/view/journals/apme/57/6/jamc-d-17-0334.1.xml
+# ref3: https://github.com/ESCOMP/CTSM/blob/75b34d2d8770461e3e28cee973a39f1737de091d/src/biogeophys/QSatMod.F90
+# Reference:  Polynomial approximations from:
+#             Piotr J. Flatau, et al.,1992:  Polynomial fits to saturation
+#             vapor pressure.  Journal of Applied Meteorology, 31, 1507-1513.
+ES_WATER_COEFFS = (6.11213476, 0.444007856, 0.143064234e-01, 0.264461437e-03,
+                   0.305903558e-05, 0.196237241e-07, 0.892344772e-10,
+                   -0.373208410e-12, 0.209339997e-15)
+ES_ICE_COEFFS = (6.11123516, 0.503109514, 0.188369801e-01, 0.420547422e-03,
+                 0.614396778e-05, 0.602780717e-07, 0.387940929e-09,
+                 0.149436277e-11, 0.262655803e-14)
+# -------------------Constants-------------------
+
+# lower bound used for the fluxes and humidity, same as the CLM forcing convention
+FORCING_FLOOR = 1e-16
+
+FORCING_VARS = ('Tair', 'PSurf', 'Wind', 'Qair', 'Zbot', 'SWdown', 'LWdown', 'Prectmms')
+
+FORCING_ATTRS = {
+    'Tair': {'units': 'K', 'long_name': 'Air temperature'},
+    'PSurf': {'units': 'Pa', 'long_name': 'Surface pressure at 950 hPa'},
+    'Wind': {'units': 'm/s', 'long_name': 'Wind speed'},
+    'Qair': {'units': 'kg/kg', 'long_name': 'Specific humidity'},
+    'Zbot': {'units': 'm', 'long_name': 'Geopotential height'},
+    'SWdown': {'units': 'W/m^2', 'long_name': 'Surface solar radiation downwards'},
+    'LWdown': {'units': 'W/m^2', 'long_name': 'Surface thermal radiation downwards'},
+    'Prectmms': {'units': 'mm/s', 'long_name': 'Total precipitation'},
+}
+
+
+def _horner(x, coeffs, out):
+    """
+    Evaluate the polynomial sum(coeffs[i] * x**i) into `out` without temporaries.
+    """
+    out[...] = coeffs[-1]
+    for c in coeffs[-2::-1]:
+        np.multiply(out, x, out=out)
+        np.add(out, c, out=out)
+    return out
+
+
+def _floor(a):
+    """
+    Replace non-positive (and NaN) values by FORCING_FLOOR in place, as `xr.where(a > 0, a, 1e-16)`.
+    """
+    np.copyto(a, FORCING_FLOOR, where=~(a > 0))
+    return a
+
+
+def era5_forcing_kernel(t2m, d2m, sp, u10, v10, ssrd, strd, tp,
+                        fsr=None,
+                        zbot: float = 30,
+                        lapse_rate: float = LAPSE_RATE,
+                        wind_profile: str = "log",
+                        clip_lwdown: bool = True,
+                        out: dict = None,
+                        block_size: int = 8760) -> dict:
+    """
+    Convert raw ERA5 fields to the eight CLM forcing fields in one pass.
+
+    All the inputs are broadcast together and the outputs are preallocated once.
+    The work is done block by block along the first axis with a fixed scratch buffer,
+    so no intermediate arrays of the full length are created.
+
+    Args:
+        t2m, d2m, sp, u10, v10, ssrd, strd, tp (array-like): The raw ERA5 fields,
+            2 m temperature [K], 2 m dewpoint [K], surface pressure [Pa], 10 m wind [m/s],
+            accumulated radiation [J/m^2] and total precipitation [m].
+        fsr (array-like, optional): The forecast surface roughness [m]. Required when wind_profile is "log".
+        zbot (float or array-like): The bottom level of the forcing data [m].
+            An array is broadcast against the trailing axes, e.g. one zbot per site for (time, site) inputs.
+        lapse_rate (float): The lapse rate of the forcing data. default is 0.006, from Pritchard et al. (GRL, 35, 2008) of CTSM
+        wind_profile (str): How to move the 10 m wind to zbot.
+            "log": logarithmic profile with fsr, ref: https://doi.org/10.5194/essd-14-5157-2022
+            "power": 1/7 power law, used for ERA5-Land which has no fsr.
+        clip_lwdown (bool): If the LWdown is floored at 1e-16 as the other fluxes. Default is True.
+        out (dict, optional): Preallocated output arrays keyed by FORCING_VARS.
+        block_size (int): The number of steps along the first axis processed at once. Default is 8760 (one year of hours).
+
+    Returns:
+        dict: The forcing fields keyed by FORCING_VARS.
+    """
+
+    if wind_profile == "log":
+        if fsr is None:
+            raise ValueError("The fsr is required for the 'log' wind profile.")
+        raw = [t2m, d2m, sp, u10, v10, ssrd, strd, tp, fsr]
+    elif wind_profile == "power":
+        raw = [t2m, d2m, sp, u10, v10, ssrd, strd, tp]
+    else:
+        raise ValueError("The wind_profile should be 'log' or 'power'.")
+
+    raw = np.broadcast_arrays(*[np.asarray(a) for a in raw])
+    shape = raw[0].shape
+    if len(shape) == 0:
+        raise ValueError("The ERA5 fields should have at least one (time) dimension.")
+    dtype = np.result_type(*raw, np.float32)
+
+    if out is None:
+        out = {var: np.empty(shape, dtype=dtype) for var in FORCING_VARS}
+    else:
+        for var in FORCING_VARS:
+            if out[var].shape != shape:
+                raise ValueError(f"The output array {var} has shape {out[var].shape}, expected {shape}.")
+
+    t2m, d2m, sp, u10, v10, ssrd, strd, tp = raw[:8]
+    fsr = raw[8] if wind_profile == "log" else None
+
+    zbot = np.asarray(zbot, dtype=float)
+    dz = zbot - 2.0
+    n = shape[0]
+    block_size = max(1, min(int(block_size), n))
+    tmp1 = np.empty((block_size,) + shape[1:], dtype=dtype)
+    tmp2 = np.empty((block_size,) + shape[1:], dtype=dtype)
+
+    out['Zbot'][...] = zbot
+
+    for i0 in range(0, n, block_size):
+        sl = slice(i0, min(i0 + block_size, n))
+        m = sl.stop - sl.start
+        s1 = tmp1[:m]
+        s2 = tmp2[:m]
+
+        # Tair: temperature at zbot with the lapse rate
+        tair = out['Tair'][sl]
+        np.subtract(t2m[sl], lapse_rate * dz, out=tair)
+
+        # PSurf: hypsometric pressure at zbot, Hbot = rair * Tair / grav
+        psurf = out['PSurf'][sl]
+        np.multiply(tair, rair / grav, out=psurf)
+        np.divide(-dz, psurf, out=psurf)
+        np.exp(psurf, out=psurf)
+        np.multiply(psurf, sp[sl], out=psurf)
+
+        # Wind: 10 m wind speed moved to zbot
+        wind = out['Wind'][sl]
+        np.hypot(u10[sl], v10[sl], out=wind)
+        if wind_profile == "log":
+            np.divide(zbot, fsr[sl], out=s1)
+            np.log(s1, out=s1)
+            np.divide(10.0, fsr[sl], out=s2)
+            np.log(s2, out=s2)
+            np.divide(s1, s2, out=s1)
+            np.multiply(wind, s1, out=wind)
+        else:
+            np.multiply(wind, (zbot / 10.0)**(1/7), out=wind)
+
+        # Qair: from the saturation vapor pressure at the dewpoint (lifted to zbot)
+        # s1 <- dewpoint [degC], s2 <- es_ice, qair <- es_water then es
+        qair = out['Qair'][sl]
+        np.subtract(d2m[sl], 273.15 + LAPSE_RATE_DEW * dz, out=s1)
+        _horner(s1, ES_WATER_COEFFS, qair)
+        _horner(s1, ES_ICE_COEFFS, s2)
+        np.copyto(qair, s2, where=~(s1 >= 0))
+        np.multiply(qair, 100, out=qair)
+        # Qair = 0.622 * es / (PSurf - (1 - 0.622) * es)
+        np.multiply(qair, -(1 - 0.622), out=s2)
+        np.add(s2, psurf, out=s2)
+        np.multiply(qair, 0.622, out=qair)
+        np.divide(qair, s2, out=qair)
+        _floor(qair)
+
+        # radiation and precipitation: hourly accumulations to rates
+        swdown = out['SWdown'][sl]
+        np.divide(ssrd[sl], 3600, out=swdown)
+        _floor(swdown)
+
+        lwdown = out['LWdown'][sl]
+        np.divide(strd[sl], 3600, out=lwdown)
+        if clip_lwdown:
+            _floor(lwdown)
+
+        prec = out['Prectmms'][sl]
+        np.multiply(tp[sl], 1000 / 3600, out=prec)
+        _floor(prec)
+
+    return out
+
+
+def era5_forcing_dataset(single: xr.Dataset,
+                         zbot: float = 30,
+                         lapse_rate: float = LAPSE_RATE,
+                         wind_profile: str = "log",
+                         clip_lwdown: bool = True) -> xr.Dataset:
+    """
+    Apply `era5_forcing_kernel` to a point ERA5 dataset and build the CLM forcing dataset.
+
+    Args:
+        single (xarray.Dataset): The ERA5 data of one location, with a `time` dimension
+            and the variables t2m, d2m, sp, u10, v10, ssrd, strd, tp (and fsr for the "log" wind profile).
+        zbot (int, float): The bottom level of the forcing data.
+        lapse_rate (int, float): The lapse rate of the forcing data. default is 0.006, from Pritchard et al. (GRL, 35, 2008) of CTSM
+        wind_profile (str): "log" or "power", see `era5_forcing_kernel`.
+        clip_lwdown (bool): If the LWdown is floored at 1e-16. Default is True.
+
+    Returns:
+        xarray.Dataset: The forcing data with dimensions (time, y, x).
+    """
+
+    dims = single['t2m'].dims
+    if dims != ('time',):
+        raise ValueError(f"The ERA5 data should only have the time dimension, got {dims}.")
+
+    fsr = single['fsr'].values if wind_profile == "log" else None
+    fields = era5_forcing_kernel(
+        single['t2m'].values, single['d2m'].values, single['sp'].values,
+        single['u10'].values, single['v10'].values,
+        single['ssrd'].values, single['strd'].values, single['tp'].values,
+        fsr=fsr, zbot=zbot, lapse_rate=lapse_rate,
+        wind_profile=wind_profile, clip_lwdown=clip_lwdown)
+
+    return forcing_dataset(fields, single['time'], attrs=single.attrs)
+
+
+def forcing_dataset(fields: dict,
+                    time,
+                    attrs: dict = None) -> xr.Dataset:
+    """
+    Build the CLM forcing dataset of one location from the fields of `era5_forcing_kernel`.
+
+    Args:
+        fields (dict): The 1-D (time) forcing fields keyed by FORCING_VARS.
+        time (array-like): The time coordinate.
+        attrs (dict, optional): The global attributes of the dataset.
+
+    Returns:
+        xarray.Dataset: The forcing data with dimensions (time, y, x).
+    """
+
+    if isinstance(time, xr.DataArray):
+        # the scalar latitude and longitude of the point are not kept, as in the CLM forcing files
+        time = time.reset_coords(drop=True)
+    data_vars = {}
+    for var in FORCING_VARS:
+        attrs_var = dict(FORCING_ATTRS[var], _FillValue=1.e36)
+        data_vars[var] = (('time', 'y', 'x'), fields[var][:, np.newaxis, np.newaxis], attrs_var)
+
+    return xr.Dataset(data_vars,
+                      coords={'time': time, 'x': [1], 'y': [1]},
+                      attrs=attrs if attrs is not None else {})
@@ -4,11 +4,192 @@
 # This script is used to run CESM2 via python
 
 import os
+import shutil
 import xarray as xr
 import numpy as np
 from typing import Union, List, Dict
 import time
 import gc
+from pyclmuapp.shared_data import open_shared
+from pyclmuapp.soil_index import get_soil_index
+from pyclmuapp.nc_patch import patch_netcdf
+
+class urban_transfer_plan:
+    
+    """
+    The transfer of the urban parameters of a site into the surface data template, compiled once.
+    
+    The plan holds the urban variables that are also in the template, with the dimensions of the values
+    on both sides and if their missing values are filled with 0. It is built once for an urban dataset and
+    a template, and applied to any number of sites. `to_dict` and `from_dict` allow to inspect or save it.
+    
+    Args:
+        urban (xr.Dataset): the urban parameters of the sites, see `select_urban`
+        template (xr.Dataset): the single cell surface data template
+        site_dim (str, optional): the site dimension of the urban parameters. Defaults to "site".
+    
+    Attributes:
+        site_dim (str): the site dimension of the urban parameters
+        entries (list): one dict per variable with the name, the source_dims (urban, without the site),
+            the target_dims (template, without lsmlat and lsmlon), the target_shape and fill
+    """
+    
+    def __init__(self,
+                 urban: xr.Dataset = None,
+                 template: xr.Dataset = None,
+                 site_dim: str = "site"):
+        
+        self.site_dim = site_dim
+        self.entries = []
+        if urban is None or template is None:
+            return
+        for name in urban.variables:
+            if name not in template.variables:
+                continue
+            source_dims = [d for d in urban[name].dims if d != site_dim]
+            target_dims = [d for d in template[name].dims if d not in ('lsmlat', 'lsmlon')]
+            target_shape = [template.sizes[d] for d in target_dims]
+            source_size = int(np.prod([urban.sizes[d] for d in source_dims]))
+            if source_size != int(np.prod(target_shape)):
+                raise ValueError(f"The urban variable {name} {source_dims} does not fit the template {target_dims}.")
+            self.entries.append({
+                'name': name,
+                'source_dims': source_dims,
+                'target_dims': target_dims,
+                'target_shape': target_shape,
+                # the missing values are set to 0, as fillna(0)
+                'fill': bool(np.issubdtype(urban[name].dtype, np.floating)),
+            })
+    
+    def apply(self,
+              template: xr.Dataset,
+              urban: xr.Dataset,
+              site: int = 0) -> xr.Dataset:
+        """
+        Write the urban parameters of one site into the template, in place.
+        
+        Args:
+            template (xr.Dataset): the single cell surface data template
+            urban (xr.Dataset): the urban parameters of the sites
+            site (int, optional): the index of the site along the site dimension. Defaults to 0.
+        
+        Returns:
+            xr.Dataset: the template
+        """
+        for entry in self.entries:
+            name = entry['name']
+            values = urban[name]
+            if self.site_dim in values.dims:
+                values = values.isel({self.site_dim: site})
+            # the values keep the order of the urban dataset, the dimension names may differ
+            values = np.asarray(values.values).reshape(entry['target_shape'])
+            if entry['fill']:
+                values = np.where(np.isnan(values), 0, values)
+            if name == 'LONGXY':
+                values = np.where(values < 0, values + 360, values)
+            target = template[name]
+            index = tuple(0 if d in ('lsmlat', 'lsmlon') else slice(None) for d in target.dims)
+            target.values[index] = values
+        return template
+    
+    def values(self, urban: xr.Dataset) -> dict:
+        """
+        The values of all the sites in the shape of the template, as `apply` writes them.
+        
+        Args:
+            urban (xr.Dataset): the urban parameters of the sites
+        
+        Returns:
+            dict: the values of each variable, (site, target_shape)
+        """
+        nsite = urban.sizes.get(self.site_dim, 1)
+        values = {}
+        for entry in self.entries:
+            name = entry['name']
+            data = urban[name]
+            if self.site_dim in data.dims:
+                data = np.asarray(data.transpose(self.site_dim, ...).values)
+            else:
+                data = np.broadcast_to(np.asarray(data.values), (nsite,) + data.shape)
+            data = data.reshape([nsite] + list(entry['target_shape']))
+            if entry['fill']:
+                data = np.where(np.isnan(data), 0, data)
+            if name == 'LONGXY':
+                data = np.where(data < 0, data + 360, data)
+            values[name] = data
+        return values
+    
+    def to_dict(self) -> dict:
+        """
+        The plan as a JSON serializable dict.
+        """
+        return {'site_dim': self.site_dim, 'entries': [dict(e) for e in self.entries]}
+    
+    @classmethod
+    def from_dict(cls, plan: dict) -> 'urban_transfer_plan':
+        """
+        Rebuild a plan from `to_dict`.
+        """
+        new = cls(site_dim=plan['site_dim'])
+        new.entries = [dict(e) for e in plan['entries']]
+        return new
+
+
+_urban_plans = {}
+
+
+def get_urban_plan(urban: xr.Dataset,
+                   template: xr.Dataset,
+                   site_dim: str = "site") -> urban_transfer_plan:
+    """
+    Get the transfer plan of the urban parameters into a template, compiled once per
+    variable layout of the urban parameters and of the template.
+    
+    Args:
+        urban (xr.Dataset): the urban parameters of the sites, see `select_urban`
+        template (xr.Dataset): the single cell surface data template
+        site_dim (str, optional): the site dimension. Defaults to "site".
+    
+    Returns:
+        urban_transfer_plan: the plan
+    """
+    key = (site_dim,
+           tuple((v, urban[v].dims, str(urban[v].dtype)) for v in urban.variables),
+           tuple((v, template[v].dims, tuple(template[v].shape)) for v in template.variables))
+    plan = _urban_plans.get(key)
+    if plan is None:
+        plan = urban_transfer_plan(urban, template, site_dim=site_dim)
+        _urban_plans[key] = plan
+    return plan
+
+
+def select_urban(urban_ds: xr.Dataset,
+                 lats: np.ndarray,
+                 lons: np.ndarray,
+                 site_dim: str = "site") -> xr.Dataset:
+    """
+    Select the urban parameters of the nearest cell and region of each site at once.
+    
+    Args:
+        urban_ds (xr.Dataset): the urban dataset
+        lats (np.ndarray): the latitudes of the sites
+        lons (np.ndarray): the longitudes of the sites, from -180 to 180
+        site_dim (str, optional): the new site dimension. Defaults to "site".
+    
+    Returns:
+        xr.Dataset: the urban parameters along the site dimension
+    """
+    if 'lat' not in urban_ds.indexes or 'lon' not in urban_ds.indexes:
+        urban_ds = urban_ds.assign_coords(lat=urban_ds.LAT, lon=urban_ds.LON)
+    urban = urban_ds.sel(lat=xr.DataArray(np.asarray(lats, dtype=float), dims=site_dim),
+             lon=xr.DataArray(np.asarray(lons, dtype=float), dims=site_dim), method='nearest')
+    # to make region_id start from 0
+    urban = urban.isel(region=xr.DataArray(urban.REGION_ID.values.astype(int) - 1, dims=site_dim))
+    for name in ['ROOF', 'WALL', 'IMPROAD', 'PERROAD']:
+        urban[f'ALB_{name}_DIF'] = urban[f'ALB_{name}'].sel(numsolar=0)
+        urban[f'ALB_{name}_DIR'] = urban[f'ALB_{name}'].sel(numsolar=1)
+    return urban
+
 
 def get_urban_params(urban_ds: Union[xr.Dataset, str],
                      soil_ds: Union[xr.Dataset, str],
@@ -40,41 +221,19 @@ def get_urban_params(urban_ds: Union[xr.Dataset, str],
         lon = lon - 360
     
     if isinstance(urban_ds, str):
-        urban_ds = xr.open_dataset(urban_ds)
+        # opened once per process and shared, see `pyclmuapp.shared_data.open_shared`
+        urban_ds = open_shared(urban_ds)
     if isinstance(template, str):
         template = xr.open_dataset(template)
+    template = template.load()
 
-    urban = urban_ds.assign_coords(lat=urban_ds.LAT, lon=urban_ds.LON).sel(lat=lat, lon=lon, method='nearest')
-    urban =  urban.sel(region=(urban.REGION_ID.values-1)) # to make region_id start from 0
-    urban['ALB_ROOF_DIF'] = urban['ALB_ROOF'].sel(numsolar=0)
-    urban['ALB_ROOF_DIR'] = urban['ALB_ROOF'].sel(numsolar=1)
-    urban['ALB_WALL_DIF'] = urban['ALB_WALL'].sel(numsolar=0)
-    urban['ALB_WALL_DIR'] = urban['ALB_WALL'].sel(numsolar=1)
-    urban['ALB_IMPROAD_DIF'] = urban['ALB_IMPROAD'].sel(numsolar=0)
-    urban['ALB_IMPROAD_DIR'] = urban['ALB_IMPROAD'].sel(numsolar=1)
-    urban['ALB_PERROAD_DIF'] = urban['ALB_PERROAD'].sel(numsolar=0)
-    urban['ALB_PERROAD_DIR'] = urban['ALB_PERROAD'].sel(numsolar=1)
+    urban = select_urban(urban_ds, [lat], [lon])
+    plan = get_urban_plan(urban, template)
+    urban = urban[[e['name'] for e in plan.entries] + ['REGION_ID']].load()
     
     # Set the urban parameters
-    for v1 in urban.variables:
-        for v2 in template.variables:
-            if v1 == v2:
-                #print(f"Setting {v1} to {v2}")
-                #print(template[v2].loc[dict(lsmlat=float(template['lsmlat'].values), lsmlon=float(template['lsmlon'].values))].shape)
-                #print(urban[v1].shape)
-                try:
-                    lsmlat = float(template['lsmlat'].values)
-                    lsmlon = float(template['lsmlon'].values)
-                except: 
-                    lsmlat = template['lsmlat'].values.item()
-                    lsmlon = template['lsmlon'].values.item()
-                
-                template[v2].loc[dict(lsmlat=lsmlat, lsmlon=lsmlon)] = urban[v1].values
-                if v2 == 'LONGXY':
-                    if template[v2].loc[dict(lsmlat=lsmlat, lsmlon=lsmlon)] < 0:
-                        template[v2].loc[dict(lsmlat=lsmlat, lsmlon=lsmlon)] = template[v2].loc[dict(lsmlat=lsmlat, lsmlon=lsmlon)].values + 360
-                template[v2] = template[v2].fillna(0)
-    template['URBAN_REGION_ID'].loc[dict(lsmlat=lsmlat, lsmlon=lsmlon)] = urban['REGION_ID'].values
+    plan.apply(template, urban, site=0)
+    template['URBAN_REGION_ID'].values[...] = urban['REGION_ID'].values[0]
     template['PCT_URBAN'].values[:, 0, 0] = np.array(PTC_URBAN)
     
     sand, clay = get_soil_params(soil_ds, lat, lon)
@@ -87,71 +246,123 @@ def get_urban_params(urban_ds: Union[xr.Dataset, str],
     return  template
 
 
+def get_urban_params_batch(urban_ds: Union[xr.Dataset, str],
+                           soil_ds: Union[xr.Dataset, str],
+                           sites: list,
+                           template: Union[xr.Dataset, str] = os.path.join(os.path.dirname(__file__), "usp", "surfdata.nc"),
+                           PTC_URBAN: list = [0,0,100],
+                           outputname: str = "surfdata_{lat}_{lon}.nc",
+                           stacked: str = None
+                           ) -> Union[List[str], str]:
+    
+    """
+    Get the urban parameters of many sites at once.
+    
+    The nearest urban grid cell and region of all the sites are gathered with one vectorized selection
+    (see `select_urban`), and the soil parameters of all the sites with one query of the shared soil index
+    (see `pyclmuapp.soil_index.soil_index.query_many`). The values of the sites are arranged once
+    with the transfer plan (see `urban_transfer_plan`). The template is written once, and the file
+    of each site is a copy of it with only the site variables revised (see `pyclmuapp.nc_patch.patch_netcdf`),
+    or all the sites fill one copy of the template stacked along `site`.
+    
+    Args:
+        urban_ds (xr.Dataset or str): the urban dataset
+        soil_ds (xr.Dataset or str): the soil dataset
+        sites (list): the (lat, lon) of each site
+        template (xr.Dataset or str, optional): the template dataset
+        PTC_URBAN (list, optional): The percentage of urban. Defaults to [0,0,100].
+            0. TBD urban, 1. HD urban, 2. MD urban
+        outputname (str, optional): the output file name of each site, formatted with the lat, lon
+            and index i of the site. Defaults to "surfdata_{lat}_{lon}.nc".
+        stacked (str, optional): write all the sites to this one file instead, stacked along a new `site` dimension.
+            Defaults to None.
+        
+    Returns:
+        list or str: the output file of each site, or the stacked file
+    """
+    
+    lats = np.array([site[0] for site in sites], dtype=float)
+    lons = np.array([site[1] for site in sites], dtype=float)
+    lons = np.where(lons > 180, lons - 360, lons)
+    
+    if isinstance(urban_ds, str):
+        # opened once per process and shared, see `pyclmuapp.shared_data.open_shared`
+        urban_ds = open_shared(urban_ds)
+    if isinstance(template, str):
+        template = xr.open_dataset(template)
+    template = template.load()
+    
+    # one pointwise selection for all the sites
+    urban = select_urban(urban_ds, lats, lons)
+    plan = get_urban_plan(urban, template)
+    urban = urban[[e['name'] for e in plan.entries] + ['REGION_ID']].load()
+    
+    values = plan.values(urban)
+    values['URBAN_REGION_ID'] = urban['REGION_ID'].values
+    # one query of the soil index for all the sites, opened once per process
+    values['PCT_SAND'], values['PCT_CLAY'] = get_soil_index(soil_ds).query_many(lats, lons)
+    values['PCT_URBAN'] = np.broadcast_to(np.array(PTC_URBAN, dtype=float), (len(sites), len(PTC_URBAN)))
+    
+    if stacked is not None:
+        ds = template.expand_dims(site=len(sites)).copy(deep=True)
+        for name, value in values.items():
+            index = (slice(None),) + tuple(0 if d in ('lsmlat', 'lsmlon') else slice(None) for d in template[name].dims)
+            ds[name].values[index] = value.reshape(ds[name].values[index].shape)
+        ds.to_netcdf(stacked)
+        return stacked
+    
+    outputs = [outputname.format(lat=lat, lon=lon, i=i) for i, (lat, lon) in enumerate(sites)]
+    base = f'{outputs[0]}.template.{os.getpid()}.part'
+    template.to_netcdf(base)
+    try:
+        for i, name in enumerate(outputs):
+            tmp = f'{name}.{os.getpid()}.part'
+            shutil.copyfile(base, tmp)
+            patch_netcdf(tmp, {v: value[i] for v, value in values.items()}, mode='replace',
+                         index=dict(lsmlat=0, lsmlon=0), journal=False)
+            os.replace(tmp, name)
+    finally:
+        os.remove(base)
+    return outputs
+
+
 def get_soil_params(ds: Union [xr.Dataset, xr.DataArray, str],
                     lat: float = 51.508965,
-                    lon: float = -0.118092) -> tuple:
+                    lon: float = -0.118092,
+                    cache_dir: Union[str, bool] = None) -> tuple:
     
     """
     Get the soil parameters.
     
+    The nearest cell with non-zero sand and clay content is found with a spatial index of the valid cells,
+    see `pyclmuapp.soil_index.soil_index`. The index is built once per soil dataset, shared by all the sites
+    and saved to disk, so the next sites (and the next sessions) only search it.
+    
     Args:
         ds (xr.Dataset or xr.DataArray or str): the soil dataset
         lat (float): latitude of interest point
         lon (float): longitude of interest point
+        cache_dir (str, optional): the folder of the saved index. Default is the pyclmuapp cache folder,
+            False to keep the index in memory only.
     
     Returns:
         tuple: sand and clay content from the soil dataset
     """
     
-    if isinstance(ds, str):
-        ds = xr.open_dataset(ds)
-    
-    ds = ds.assign_coords(lat=ds.LAT, lon=ds.LON)
-
-    lat_soil = lat
-    lon_soil = lon
-
-    search_range = 180/21600  # 0.008333333333333333
-
-    while True:
-        found_point = False  # flag to indicate if a suitable point is found
-        for lat_offset in [0, 1 , -1]:
-            for lon_offset in [0, 1, -1]:
-                # calculate new latitude and longitude
-                new_lat = lat_soil + lat_offset * search_range
-                new_lon = lon_soil + lon_offset * search_range
-                
-                # select the nearest point
-                dd = ds.sel(lat=new_lat, lon=new_lon, method='nearest')
-                sand = dd['PCT_SAND'].sel(max_value_mapunit=int(dd['MAPUNITS'].values)).values
-                clay = dd['PCT_CLAY'].sel(max_value_mapunit=int(dd['MAPUNITS'].values)).values
-                
-                # check if the point is suitable
-                if not (np.all(sand == 0) or np.all(clay == 0)):
-                    found_point = True
-                    lat_soil = new_lat
-                    lon_soil = new_lon
-                    break  #  break the inner loop
-            # break the outer loop
-            if found_point:
-                print(f'Found suitable point at lat: {lat_soil}, lon: {lon_soil}')
-                break  # break the outer loop
-        # break the while loop
-        if found_point:
-            print(f'Found suitable point at lat: {lat_soil}, lon: {lon_soil}')
-            break  # break the while loop
-        else:
-            print('No suitable point found in the search range, expanding search range.')
-            search_range += 180/21600  # expand the search range by 0.008333333333333333
-
-    return sand, clay
+    return get_soil_index(ds, cache_dir=cache_dir).query(lat, lon)
 
 
 def get_forcing(start_year :int, 
                 end_year: int, 
                 start_month: int, end_month: int,
                 lat: float, lon: float, zbot: float,
-                source: str = 'cds'
+                source: str = 'cds',
+                stream: bool = True,
+                max_workers: int = 4,
+                lapse_rate: float = 0.006,
+                cache = False,
+                profile: str = 'default',
+                existing: str = None
                 ):
     
     """
@@ -170,59 +381,118 @@ def get_forcing(start_year :int,
             "arco-era5": download data from the ARCO ERA5 dataset
             "era5-land-ts": download data from the ERA5-Land Time Series dataset
             "gee": download data from the Google Earth Engine (GEE) using the GEE API
+        stream (bool): only for "cds". If True, each converted month is appended to the output file on disk,
+            so only one month is held in memory. If False, all the months are concatenated in memory
+            and written at once. Default is True.
+        max_workers (int): only for "cds". The maximum number of months downloaded concurrently from the CDS. Default is 4.
+        lapse_rate (float): the lapse rate of the forcing data. Default is 0.006.
+        cache (bool, str or era5_cache): the cache of the downloaded data and of the forcing, see `pyclmuapp.cache.get_cache`.
+            A forcing already converted for the same grid cell, zbot and lapse rate over a period that covers
+            the request is reused without any download. Default is False, no cache: the files are only written
+            in ./era5_data. True for the cache folder $PYCLMUAPP_CACHE or ~/.cache/pyclmuapp.
+        profile (str): the NetCDF output profile of the forcing file, "default" or "compressed" (zlib, float32,
+            chunked by month along time), see `pyclmuapp.forcing_io.forcing_encoding`. Default is "default".
+        existing (str, optional): an existing forcing file of the same site to extend. Only the months of the
+            requested period that the file does not cover are fetched and converted, then they are spliced into
+            the file, see `pyclmuapp.forcing_io.splice_forcing`. The path to the extended file is returned.
+            Default is None.
     Returns:
         xr.Dataset: the forcing dataset
     """
     
+    from pyclmuapp.cache import get_cache
+    from pyclmuapp.era5_forcing import month_bounds
+    from pyclmuapp.forcing_kernel import FORCING_VARS
+    from pyclmuapp.forcing_io import write_forcing, FORCING_PROFILES
+    prefix = {"cds": "era5_forcing", "arco-era5": "arco_era5_forcing",
+              "era5-land-ts": "era5_land_ts_forcing", "gee": "era5_gee_forcing"}
+    if source not in prefix:
+        raise ValueError("The source is not supported. Please choose from 'cds', 'arco-era5', 'era5-land-ts', 'gee'.")
+    
+    if existing is not None:
+        import pandas as pd
+        from pyclmuapp.era5_forcing import month_range
+        from pyclmuapp.forcing_io import forcing_time_range, splice_forcing
+        first, last = forcing_time_range(existing)
+        # the runs of consecutive months that the existing file does not fully cover
+        runs = []
+        months = month_range(start_year, start_month, end_year, end_month)
+        for i, (year, month) in enumerate(months):
+            month_first, month_last = month_bounds(year, month)
+            if first <= pd.Timestamp(month_first) and pd.Timestamp(month_last) + pd.Timedelta(hours=23) <= last:
+                continue
+            if runs and runs[-1][-1] == months[i - 1]:
+                runs[-1].append((year, month))
+            else:
+                runs.append([(year, month)])
+        if not runs:
+            print(f"The forcing file {existing} already covers the period.")
+        for run in runs:
+            (run_start_year, run_start_month), (run_end_year, run_end_month) = run[0], run[-1]
+            print(f"Extend {existing} with {run_start_year}-{run_start_month} to {run_end_year}-{run_end_month}")
+            path = get_forcing(run_start_year, run_end_year, run_start_month, run_end_month,
+                               lat, lon, zbot, source=source, stream=stream, max_workers=max_workers,
+                               lapse_rate=lapse_rate, cache=cache, profile=profile)
+            with xr.open_dataset(path) as ds:
+                splice_forcing(existing, ds.load(), dim='time', profile=profile)
+        return os.path.abspath(existing)
+    
+    cache = get_cache(cache)
+    first_day = month_bounds(start_year, start_month)[0]
+    last_day = month_bounds(end_year, end_month)[1]
+    forcing_key = dict(kind='forcing', source=source, variables=FORCING_VARS, lat=lat, lon=lon,
+                       start=first_day, end=last_day, zbot=zbot, lapse_rate=lapse_rate,
+                       resolution=0.1 if source == "era5-land-ts" else 0.25,
+                       profile=profile if isinstance(profile, str) else 'custom',
+                       encoding=FORCING_PROFILES.get(profile) if isinstance(profile, str) else profile)
+    if cache is not None:
+        cached = cache.get(**forcing_key)
+        if cached is not None:
+            if not os.path.exists('./era5_data'):
+                os.makedirs('./era5_data', exist_ok=True)
+            outfile = f'era5_data/{prefix[source]}_{lat}_{lon}_{zbot}_{start_year}_{start_month}_{end_year}_{end_month}.nc'
+            print(f"The forcing from {first_day} to {last_day} is in the cache: {cached}")
+            with xr.open_dataset(cached) as ds:
+                ds = ds.sel(time=slice(first_day, f'{last_day}T23:59:59')).load()
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            write_forcing(ds, outfile, profile)
+            return os.path.join(os.getcwd(), outfile)
+    
     if source == "cds":
-        from pyclmuapp.era5_forcing import era5_to_forcing, era5_download
-        import xarray as xr
+        from pyclmuapp.era5_forcing import era5_to_forcing, era5_download_pool, month_range
+        from pyclmuapp.forcing_io import append_netcdf
         era5_list = []
-        # from 2002 to 2014
-        years = range(start_year, end_year+1)
-        # download data from January to December
-        months = range(start_month, end_month+1)
         if not os.path.exists('./era5_data'):
             os.makedirs('./era5_data', exist_ok=True)
             os.makedirs('./era5_data/era5_single', exist_ok=True)
-        outputfile='era5_data/era5_forcing_{lat}_{lon}_{zbot}_{year}_{month}.nc'
-        for year in years:
-            
-            if start_year == end_year:
-                months = range(start_month, end_month+1)
-            elif year == end_year:
-                months = range(1, end_month+1)
-            elif year == start_year:
-                months = range(start_month, 13)
+        outfile = f'era5_data/era5_forcing_{lat}_{lon}_{zbot}_{start_year}_{start_month}_{end_year}_{end_month}.nc'
+        # the months are appended to a partial file, which replaces the output once complete
+        partfile = outfile + '.part'
+        if os.path.exists(partfile):
+            os.remove(partfile)
+        # the months are downloaded concurrently and converted in time order as they arrive
+        pool = era5_download_pool(lat=lat, lon=lon, outputfolder='./era5_data/era5_single',
+                                  max_workers=max_workers, cache=cache)
+        months = month_range(start_year, start_month, end_year, end_month)
+        for year, month, single in pool.download(months):
+            # Convert ERA5 data to CLM forcing
+            forcing = era5_to_forcing(single=single, 
+                                    lat=lat, lon=lon, zbot=zbot, lapse_rate=lapse_rate)
+            if stream:
+                append_netcdf(forcing.sortby('time'), partfile, dim='time', profile=profile)
+                forcing.close()
+                del forcing
             else:
-                months = range(1, 13)
-                
-            for month in months:
-                single = era5_download(year=year, month=month,
-                                            lat=lat, lon=lon, outputfolder='./era5_data/era5_single')
-                # Convert ERA5 data to CLM forcing
-                forcing = era5_to_forcing(single=single, 
-                                        lat=lat, lon=lon, zbot=zbot,)
                 era5_list.append(forcing)
                 
-            #for month in months:
-            #    single = era5_download(year=year, month=month,
-            #                                lat=lat, lon=lon, outputfolder='./era5_data')
-            #    # Convert ERA5 data to CLM forcing
-            #    forcing = era5_to_forcing(single=single, 
-            #                            lat=lat, lon=lon, zbot=zbot,
-            #                            outputfile=outputfile.format(lat=lat, lon=lon, 
-            #                                                        zbot=zbot, year=year, 
-            #                                                        month=str(month).zfill(2)))
-            #    ds = xr.open_dataset(outputfile.format(lat=lat, lon=lon, 
-            #                                        zbot=zbot, year=year, 
-            #                                        month=str(month).zfill(2)))
-            #    era5_list.append(ds)
-        era5 = xr.concat(era5_list, dim='time').sortby('time')
-        outfile = f'era5_data/era5_forcing_{lat}_{lon}_{zbot}_{start_year}_{start_month}_{end_year}_{end_month}.nc'
         if os.path.exists(outfile):
             os.remove(outfile)
-        era5.to_netcdf(outfile)
+        if stream:
+            os.replace(partfile, outfile)
+        else:
+            era5 = xr.concat(era5_list, dim='time').sortby('time')
+            write_forcing(era5, outfile, profile)
         result = os.path.join(os.getcwd(), outfile)
 
     elif source == "arco-era5":
@@ -235,7 +505,8 @@ def get_forcing(start_year :int,
         else:
             arco_era5_to_forcing(lat=lat, lon=lon, zbot=zbot, 
                                 start_year=start_year, end_year=end_year, 
-                                start_month=start_month, end_month=end_month, outputfile=outfile)
+                                start_month=start_month, end_month=end_month, outputfile=outfile,
+                                lapse_rate=lapse_rate, profile=profile)
         result = os.path.join(os.getcwd(), outfile)
         
     elif source == "era5-land-ts":
@@ -252,7 +523,9 @@ def get_forcing(start_year :int,
             else:
                 end_date = f"{end_year}-{str(end_month+1).zfill(2)}-01"
             outputfile = f'era5_data/era5_land_ts_forcing_{lat}_{lon}_{zbot}_{start_year}_{start_month}_{end_year}_{end_month}.nc'
-            workflow_era5s_to_forcing(lat, lon, start_date, end_date, zbot=zbot, outputfile=outputfile)
+            workflow_era5s_to_forcing(lat, lon, start_date, end_date, zbot=zbot, outputfile=outputfile,
+                                      lapse_rate=lapse_rate, cache=cache if cache is not None else False,
+                                      profile=profile)
         result = os.path.join(os.getcwd(), outfile)
         
     elif source == "gee":
@@ -273,8 +546,47 @@ def get_forcing(start_year :int,
         if not os.path.exists('./era5_data'):
             os.makedirs('./era5_data', exist_ok=True)
         outputfile = f'era5_data/era5_gee_forcing_{lat}_{lon}_{zbot}_{start_year}_{start_month}_{end_year}_{end_month}.nc'
-        ds_forcing = gee_era5s_to_forcing(ee, lat, lon, start_date, end_date, zbot=zbot, outputfile=outputfile)
+        ds_forcing = gee_era5s_to_forcing(ee, lat, lon, start_date, end_date, zbot=zbot, outputfile=outputfile,
+                                          lapse_rate=lapse_rate, profile=profile)
         result = os.path.join(os.getcwd(), outputfile)
-    else:
-        raise ValueError("The source is not supported. Please choose from 'cds', 'arco-era5', 'era5-land-ts', 'gee'.")
-    return result
\ No newline at end of file
+    
+    if cache is not None:
+        # copied, so that editing the output file does not change the cached forcing
+        cache.put(result, move=False, **forcing_key)
+    return result
+
+
+def get_forcing_batch(sites: list,
+                      start_year: int,
+                      end_year: int,
+                      start_month: int, end_month: int,
+                      lapse_rate: float = 0.006,
+                      max_workers: int = 4,
+                      profile: str = 'default'
+                      ) -> list:
+    
+    """
+    get the forcing data of many sites from the era5 dataset of the CDS.
+    The region that covers all the sites is downloaded once per month,
+    so the cost scales with the region rather than with the number of sites.
+    
+    Args:
+        sites (list): the (lat, lon, zbot) of each site
+        start_year (int): the start year
+        end_year (int): the end year
+        start_month (int): the start month
+        end_month (int): the end month
+        lapse_rate (float): the lapse rate of the forcing data. Default is 0.006.
+        max_workers (int): the maximum number of months downloaded concurrently from the CDS. Default is 4.
+        profile (str): the NetCDF output profile of the forcing files, "default" or "compressed". Default is "default".
+    Returns:
+        list: the path to the forcing file of each site, in the order of sites
+    """
+    
+    from pyclmuapp.era5_forcing import era5_batch_to_forcing
+    outfiles = era5_batch_to_forcing(sites,
+                                     start_year=start_year, start_month=start_month,
+                                     end_year=end_year, end_month=end_month,
+                                     outputfolder='era5_data', lapse_rate=lapse_rate,
+                                     max_workers=max_workers, profile=profile)
+    return [os.path.join(os.getcwd(), outfile) for outfile in outfiles]
\ No newline at end of file
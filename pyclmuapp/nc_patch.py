@@ -0,0 +1,221 @@
+import os
+import json
+import zipfile
+import numpy as np
+import netCDF4
+from typing import Union
+
+# The variables of a NetCDF file are revised in place: only the data of the touched
+# variables is read and written, the rest of the file is left as is.
+# Before the first write, the original values of the touched region are saved block by block
+# in a journal next to the file (<file>.journal.npz). The journal is removed once the revision is done,
+# so a journal left on disk means the revision was interrupted, and the next patch or
+# `recover_netcdf` writes the original values back before anything else.
+
+
+def journal_path(path: str) -> str:
+    """
+    The journal of the in-place revisions of a NetCDF file.
+    """
+    return path + '.journal.npz'
+
+
+def _region(var: netCDF4.Variable, index: dict = None) -> tuple:
+    """
+    The index of the revised region of a variable, an int or a slice per dimension.
+    """
+    index = index or {}
+    return tuple(index.get(d, slice(None)) for d in var.dimensions)
+
+
+def _encode_region(region: tuple) -> list:
+    return [[r.start, r.stop, r.step] if isinstance(r, slice) else int(r) for r in region]
+
+
+def _decode_region(region: list) -> tuple:
+    return tuple(slice(*r) if isinstance(r, list) else r for r in region)
+
+
+def _blocks(var: netCDF4.Variable, region: tuple, block_size: int):
+    """
+    Split a region into blocks along the first dimension, e.g. the time of a forcing file.
+
+    Yields:
+        tuple: (the index of the block in the file, the index of the block in the region values)
+    """
+    if var.ndim == 0 or not isinstance(region[0], slice):
+        yield region, ...
+        return
+    start, stop, step = region[0].indices(var.shape[0])
+    n = len(range(start, stop, step))
+    for b in range(0, n, block_size):
+        e = min(b + block_size, n)
+        yield (slice(start + b * step, start + e * step, step),) + region[1:], slice(b, e)
+
+
+def _region_shape(var: netCDF4.Variable, region: tuple) -> tuple:
+    return tuple(len(range(*r.indices(n))) for r, n in zip(region, var.shape) if isinstance(r, slice))
+
+
+def label_index(path: str, labels: dict) -> dict:
+    """
+    The positions of coordinate labels, as the index of `patch_netcdf`.
+
+    The dimensions without a coordinate variable in the file are indexed by position,
+    as with `xarray.DataArray.loc`.
+
+    Args:
+        path (str): The path to the NetCDF file.
+        labels (dict): The coordinate label of some dimensions, e.g. dict(lsmlat=0, lsmlon=0, numurbl=2).
+
+    Returns:
+        dict: The position along each dimension.
+    """
+
+    index = {}
+    with netCDF4.Dataset(path, 'r') as nc:
+        for dim, label in labels.items():
+            if dim in nc.variables and nc.variables[dim].dimensions == (dim,):
+                found = np.flatnonzero(nc.variables[dim][:] == label)
+                if found.size == 0:
+                    raise KeyError(f"The label {label} is not in the coordinate {dim} of {path}.")
+                index[dim] = int(found[0])
+            else:
+                index[dim] = label
+    return index
+
+
+def _write_journal(nc: netCDF4.Dataset,
+                   names,
+                   index: dict,
+                   block_size: int,
+                   journal: str) -> None:
+    """
+    Save the original values of the revised region of some variables in a journal.
+
+    The journal is a `.npz` file with one array per block of `_blocks`, written one block
+    at a time, so only one block is held in memory. It replaces the journal path once complete.
+    """
+    tmp = journal + '.part'
+    entries = []
+    try:
+        with open(tmp, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED, allowZip64=True) as z:
+                for name in names:
+                    var = nc.variables[name]
+                    # the raw values are saved, without the fill value masking and scaling
+                    var.set_auto_maskandscale(False)
+                    for block, _ in _blocks(var, _region(var, index), block_size):
+                        with z.open(f'data_{len(entries)}.npy', 'w', force_zip64=True) as member:
+                            np.lib.format.write_array(member, np.asarray(var[block]))
+                        entries.append({'name': name, 'region': _encode_region(block)})
+                    var.set_auto_maskandscale(True)
+                with z.open('meta.npy', 'w') as member:
+                    np.lib.format.write_array(member, np.asarray(json.dumps(entries)))
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        # an incomplete journal is of no use, the file is not touched yet
+        os.remove(tmp)
+        raise
+    os.replace(tmp, journal)
+
+
+def recover_netcdf(path: str) -> bool:
+    """
+    Write back the original values saved in the journal of an interrupted revision.
+
+    Args:
+        path (str): The path to the NetCDF file.
+
+    Returns:
+        bool: True if a journal was found and the file was recovered.
+    """
+
+    journal = journal_path(path)
+    if not os.path.exists(journal):
+        return False
+    with np.load(journal) as saved:
+        entries = json.loads(str(saved['meta']))
+        with netCDF4.Dataset(path, 'r+') as nc:
+            for i, entry in enumerate(entries):
+                var = nc.variables[entry['name']]
+                # the raw values are written back, without the fill value masking and scaling
+                var.set_auto_maskandscale(False)
+                var[_decode_region(entry['region'])] = saved[f'data_{i}']
+    os.remove(journal)
+    print(f"Recovered {path} from the journal of an interrupted revision.")
+    return True
+
+
+def patch_netcdf(path: str,
+                 action: dict,
+                 mode: Union[str, dict] = 'add',
+                 index: dict = None,
+                 block_size: int = 744,
+                 journal: bool = True) -> str:
+    """
+    Revise variables of a NetCDF file in place.
+
+    Only the touched region of the revised variables is read and written, block by block
+    along the first dimension, so changing one variable of a multi-year forcing file does not
+    rewrite the whole file. The original values are saved in a journal first, see `recover_netcdf`.
+
+    Args:
+        path (str): The path to the NetCDF file.
+        action (dict): The new values keyed by variable name, a number or an array that
+            broadcasts to the revised region.
+        mode (str or dict): "add" to add the values, "scale" to multiply by them,
+            "replace" to replace them, or a dict of the mode of each variable. Default is "add".
+        index (dict, optional): The int or slice of the revised region along some dimensions,
+            e.g. dict(lsmlat=0, lsmlon=0, numurbl=2). Default is None, the whole variables.
+        block_size (int): The number of records along the first dimension revised at once.
+            Default is 744, one month of hourly data.
+        journal (bool): Save the original values before the revision. Default is True.
+            False for a file that can be thrown away if the revision fails, e.g. a fresh copy.
+
+    Returns:
+        str: The path to the NetCDF file.
+    """
+
+    if not action:
+        return path
+    modes = mode if isinstance(mode, dict) else {name: mode for name in action}
+    for name in action:
+        if modes.get(name) not in ('add', 'scale', 'replace'):
+            raise ValueError(f"The mode of {name} should be 'add', 'scale' or 'replace', got {modes.get(name)}.")
+
+    recover_netcdf(path)
+    use_journal = journal
+    journal = journal_path(path)
+
+    try:
+        with netCDF4.Dataset(path, 'r+') as nc:
+            for name in action:
+                if name not in nc.variables:
+                    raise ValueError(f"The variable {name} is not in the file {path}.")
+
+            # save the original values of the touched region before the first write
+            if use_journal:
+                _write_journal(nc, action, index, block_size, journal)
+
+            for name, value in action.items():
+                var = nc.variables[name]
+                region = _region(var, index)
+                value = np.broadcast_to(np.asarray(value, dtype=np.float64), _region_shape(var, region))
+                for block, part in _blocks(var, region, block_size):
+                    if modes[name] == 'add':
+                        var[block] = var[block] + value[part]
+                    elif modes[name] == 'scale':
+                        var[block] = var[block] * value[part]
+                    else:
+                        var[block] = value[part]
+    except BaseException:
+        # a revision that failed half way is rolled back to the original values
+        if os.path.exists(journal):
+            recover_netcdf(path)
+        raise
+
+    if use_journal:
+        os.remove(journal)
+    return path
@@ -13,11 +13,12 @@ class pts_clmu(clumapp):
                  output_path: str = "outputfolder",
                  log_path: str = "logfolder",
                  scripts_path: str = "scriptsfolder",
-                 container_type: str = "docker") -> None:
+                 container_type: str = "docker",
+                 native_paths: Union[dict, str] = None) -> None:
         
         super().__init__(pwd=pwd, input_path=input_path, 
                          output_path=output_path, log_path=log_path, scripts_path=scripts_path, 
-                         container_type=container_type)
+                         container_type=container_type, native_paths=native_paths)
 
         with open(os.path.join(os.path.dirname(__file__), "config/config_man.json"), 'r') as f:
             self.caseconfig = json.load(f)
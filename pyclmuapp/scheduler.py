@@ -0,0 +1,449 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import traceback
+import subprocess
+from typing import Union
+
+# The directives of each batch scheduler. The index of an array task is mapped to a case
+# through the TASKS list of the script, so a subset of the cases (e.g. the failed ones)
+# can be submitted again as a new array.
+SCHEDULERS = {
+    "slurm": {
+        "submit": ["sbatch", "--parsable"],
+        "directives": ["#SBATCH --job-name={job_name}",
+                       "#SBATCH --array=0-{last}{limit}",
+                       "#SBATCH --output={logs}/%x_%A_%a.log"],
+        "limit": "%{}",
+        "index": "SLURM_ARRAY_TASK_ID",
+        "job": "SLURM_ARRAY_JOB_ID",
+        "first": 0,
+    },
+    "pbs": {
+        "submit": ["qsub"],
+        "directives": ["#PBS -N {job_name}",
+                       "#PBS -J 0-{last}",
+                       "#PBS -j oe",
+                       "#PBS -o {logs}/"],
+        "limit": None,
+        "index": "PBS_ARRAY_INDEX",
+        "job": "PBS_JOBID",
+        "first": 0,
+    },
+    "sge": {
+        "submit": ["qsub"],
+        "directives": ["#$ -N {job_name}",
+                       "#$ -t 1-{count}{limit}",
+                       "#$ -j y",
+                       "#$ -o {logs}/"],
+        "limit": " -tc {}",
+        "index": "SGE_TASK_ID",
+        "job": "JOB_ID",
+        "first": 1,
+    },
+}
+
+# the status of a task is given by its marker file in pwd/status
+_markers = ('done', 'failed', 'running')
+
+# the seconds between two touches of the running marker of a task, see `run_task`
+HEARTBEAT = 60
+
+
+class job_array:
+
+    """
+    Run a list of usp or pts cases as a job array of a batch scheduler (Slurm, PBS or SGE).
+
+    The cases are saved in pwd/tasks.json, and a job array script (pwd/job_array.sh) runs one case
+    per array task with `run_task`, in its own working directory (pwd/cases/<name>).
+    The usp cases share one scripts folder (pwd/scriptsfolder), so the model is built once
+    for the array, see `pyclmuapp.usp.usp_clmu.build_case_name`.
+    Each task leaves a marker file in pwd/status, <i>.running while it runs, then <i>.done with
+    the list of its output files, or <i>.failed with the error. The status and the outputs of
+    the array are read from the markers, so they can be checked from any node, e.g. after the
+    submitting session is closed (`job_array.load`).
+    The running marker has the scheduler job and task ids of the task, and is touched every
+    HEARTBEAT seconds while the task runs. A task killed by the scheduler (time limit, memory,
+    node failure) stops touching it, and the case is taken as failed once its marker is `stale`.
+
+    Examples:
+        >>> jobs = job_array(cases, forcing="forcing.nc", container_type="singularity",
+        ...                  directives=["#SBATCH --time=02:00:00"], setup=["source activate pyclmuapp"])
+        >>> jobs.submit()
+        >>> jobs.wait()
+        >>> outputs = jobs.outputs()
+        >>> jobs.submit(jobs.failed())  # run the failed cases again
+
+    Args:
+        cases (list): The cases, a dict per task.
+            - kind "usp": the scenarios of `pyclmuapp.ensemble.usp_ensemble` ("name", "surf", "surf_mode",
+              "forcing" and "run"), with the optional inputs of the case "forcing_file", "surfdata" and "domain".
+            - kind "pts": the case configurations of `pyclmuapp.pts.pts_clmu.run`, named by their "case_name".
+        pwd (str): The folder of the job array. The default is pwd+"jobarray".
+        kind (str): "usp" for `usp_clmu` cases or "pts" for `pts_clmu` cases. The default is "usp".
+        scheduler (str): "slurm", "pbs" or "sge". The default is "slurm".
+        container_type (str): The type of the container of the tasks, see `pyclmuapp.container.clumapp`.
+            The default is "singularity".
+        forcing (str, optional): The path to the forcing data file of the usp cases without "forcing_file".
+        surfdata (str, optional): The path to the surface data file of the usp cases without "surfdata".
+        domain (str, optional): The path to the domain data file of the usp cases without "domain".
+        job_name (str): The name of the job. The default is "pyclmuapp".
+        directives (list, optional): More scheduler directives, e.g. ["#SBATCH --time=02:00:00"].
+        setup (list, optional): The shell lines run before each task, e.g. ["module load singularity"].
+        max_concurrent (int, optional): The maximum number of tasks running at once (slurm and sge).
+        python (str): The python of the tasks. The default is the python of this session.
+        **run_kwargs: The arguments of `usp_clmu.run` shared by all the usp cases.
+
+    Attributes:
+        pwd (str): The folder of the job array.
+        names (list): The name of each case.
+        script (str): The path to the job array script.
+        config (dict): The cases and the settings of the job array, as saved in tasks.json.
+        job_ids (list): The ids of the submitted jobs, also saved in tasks.json.
+    """
+
+    def __init__(self,
+                 cases: list,
+                 pwd: str = os.path.join(os.getcwd(), 'jobarray'),
+                 kind: str = "usp",
+                 scheduler: str = "slurm",
+                 container_type: str = "singularity",
+                 forcing: str = None,
+                 surfdata: str = None,
+                 domain: str = None,
+                 job_name: str = "pyclmuapp",
+                 directives: list = None,
+                 setup: list = None,
+                 max_concurrent: int = None,
+                 python: str = sys.executable,
+                 **run_kwargs):
+
+        if kind not in ("usp", "pts"):
+            raise ValueError(f"The kind should be 'usp' or 'pts', got {kind}.")
+        if scheduler not in SCHEDULERS:
+            raise ValueError(f"The scheduler should be one of {list(SCHEDULERS)}, got {scheduler}.")
+
+        cases = [case.to_dict() if hasattr(case, 'to_dict') else dict(case) for case in cases]
+        if kind == "usp":
+            from pyclmuapp.ensemble import member_names
+            names = member_names(cases, run_kwargs)
+            for name, case in zip(names, cases):
+                if case.get('forcing_file', forcing) is None:
+                    raise ValueError(f"The forcing data of the case {name} is not provided.")
+        else:
+            names = [case['case_name'] for case in cases]
+            if len(set(names)) != len(names):
+                raise ValueError("The case_name of the pts cases should be unique.")
+
+        self.config = {
+            "kind": kind,
+            "container_type": container_type,
+            "forcing": _abspath(forcing),
+            "surfdata": _abspath(surfdata),
+            "domain": _abspath(domain),
+            "run": run_kwargs,
+            "names": names,
+            "cases": cases,
+            "scheduler": scheduler,
+            "job_name": job_name,
+            "directives": list(directives or []),
+            "setup": list(setup or []),
+            "max_concurrent": max_concurrent,
+            "python": python,
+            # the tasks run from this folder, e.g. where the singularity image is
+            "workdir": os.getcwd(),
+            "job_ids": [],
+        }
+        self._attach(pwd)
+
+        for folder in ('status', 'logs', 'cases'):
+            os.makedirs(os.path.join(self.pwd, folder), exist_ok=True)
+        self._save()
+
+    def _save(self) -> None:
+        tmp = os.path.join(self.pwd, 'tasks.json.part')
+        with open(tmp, 'w') as f:
+            json.dump(self.config, f, indent=2, default=_to_json)
+        os.replace(tmp, os.path.join(self.pwd, 'tasks.json'))
+
+    @classmethod
+    def load(cls, pwd: str) -> 'job_array':
+        """
+        The job array of a folder, to check the status and the outputs of its tasks.
+
+        Args:
+            pwd (str): The folder of the job array.
+
+        Returns:
+            job_array: The job array.
+        """
+        self = cls.__new__(cls)
+        with open(os.path.join(pwd, 'tasks.json')) as f:
+            self.config = json.load(f)
+        self._attach(pwd)
+        return self
+
+    def _attach(self, pwd: str) -> None:
+        self.pwd = os.path.abspath(pwd)
+        self.names = self.config['names']
+        self.scheduler = self.config['scheduler']
+        self.script = os.path.join(self.pwd, 'job_array.sh')
+        self.job_ids = self.config.setdefault('job_ids', [])
+
+    def write(self, indices: list = None) -> str:
+        """
+        Write the job array script.
+
+        Args:
+            indices (list, optional): The indices of the cases to run. The default is None, all the cases.
+
+        Returns:
+            str: The path to the script.
+        """
+        if indices is None:
+            indices = list(range(len(self.names)))
+        if not indices:
+            raise ValueError("No case to run.")
+        spec = SCHEDULERS[self.scheduler]
+        limit = ""
+        if self.config['max_concurrent'] is not None and spec['limit'] is not None:
+            limit = spec['limit'].format(int(self.config['max_concurrent']))
+        values = dict(job_name=self.config['job_name'], last=len(indices) - 1, count=len(indices),
+                      limit=limit, logs=os.path.join(self.pwd, 'logs'))
+        lines = ["#!/bin/bash"]
+        lines += [d.format(**values) for d in spec['directives']]
+        lines += self.config['directives']
+        lines += [""] + self.config['setup']
+        lines += [
+            f"TASKS=({' '.join(str(int(i)) for i in indices)})",
+            f"TASK=${{TASKS[$(( ${spec['index']} - {spec['first']} ))]}}",
+            f"cd '{self.config['workdir']}'",
+            f"'{self.config['python']}' -c \"from pyclmuapp.scheduler import run_task; run_task('{self.pwd}', $TASK)\"",
+            "",
+        ]
+        tmp = self.script + '.part'
+        with open(tmp, 'w') as f:
+            f.write("\n".join(lines))
+        os.chmod(tmp, 0o755)
+        os.replace(tmp, self.script)
+        return self.script
+
+    def submit(self,
+               indices: list = None,
+               submit_command: Union[str, list] = None) -> str:
+        """
+        Write the job array script and submit it.
+
+        The markers of the submitted cases are removed first, so the cases run again.
+
+        Args:
+            indices (list, optional): The indices of the cases to run, e.g. `failed()`. The default is None, all the cases.
+            submit_command (str or list, optional): The submit command. The default is the command of
+                the scheduler, e.g. ["sbatch", "--parsable"].
+
+        Returns:
+            str: The id of the job.
+        """
+        if indices is None:
+            indices = list(range(len(self.names)))
+        script = self.write(indices)
+        for i in indices:
+            for marker in _markers:
+                path = self._marker(i, marker)
+                if os.path.exists(path):
+                    os.remove(path)
+        if submit_command is None:
+            submit_command = SCHEDULERS[self.scheduler]['submit']
+        if isinstance(submit_command, str):
+            submit_command = [submit_command]
+        result = subprocess.run(list(submit_command) + [script], text=True, check=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        job_id = result.stdout.strip().split(';')[0]
+        self.job_ids.append(job_id)
+        self._save()
+        print(f"Submitted the job array {job_id} of {len(indices)} cases.")
+        return job_id
+
+    def _marker(self, i: int, marker: str) -> str:
+        return os.path.join(self.pwd, 'status', f'{i}.{marker}')
+
+    def status(self, stale: float = 5 * HEARTBEAT) -> dict:
+        """
+        The status of each case: "pending", "running", "done" or "failed".
+
+        Args:
+            stale (float): The seconds after which a running marker that is not touched any more
+                is taken as a killed task, so the case is "failed". The default is 5 * HEARTBEAT.
+
+        Returns:
+            dict: The status of each case, keyed by name.
+        """
+        status = {}
+        now = time.time()
+        for i, name in enumerate(self.names):
+            status[name] = "pending"
+            for marker in _markers:
+                path = self._marker(i, marker)
+                try:
+                    touched = os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                status[name] = marker
+                if marker == "running" and now - touched > stale:
+                    status[name] = "failed"
+                break
+        return status
+
+    def failed(self, stale: float = 5 * HEARTBEAT) -> list:
+        """
+        The indices of the failed cases, with the killed ones, see `status`.
+        """
+        return [i for i, s in enumerate(self.status(stale=stale).values()) if s == "failed"]
+
+    def running(self) -> dict:
+        """
+        The running markers of the running cases, with the host, pid and scheduler ids of each task.
+
+        Returns:
+            dict: The content of the running marker of each running case, keyed by name.
+        """
+        running = {}
+        for i, name in enumerate(self.names):
+            try:
+                with open(self._marker(i, 'running')) as f:
+                    running[name] = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+        return running
+
+    def wait(self,
+             interval: float = 30,
+             timeout: float = None,
+             stale: float = 5 * HEARTBEAT) -> dict:
+        """
+        Wait until all the cases are done or failed.
+
+        Args:
+            interval (float): The seconds between two checks. The default is 30.
+            timeout (float, optional): The maximum seconds to wait. The default is None, no limit.
+            stale (float): The seconds after which a case killed by the scheduler is failed, see `status`.
+
+        Returns:
+            dict: The status of each case, see `status`.
+        """
+        start = time.time()
+        while True:
+            status = self.status(stale=stale)
+            if all(s in ("done", "failed") for s in status.values()):
+                return status
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f"The job array in {self.pwd} is not finished after {timeout} seconds.")
+            time.sleep(interval)
+
+    def outputs(self) -> dict:
+        """
+        The output files of each case. A case that is not done has an empty list.
+
+        Returns:
+            dict: The list of the output files of each case, keyed by name.
+        """
+        outputs = {}
+        for i, name in enumerate(self.names):
+            path = self._marker(i, 'done')
+            if os.path.exists(path):
+                with open(path) as f:
+                    outputs[name] = json.load(f)['outputs']
+            else:
+                outputs[name] = []
+        return outputs
+
+
+def _abspath(path: str) -> Union[str, None]:
+    return None if path is None else os.path.abspath(path)
+
+
+def _to_json(value):
+    # the arrays of the surface revisions and the perturbations
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"The value {value!r} of a case can not be saved in tasks.json.")
+
+
+def _write_marker(path: str, content: dict) -> None:
+    tmp = path + '.part'
+    with open(tmp, 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _heartbeat(path: str, stop: threading.Event, interval: float) -> None:
+    # touch the running marker until the task ends, see `job_array.status`
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return
+
+
+def run_task(pwd: str, index: int) -> list:
+    """
+    Run a case of a job array, in its task of the scheduler, see `job_array`.
+
+    Args:
+        pwd (str): The folder of the job array.
+        index (int): The index of the case.
+
+    Returns:
+        list: The output files of the case.
+    """
+
+    with open(os.path.join(pwd, 'tasks.json')) as f:
+        config = json.load(f)
+    name = config['names'][index]
+    case = config['cases'][index]
+    status = os.path.join(pwd, 'status')
+    running = os.path.join(status, f'{index}.running')
+    spec = SCHEDULERS[config['scheduler']]
+    _write_marker(running, {"name": name, "host": socket.gethostname(), "pid": os.getpid(),
+                            "job_id": os.environ.get(spec['job']),
+                            "task_id": os.environ.get(spec['index']),
+                            "start": time.strftime("%Y-%m-%d %H:%M:%S")})
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(running, stop, HEARTBEAT), daemon=True).start()
+    try:
+        case_pwd = os.path.join(pwd, 'cases', name)
+        if config['kind'] == "usp":
+            from pyclmuapp.ensemble import stage_member
+            # the usp cases share a scripts folder, and so the built case, see `usp_clmu.build_case_name`
+            member = stage_member(case_pwd, case,
+                                  forcing=case.get('forcing_file', config['forcing']),
+                                  surfdata=case.get('surfdata', config['surfdata']),
+                                  domain=case.get('domain', config['domain']),
+                                  container_type=config['container_type'],
+                                  scripts_path=os.path.join(pwd, 'scriptsfolder'))
+            kwargs = dict(config['run'], **case.get('run', {}))
+            if 'case_name' not in case.get('run', {}):
+                # a shared case_name is the prefix of the case names, as in `usp_ensemble`
+                kwargs['case_name'] = f"{config['run']['case_name']}_{name}" if 'case_name' in config['run'] else name
+            outputs = member.run(**kwargs)
+        else:
+            from pyclmuapp.pts import pts_clmu
+            app = pts_clmu(pwd=case_pwd, container_type=config['container_type'])
+            outputs = app.run(caseconfig=case, cmdlogfile=os.path.join(case_pwd, "dockercmd.log"))
+        if not outputs:
+            # the failures of the model runs are logged, not raised
+            raise RuntimeError(f"The case {name} has no output file, see the logs in {case_pwd}.")
+    except BaseException:
+        stop.set()
+        _write_marker(os.path.join(status, f'{index}.failed'), {"name": name, "error": traceback.format_exc()})
+        os.remove(running)
+        raise
+    stop.set()
+    _write_marker(os.path.join(status, f'{index}.done'), {"name": name, "outputs": outputs})
+    os.remove(running)
+    return outputs
+
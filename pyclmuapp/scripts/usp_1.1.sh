@@ -133,30 +133,59 @@ export SURF=${ctsm_input}/usp/${SURF}
 # --------------------------------Input--------------------------------
 
 # --------------------------------Setting--------------------------------
-# Create a new case
-cd ${CASESRPITS}
-if [ -d ${case_name} ]; then
-   echo "The case ${case_name} already exists."
-   cd ${case_name}
-else
-   ./create_newcase --case ${case_name} --res CLM_USRDAT --compset 2000_DATM%1PT_CLM50%SP_SICE_SOCN_SROF_SGLC_SWAV --run-unsupported
-   cd ${case_name}
+# Create and build a new case
+new_case() {
+   ./create_newcase --case $1 --res CLM_USRDAT --compset ${COMPSET} --run-unsupported
+   cd $1
    echo "domainfile='$ATMDOM_PATH/$ATMDOM_FILE'" >> user_nl_datm
    echo "fsurdat='${SURF}'" >> user_nl_clm
    echo "hist_avgflag_pertape='A'" >> user_nl_clm
    echo "hist_nhtfrq=1000000000" >> user_nl_clm
    echo "hist_mfilt=1" >> user_nl_clm
-   cp ${ctsm_input}/usp/SourceMods/src.clm/* ${case_name}/SourceMods/src.clm/
+   cp ${ctsm_input}/usp/SourceMods/src.clm/* $1/SourceMods/src.clm/
 
    ./xmlchange DATM_MODE=CLM1PT
    # Set up the case
    ./xmlchange NTASKS=1
    ./xmlchange CALENDAR=GREGORIAN # or NOLEAP
+   # the executable of a built case is kept in the case itself ($2), in the scripts folder,
+   # instead of the CaseOutputs of the app that built it, so every app that mounts the folder can clone it
+   if [ -n "$2" ]; then
+      ./xmlchange EXEROOT=$2
+   fi
    #./xmlchange CLM_USRDAT_NAME=${GRIDNAME}
    #./xmlchange DIN_LOC_ROOT_CLMFORC=${FORCING_PATH}
    ./case.setup
    ./case.build
+   cd ${CASESRPITS}
+}
 
+export COMPSET=2000_DATM%1PT_CLM50%SP_SICE_SOCN_SROF_SGLC_SWAV
+cd ${CASESRPITS}
+if [ -d ${case_name} ]; then
+   echo "The case ${case_name} already exists."
+   cd ${case_name}
+elif [ -n "${BUILD_CASE}" ]; then
+   # BUILD_CASE is a built case of the same compset, SourceMods and image (set by pyclmuapp).
+   # It is built once, and the new case is a clone that uses its executable,
+   # so only the run-time settings below are changed.
+   export BUILD_ROOT=/p/scripts/${BUILD_CASE}
+   (
+      flock 9
+      if [ ! -d ${BUILD_ROOT} ] || [ "$(cd ${BUILD_ROOT} && ./xmlquery --value BUILD_COMPLETE)" != "TRUE" ]; then
+         echo "Building the case ${BUILD_CASE}."
+         rm -rf ${BUILD_ROOT} ${CESMDATAROOT}/CaseOutputs/${BUILD_CASE}
+         new_case ${BUILD_ROOT} ${BUILD_ROOT}/bld
+      fi
+   ) 9>/p/scripts/.${BUILD_CASE}.lock
+   ./create_clone --clone ${BUILD_ROOT} --case ${case_name} --keepexe
+   cd ${case_name}
+   sed -i "/^domainfile=/d" user_nl_datm
+   echo "domainfile='$ATMDOM_PATH/$ATMDOM_FILE'" >> user_nl_datm
+   ./case.setup
+else
+   new_case ${case_name}
+   cd ${case_name}
 fi
 
 #./preview_namelists
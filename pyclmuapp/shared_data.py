@@ -0,0 +1,63 @@
+import os
+import threading
+import xarray as xr
+
+_handles = {}
+_lock = threading.Lock()
+
+
+def _key(path: str) -> tuple:
+    """
+    The identity of a file: a file replaced on disk gets a new handle.
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime
+
+
+def open_shared(path: str,
+                chunks=None) -> xr.Dataset:
+    """
+    Open a global input dataset (e.g. the urban properties or the soil texture) once per process.
+
+    The file is opened lazily, and with dask chunks when dask is installed, so nothing is read
+    until a cell is selected. The LAT and LON variables are set once as the lat and lon index
+    coordinates, so the following nearest selections reuse the same indexes.
+    The same dataset is returned to every caller until the file changes on disk.
+
+    Args:
+        path (str): The path to the NetCDF file.
+        chunks (dict, optional): The dask chunks. Default is the chunks of the file when dask is installed.
+
+    Returns:
+        xarray.Dataset: The shared dataset.
+    """
+    key = _key(path)
+    with _lock:
+        ds = _handles.get(key)
+        if ds is not None:
+            return ds
+        if chunks is None:
+            try:
+                import dask
+                chunks = {}
+            except ImportError:
+                chunks = None
+        ds = xr.open_dataset(path, chunks=chunks)
+        if 'LAT' in ds.variables and 'LON' in ds.variables \
+                and ds['LAT'].dims == ('lat',) and ds['LON'].dims == ('lon',):
+            ds = ds.assign_coords(lat=ds.LAT.load(), lon=ds.LON.load())
+        # the previous handles of a replaced file are closed
+        for old in [k for k in _handles if k[0] == key[0]]:
+            _handles.pop(old).close()
+        _handles[key] = ds
+        return ds
+
+
+def close_shared() -> None:
+    """
+    Close all the shared datasets.
+    """
+    with _lock:
+        for ds in _handles.values():
+            ds.close()
+        _handles.clear()
@@ -0,0 +1,228 @@
+import os
+import json
+import hashlib
+import numpy as np
+import xarray as xr
+from typing import Union
+from pyclmuapp.cache import cache_root
+from pyclmuapp.shared_data import open_shared, _key
+
+
+class soil_index:
+
+    """
+    A spatial index of the soil cells with valid (non-zero) sand and clay content.
+
+    The validity of every cell of the soil texture grid (e.g. mksrf_soitex.10level.c010119.nc) is
+    computed once, from the sand and clay of each map unit, and kept as a bit-packed mask.
+    The nearest valid cell of a site is then found with one search in the mask, instead of
+    one `sel` per candidate cell. The mask is saved in the cache folder and memory-mapped
+    when the same soil file is used again.
+
+    Args:
+        ds (xr.Dataset or str): the soil dataset, with MAPUNITS (lat, lon), LAT, LON,
+            PCT_SAND and PCT_CLAY (max_value_mapunit and soil layers).
+        cache_dir (str, optional): the folder of the saved masks. Default is the pyclmuapp cache folder,
+            see `pyclmuapp.cache.cache_root`. False to keep the mask in memory only.
+        block_size (int): the number of grid rows read at once when the mask is built. Default is 1024.
+
+    Attributes:
+        ds (xr.Dataset): the soil dataset.
+        lats (np.ndarray): the latitudes of the grid.
+        lons (np.ndarray): the longitudes of the grid.
+        mask (np.ndarray): the bit-packed mask of the valid cells, (lat, ceil(lon / 8)).
+        path (str or None): the file of the saved mask.
+    """
+
+    def __init__(self,
+                 ds: Union[xr.Dataset, str],
+                 cache_dir: Union[str, bool] = None,
+                 block_size: int = 1024):
+
+        if isinstance(ds, str):
+            ds = open_shared(ds)
+        self.ds = ds
+        self.lats = np.asarray(ds['LAT'].values, dtype=float)
+        self.lons = np.asarray(ds['LON'].values, dtype=float)
+        self.shape = (self.lats.size, self.lons.size)
+        self.block_size = block_size
+
+        # the position of each map unit label, and if its sand and clay are valid
+        sand = ds['PCT_SAND'].transpose('max_value_mapunit', ...).values
+        clay = ds['PCT_CLAY'].transpose('max_value_mapunit', ...).values
+        nunit = sand.shape[0]
+        if 'max_value_mapunit' in ds.coords:
+            labels = ds['max_value_mapunit'].values.astype(np.int64)
+        else:
+            labels = np.arange(nunit)
+        valid = (sand.reshape(nunit, -1) != 0).any(axis=1) & (clay.reshape(nunit, -1) != 0).any(axis=1)
+        self._position = np.full(labels.max() + 1, -1, dtype=np.int64)
+        self._position[labels] = np.arange(nunit)
+        self._valid = np.zeros(labels.max() + 1, dtype=bool)
+        self._valid[labels] = valid
+
+        self.path = None
+        if cache_dir is not False:
+            key = self._fingerprint()
+            if key is not None:
+                folder = cache_root() if cache_dir in (None, True) else cache_dir
+                self.path = os.path.join(folder, f'soil_index_{key}.npy')
+
+        if self.path is not None and os.path.exists(self.path):
+            self.mask = np.load(self.path, mmap_mode='r')
+        else:
+            self.mask = self._build()
+            if self.path is not None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = f'{self.path}.{os.getpid()}.part'
+                with open(tmp, 'wb') as f:
+                    np.save(f, self.mask)
+                os.replace(tmp, self.path)
+
+    def _fingerprint(self) -> Union[str, None]:
+        """
+        The key of the saved mask: the soil file, its size and modification time. None for in-memory data.
+        """
+        source = self.ds.encoding.get('source')
+        if not source or not os.path.exists(source):
+            return None
+        stat = os.stat(source)
+        params = {'source': os.path.abspath(source), 'size': stat.st_size,
+                  'mtime': stat.st_mtime, 'shape': list(self.shape)}
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:32]
+
+    def _is_valid(self, mapunits: np.ndarray) -> np.ndarray:
+        """
+        The validity of the cells of a block of map units. Unknown map units are not valid.
+        """
+        mapunits = np.nan_to_num(np.asarray(mapunits, dtype=float), nan=-1).astype(np.int64)
+        inside = (mapunits >= 0) & (mapunits < self._valid.size)
+        return inside & self._valid[np.where(inside, mapunits, 0)]
+
+    def _build(self) -> np.ndarray:
+        """
+        Build the bit-packed mask of the valid cells, block by block along lat.
+        """
+        mapunits = self.ds['MAPUNITS'].transpose('lat', 'lon')
+        nlat, nlon = self.shape
+        mask = np.empty((nlat, (nlon + 7) // 8), dtype=np.uint8)
+        for i0 in range(0, nlat, self.block_size):
+            i1 = min(i0 + self.block_size, nlat)
+            block = mapunits.isel(lat=slice(i0, i1)).values
+            mask[i0:i1] = np.packbits(self._is_valid(block), axis=1)
+        return mask
+
+    def _window(self, i0, i1, j0, j1) -> np.ndarray:
+        """
+        The unpacked mask of the rows i0:i1 and the columns j0:j1.
+        """
+        b0 = j0 // 8
+        bits = np.unpackbits(np.asarray(self.mask[i0:i1, b0:(j1 + 7) // 8]), axis=1)
+        return bits[:, j0 - b0 * 8:j1 - b0 * 8].astype(bool)
+
+    def nearest(self, lat: float, lon: float) -> tuple:
+        """
+        Find the nearest valid soil cell of a point.
+
+        Args:
+            lat (float): latitude of interest point
+            lon (float): longitude of interest point
+
+        Returns:
+            tuple: (i, j), the lat and lon indices of the cell.
+        """
+        i0 = int(np.abs(self.lats - lat).argmin())
+        j0 = int(np.abs(self.lons - lon).argmin())
+        nlat, nlon = self.shape
+        radius = 8
+        while True:
+            r0, r1 = max(i0 - radius, 0), min(i0 + radius + 1, nlat)
+            c0, c1 = max(j0 - radius, 0), min(j0 + radius + 1, nlon)
+            ii, jj = np.nonzero(self._window(r0, r1, c0, c1))
+            whole = (r0, r1, c0, c1) == (0, nlat, 0, nlon)
+            if ii.size:
+                dist2 = (ii + r0 - i0)**2 + (jj + c0 - j0)**2
+                k = int(dist2.argmin())
+                # a closer valid cell may be outside the window if the nearest one is not within the radius
+                if dist2[k] <= radius**2 or whole:
+                    return int(ii[k] + r0), int(jj[k] + c0)
+            elif whole:
+                raise ValueError("No soil cell with valid sand and clay in the soil dataset.")
+            radius *= 4
+
+    def query(self, lat: float, lon: float) -> tuple:
+        """
+        Get the sand and clay content of the nearest valid soil cell of a point.
+
+        Args:
+            lat (float): latitude of interest point
+            lon (float): longitude of interest point
+
+        Returns:
+            tuple: sand and clay content from the soil dataset
+        """
+        i, j = self.nearest(lat, lon)
+        unit = int(self.ds['MAPUNITS'].transpose('lat', 'lon')[i, j].values)
+        pos = int(self._position[unit])
+        sand = self.ds['PCT_SAND'].isel(max_value_mapunit=pos).values
+        clay = self.ds['PCT_CLAY'].isel(max_value_mapunit=pos).values
+        print(f'Found suitable point at lat: {self.lats[i]}, lon: {self.lons[j]}')
+        return sand, clay
+
+    def query_many(self, lats: np.ndarray, lons: np.ndarray) -> tuple:
+        """
+        Get the sand and clay content of the nearest valid soil cells of many points at once.
+
+        The nearest cell of each point is searched in the mask, then the map units, the sand
+        and the clay of all the points are read with one pointwise selection each.
+
+        Args:
+            lats (np.ndarray): latitudes of the points
+            lons (np.ndarray): longitudes of the points
+
+        Returns:
+            tuple: sand and clay content, one row per point
+        """
+        points = list(zip(np.asarray(lats, dtype=float).ravel(), np.asarray(lons, dtype=float).ravel()))
+        # the sites of the same point are searched once
+        cells = {}
+        for point in points:
+            if point not in cells:
+                cells[point] = self.nearest(*point)
+        ii, jj = np.array([cells[point] for point in points], dtype=np.int64).reshape(-1, 2).T
+        units = self.ds['MAPUNITS'].transpose('lat', 'lon').isel(
+            lat=xr.DataArray(ii, dims='site'), lon=xr.DataArray(jj, dims='site')).values
+        pos = xr.DataArray(self._position[units.astype(np.int64)], dims='site')
+        sand = self.ds['PCT_SAND'].isel(max_value_mapunit=pos).transpose('site', ...).values
+        clay = self.ds['PCT_CLAY'].isel(max_value_mapunit=pos).transpose('site', ...).values
+        print(f'Found suitable points for {len(points)} sites')
+        return sand, clay
+
+
+_indexes = {}
+
+
+def get_soil_index(ds: Union[xr.Dataset, str],
+                   cache_dir: Union[str, bool] = None) -> soil_index:
+    """
+    Get the soil index of a soil dataset, built once per dataset and cache folder
+    and shared by all the sites of a session.
+
+    Args:
+        ds (xr.Dataset or str): the soil dataset or the path to it
+        cache_dir (str, optional): the folder of the saved masks, see `soil_index`.
+
+    Returns:
+        soil_index: the index of the dataset
+    """
+    if isinstance(cache_dir, str):
+        cache_dir = os.path.abspath(cache_dir)
+    elif cache_dir is not False:
+        # True is the default cache folder, as None
+        cache_dir = None
+    key = (_key(ds) if isinstance(ds, str) else id(ds), cache_dir)
+    index = _indexes.get(key)
+    if index is None or (not isinstance(ds, str) and index.ds is not ds):
+        index = soil_index(ds, cache_dir=cache_dir)
+        _indexes[key] = index
+    return index
@@ -1,5 +1,8 @@
 import os
 import sys
+import json
+import inspect
+import hashlib
 from typing import Union
 import shutil
 import pandas as pd
@@ -9,6 +12,11 @@ from pyclmuapp.clmu import *
 from pyclmuapp.getcity import *
 from datetime import datetime
 from pyclmuapp.container import clumapp
+from pyclmuapp.nc_patch import patch_netcdf
+from pyclmuapp.forcing_io import perturb_forcing
+
+# the compset of the usp cases, see scripts/usp_1.1.sh
+USP_COMPSET = "2000_DATM%1PT_CLM50%SP_SICE_SOCN_SROF_SGLC_SWAV"
 
 class usp_clmu(clumapp):
 
@@ -18,11 +26,12 @@ class usp_clmu(clumapp):
                  output_path: str = "outputfolder",
                  log_path: str = "logfolder",
                  scripts_path: str = "scriptsfolder",
-                 container_type: str = "docker") -> None:
+                 container_type: str = "docker",
+                 native_paths: Union[dict, str] = None) -> None:
         
         super().__init__(pwd=pwd, input_path=input_path, 
                          output_path=output_path, log_path=log_path, scripts_path=scripts_path, 
-                         container_type=container_type)
+                         container_type=container_type, native_paths=native_paths)
 
         if container_type == "singularity":
             shutil.copytree(os.path.join(os.path.dirname(__file__), 'config', 'cime_config'), 
@@ -48,6 +57,9 @@ class usp_clmu(clumapp):
         self.urban_vars_list = [value for sublist in self.urban_vars_dict.values() for value in sublist]
 
         self.create_folder(os.path.join(self.input_path, 'usp'))
+        # the surface data is kept in memory and written once before the run, see `flush_surf`
+        self._surf = None
+        self._surf_pending = False
         # get the default surface data --> UK King's College London
         self.check_surf()
         
@@ -100,7 +112,11 @@ class usp_clmu(clumapp):
             dict: The dictionary of the surface data for the urban surface parameters.
         """
 
+        self._switch_surf(surfata_name)
         surfdata = self._open_nc(usr_surfdata, "surfdata")
+        # the single point file is small, it is read once and the file is closed
+        surfdata.load()
+        surfdata.close()
 
         output = {}
         for var in self.urban_vars_list:
@@ -151,14 +167,8 @@ class usp_clmu(clumapp):
         ncfile_path = os.path.join(self.input_path, ncfile)
         #self.surfdata = ncfile_path.split("/")[-1]
         self.surfdata = os.path.split(ncfile_path)[-1]
-        
-        if os.path.exists(ncfile_path):
-            os.remove(ncfile_path)
-        # Save the file
-        surfdata.to_netcdf(ncfile_path)
-        surfdata.close()
-        del surfdata
-        gc.collect()
+        self._surf = surfdata
+        self._surf_pending = True
 
         return output
         
@@ -181,14 +191,25 @@ class usp_clmu(clumapp):
             urban_type (int): The type of the urban surface. The default is 2. 0 is for TBD urban, 1 is for HD urban, and 2 is for MD urban.
         Returns:
             None
+
+        Note:
+            The revision is made in memory. The file is written once by `flush_surf`,
+            which `run` calls before the simulation.
         """
 
         #surfdata = self._open_nc(usr_surfdata, "surfdata")
 
+        self._switch_surf(surfata_name)
         if usr_surfdata is not None:
             surfdata = self._open_nc(usr_surfdata, "surfdata")
+            surfdata.load()
+            surfdata.close()
+        elif self._surf is not None:
+            surfdata = self._surf
         else:
             surfdata = self._open_nc(os.path.join(self.input_path, 'usp', self.surfdata), "surfdata")
+            surfdata.load()
+            surfdata.close()
 
         def _check_action(action: dict):
             
@@ -250,13 +271,41 @@ class usp_clmu(clumapp):
         ncfile_path = os.path.join(self.input_path, ncfile)
         #self.surfdata = ncfile_path.split("/")[-1]
         self.surfdata = os.path.split(ncfile_path)[-1]
-        if os.path.exists(ncfile_path):
-            os.remove(ncfile_path)
-        # Save the file
-        surfdata.to_netcdf(ncfile_path)
-        surfdata.close()
-        del surfdata
-        gc.collect()
+        self._surf = surfdata
+        self._surf_pending = True
+
+    def _switch_surf(self, surfata_name: str) -> None:
+        """
+        Write the pending surface data to its file before `check_surf` or `modify_surf` moves to another file,
+        so each file gets the revisions made for it, as if it was written by each call.
+        """
+        if self._surf_pending and os.path.split(surfata_name)[-1] != self.surfdata:
+            self.flush_surf()
+
+    def flush_surf(self) -> str:
+        """
+        Write the surface data kept in memory by `check_surf` and `modify_surf`.
+
+        The file is only written if the data was changed since the last write, or if the file
+        was removed (e.g. by `case_clean` or `clean_usp`), so a series of revisions costs one write before each run.
+        The data in memory is for one file, the last `surfata_name`: the revisions pending for a previous
+        name are written to it when the name changes.
+
+        Returns:
+            str: The path to the surface data file.
+        """
+
+        ncfile_path = os.path.join(self.input_path, 'usp', self.surfdata)
+        if self._surf is None or (not self._surf_pending and os.path.exists(ncfile_path)):
+            return ncfile_path
+        os.makedirs(os.path.dirname(ncfile_path), exist_ok=True)
+        partfile = ncfile_path + '.part'
+        if os.path.exists(partfile):
+            os.remove(partfile)
+        self._surf.to_netcdf(partfile)
+        os.replace(partfile, ncfile_path)
+        self._surf_pending = False
+        return ncfile_path
 
     def check_domain(self,
                     usr_domain: str = None, 
@@ -274,7 +323,10 @@ class usp_clmu(clumapp):
         """
         
         domian_nc = self._open_nc(usr_domain, "domain")
-        surfdata = self._open_nc(os.path.join(self.input_path, 'usp', self.surfdata), "surfdata")
+        if self._surf is not None:
+            surfdata = self._surf
+        else:
+            surfdata = self._open_nc(os.path.join(self.input_path, 'usp', self.surfdata), "surfdata")
         lat = surfdata['LATIXY'].values[0,0]
         lon = surfdata['LONGXY'].values[0,0]
         if lon < 0:
@@ -339,7 +391,8 @@ class usp_clmu(clumapp):
                         usr_forcing: str = None,
                         action: dict = None,
                         mode: str = "add",
-                        forcing_name: str = "forcing.nc") -> None:
+                        forcing_name: str = "forcing.nc",
+                        inplace: bool = True) -> None:
         """
         The function to revise the forcing data for the urban surface parameters.
 
@@ -348,8 +401,33 @@ class usp_clmu(clumapp):
             action (dict): The dictionary of the revised forcing data for the urban surface parameters. The default is None, which means no action.
             mode (str): The mode for the revision. The default is "add".
             forcing_name (str): The name of the revised forcing data file. The default is "forcing.nc".
+            inplace (bool): Revise the variables in the file, see `pyclmuapp.nc_patch.patch_netcdf`.
+                The forcing data is copied to the revised file first if needed. The default is True.
+                False to rewrite the whole file.
         
         """
+        ncfile = f"usp/{forcing_name}"
+        ncfile_path = os.path.join(self.input_path, ncfile)
+        if inplace:
+            source = usr_forcing if usr_forcing is not None else self.forcing_file
+            if source is None:
+                raise ValueError("The forcing data is not provided.")
+            if not os.path.exists(source):
+                raise FileNotFoundError(f"The data file [{source}] is not found.")
+            if os.path.abspath(source) != os.path.abspath(ncfile_path):
+                shutil.copy(source, ncfile_path + '.part')
+                os.replace(ncfile_path + '.part', ncfile_path)
+            self.usr_forcing_file = os.path.split(ncfile_path)[-1]
+            if action is None:
+                return
+            try:
+                patch_netcdf(ncfile_path, action, mode=mode)
+                return
+            except OSError as e:
+                # e.g. the file is still open in this process, the whole file is rewritten
+                print(f"Can not revise {ncfile_path} in place ({e}), rewriting it.")
+                usr_forcing = ncfile_path
+
         if usr_forcing is not None:
             forcing = self._open_nc(usr_forcing, "forcing")
         else:
@@ -366,14 +444,69 @@ class usp_clmu(clumapp):
                 for var in action.keys():
                     forcing[var].values += np.array(action[var], dtype=np.float64)
         
-        ncfile = f"usp/{forcing_name}"
-        ncfile_path = os.path.join(self.input_path, ncfile)
         if os.path.exists(ncfile_path):
             os.remove(ncfile_path)
         forcing.to_netcdf(ncfile_path)
         #self.usr_forcing_file = ncfile_path.split("/")[-1]
         self.usr_forcing_file = os.path.split(ncfile_path)[-1]
 
+    def perturb_forcing(self,
+                        perturbation: dict = None,
+                        forcing_name: str = "forcing.nc") -> str:
+        """
+        The function to use a perturbed copy of the forcing data for the next runs.
+
+        The forcing data given to `check_forcing` is the baseline and is never changed.
+        Each call writes the perturbed copy once, see `pyclmuapp.forcing_io.perturb_forcing`.
+
+        Args:
+            perturbation (dict): The perturbation of each forcing variable, e.g. {"Tair": 1.0} to add 1 K
+                or {"Prectmms": {"scale": 1.1}}. The default is None, which means using the baseline forcing data.
+            forcing_name (str): The name of the perturbed forcing data file. The default is "forcing.nc".
+
+        Returns:
+            str: The path to the forcing data file used by the next runs.
+        """
+        baseline = getattr(self, 'forcing_file', None)
+        if baseline is None:
+            raise ValueError("The forcing data is not provided.")
+        if not perturbation:
+            self.usr_forcing_file = os.path.split(baseline)[-1]
+            return baseline
+
+        ncfile_path = os.path.join(self.input_path, 'usp', forcing_name)
+        if os.path.abspath(ncfile_path) == os.path.abspath(baseline):
+            # the baseline has the same name, e.g. forcing.nc
+            ncfile_path = os.path.join(self.input_path, 'usp', 'perturbed_' + forcing_name)
+        perturb_forcing(baseline, ncfile_path, perturbation)
+        self.usr_forcing_file = os.path.split(ncfile_path)[-1]
+        return ncfile_path
+
+    def build_case_name(self) -> str:
+        """
+        The name of the built case shared by the usp cases with the same compset, SourceMods and image.
+
+        The case is built in the scripts folder the first time it is needed and kept by `case_clean`,
+        so the next cases, also in later sessions, are cloned from it without a new build.
+
+        Returns:
+            str: The name of the built case, "usp_build_<hash>".
+        """
+        sourcemod = os.path.join(self.input_path, 'usp', 'SourceMods')
+        if not os.path.exists(sourcemod):
+            sourcemod = os.path.join(os.path.dirname(__file__), 'usp', 'SourceMods')
+        files = hashlib.sha256()
+        for root, dirs, names in sorted(os.walk(sourcemod)):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                files.update(os.path.relpath(path, sourcemod).encode())
+                with open(path, 'rb') as f:
+                    files.update(f.read())
+        params = {'compset': USP_COMPSET, 'sourcemods': files.hexdigest(), 'image': self.image_name}
+        key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+        return f"usp_build_{key}"
+
     def run(self, 
             output_prefix: str = "_clm.nc",
             case_name: str = "usp_case", 
@@ -395,7 +528,8 @@ class usp_clmu(clumapp):
             hist_nhtfrq: int = 1,
             hist_mfilt: int = 1000000000,
             urban_hac: str = "ON_WASTEHEAT",
-            crun_type : str = "usp") -> list:
+            crun_type : str = "usp",
+            build_cache: bool = True) -> list:
 
         """
         The function to run the CLMU-App for the urban single point simulation.
@@ -441,14 +575,90 @@ class usp_clmu(clumapp):
             crun_type (str):        The type of the run. The default is "usp". 
                                     No need to change this parameter.
                                     Do not change this parameter if you are not sure.
+            build_cache (bool):     The flag to reuse a built case. 
+                                    The default is True. A new case is then cloned from a case built
+                                    once for the same compset, SourceMods and image, see `build_case_name`.
+                                    The built case is kept in the scripts folder, so the apps that share
+                                    a scripts folder (e.g. the members of `pyclmuapp.ensemble.usp_ensemble`)
+                                    share the build. False to build each new case.
+                                    Only the clmu-app 1.1 and 1.2 images support it, it is turned off for the others.
 
         Returns:
             list: The list of the output files names.
         """
 
+        command, crun_type, logfile, case_name = self._run_setup(
+            case_name=case_name, RUN_STARTDATE=RUN_STARTDATE, START_TOD=START_TOD,
+            STOP_OPTION=STOP_OPTION, STOP_N=STOP_N, ATM_DOM=ATM_DOM, SURF=SURF, FORCING=FORCING,
+            RUN_TYPE=RUN_TYPE, RUN_REFCASE=RUN_REFCASE, RUN_REFDATE=RUN_REFDATE, RUN_REFTOD=RUN_REFTOD,
+            logfile=logfile, hist_type=hist_type, hist_nhtfrq=hist_nhtfrq, hist_mfilt=hist_mfilt,
+            urban_hac=urban_hac, crun_type=crun_type, build_cache=build_cache)
+
+        self.docker(cmd=crun_type, iflog=iflog, 
+                    password=password, cmdlogfile=logfile,
+                    dockersript=command)
+
+        return self._run_outputs(output_prefix, case_name, RUN_STARTDATE)
+
+    async def run_async(self,
+                        callback=None,
+                        **kwargs) -> list:
+
+        """
+        The coroutine version of `run`, for several concurrent simulations in one process.
+
+        The container output is streamed line by line to the log file and to `callback` while
+        the model runs, see `pyclmuapp.async_run.stream_command`.
+
+        Examples:
+            >>> async def main():
+            ...     return await asyncio.gather(usp1.run_async(case_name="a"), usp2.run_async(case_name="b"))
+
+        Args:
+            callback (callable, optional): Called with (stream, line) for each output line,
+                stream being "stdout" or "stderr". It may be a coroutine function.
+            **kwargs: The arguments of `run`.
+
+        Returns:
+            list: The list of the output files names.
+
+        Raises:
+            RuntimeError: If the command of the run fails.
+        """
+
+        bound = inspect.signature(self.run).bind(**kwargs)
+        bound.apply_defaults()
+        args = dict(bound.arguments)
+        output_prefix = args.pop('output_prefix')
+        password = args.pop('password')
+        iflog = args.pop('iflog')
+        command, crun_type, logfile, case_name = self._run_setup(**args)
+        returncode = await self.docker_async(cmd=crun_type, iflog=iflog,
+                                             password=password, cmdlogfile=logfile,
+                                             dockersript=command, callback=callback)
+        if returncode != 0:
+            raise RuntimeError(f"The run of the case {self.case_name} failed with return code {returncode}, see the log {logfile}.")
+        return self._run_outputs(output_prefix, case_name, args['RUN_STARTDATE'])
+
+    def _run_setup(self, case_name, RUN_STARTDATE, START_TOD, STOP_OPTION, STOP_N,
+                   ATM_DOM, SURF, FORCING, RUN_TYPE, RUN_REFCASE, RUN_REFDATE, RUN_REFTOD,
+                   logfile, hist_type, hist_nhtfrq, hist_mfilt, urban_hac, crun_type, build_cache) -> tuple:
+
+        """
+        Stage the inputs and the scripts of a run and format its command, see `run` for the arguments.
+
+        Returns:
+            tuple: (command, crun_type, logfile, case_name in the container)
+        """
+
         self.case_name = case_name
         case_name = f'/p/scripts/{case_name}'
 
+        if build_cache and self.image_name not in ("envdes/clmu-app:1.1", "junjieyuuom/clmu-app:1.2"):
+            # the usp.sh of the other images builds each case
+            print(f"The image {self.image_name} does not support build_cache, each case is built.")
+            build_cache = False
+
         if SURF is not None:
             self.check_surf(usr_surfdata=SURF)
         else:
@@ -456,6 +666,7 @@ class usp_clmu(clumapp):
                 raise ValueError("The surface data is not provided.")
             else:
                 self.surfdata = self.surfdata
+        self.flush_surf()
 
         if FORCING is not None:
             self.check_forcing(usr_forcing=FORCING)
@@ -518,7 +729,8 @@ class usp_clmu(clumapp):
                                         hist_type=hist_type,
                                         hist_nhtfrq=hist_nhtfrq,
                                         hist_mfilt=hist_mfilt,
-                                        urban_hac=urban_hac)
+                                        urban_hac=urban_hac,
+                                        BUILD_CASE=self.build_case_name() if build_cache else "")
 
         # Set the logfile
         if logfile is None:
@@ -530,9 +742,16 @@ class usp_clmu(clumapp):
             if not sys.platform.startswith('linux'):
                 print("udocker is only supported on Linux OS. Please use docker or singularity container.")
                 
-        self.docker(cmd=crun_type, iflog=iflog, 
-                    password=password, cmdlogfile=logfile,
-                    dockersript=command)
+        return command, crun_type, logfile, case_name
+
+    def _run_outputs(self, output_prefix, case_name, RUN_STARTDATE) -> list:
+
+        """
+        Rename the output files of a run, see `run` for the arguments.
+
+        Returns:
+            list: The list of the output files names.
+        """
 
         savename_list = []
         i=0
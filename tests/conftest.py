@@ -0,0 +1,67 @@
+import os
+import json
+import shutil
+import numpy as np
+import pytest
+import xarray as xr
+from pyclmuapp import backend
+
+# a stub of usp_1.1.sh for the native backend: it checks the mapped paths and writes the history
+# file of the case in $CESMDATAROOT/Archive, as CTSM does; a case whose name has "fail" fails
+# while the file $FAIL_FLAG exists
+STUB_USP = """#! /bin/bash
+export CASESRPITS=/p/project/clm5.0/cime/scripts
+export CESMDATAROOT=/p/scratch/CESMDATAROOT
+while [[ $# -gt 0 ]]; do
+   case $1 in
+      --case_name) case_name=$2; shift;;
+      --RUN_STARTDATE) start=$2; shift;;
+      --SURF) surf=$2; shift;;
+   esac
+   shift
+done
+test -d ${CASESRPITS} || exit 3
+test -f /p/clmuapp/usp/${surf} || exit 4
+if [[ ${case_name} == *fail* ]] && [ -f "${FAIL_FLAG}" ]; then
+   exit 1
+fi
+mkdir -p ${case_name} ${CESMDATAROOT}/Archive/lnd/hist
+touch ${CESMDATAROOT}/Archive/lnd/hist/$(basename ${case_name}).clm2.h0.${start}-00000.nc
+"""
+
+
+@pytest.fixture
+def native_env(tmp_path, monkeypatch):
+    """
+    A host CTSM install for the native backend: the paths of /p/project/clm5.0 and of the
+    input data, given by $PYCLMUAPP_NATIVE_PATHS, and a forcing file.
+    """
+    if shutil.which('bash') is None:
+        pytest.skip("the native backend needs bash")
+    ctsm = tmp_path / 'ctsm'
+    (ctsm / 'cime' / 'scripts').mkdir(parents=True)
+    inputdata = tmp_path / 'inputdata'
+    inputdata.mkdir()
+    paths = tmp_path / 'native_paths.json'
+    paths.write_text(json.dumps({"/p/project/clm5.0": str(ctsm),
+                                 "/p/scratch/CESMDATAROOT/inputdata": str(inputdata)}))
+    monkeypatch.setenv('PYCLMUAPP_NATIVE_PATHS', str(paths))
+    # the backends are cached per process, with the paths of the first one
+    monkeypatch.setattr(backend, '_backends', {})
+    forcing = tmp_path / 'forcing.nc'
+    xr.Dataset({'Tair': ('time', np.zeros(3))}).to_netcdf(forcing)
+    return {'ctsm': str(ctsm), 'inputdata': str(inputdata), 'paths': str(paths), 'forcing': str(forcing)}
+
+
+@pytest.fixture
+def stub_usp():
+    """
+    Put the stub usp.sh in the input folder of an app, where `case_scripts` would copy usp_1.1.sh.
+    """
+    def _stub(input_path: str) -> str:
+        script = os.path.join(input_path, 'usp', 'usp.sh')
+        os.makedirs(os.path.dirname(script), exist_ok=True)
+        with open(script, 'w') as f:
+            f.write(STUB_USP)
+        return script
+    return _stub
@@ -0,0 +1,136 @@
+import os
+import asyncio
+import pytest
+from pyclmuapp import backend
+from pyclmuapp.backend import parse_template, docker_backend, docker_in_backend, fake_backend, native_backend, get_backend
+from pyclmuapp.usp import usp_clmu
+
+
+def _values(tmp_path, command=""):
+    folders = {}
+    for field in ('input_path', 'output_path', 'log_path', 'scripts_path'):
+        folders[field] = str(tmp_path / field)
+        os.makedirs(folders[field], exist_ok=True)
+    return dict(folders, command=command, image_name=None, container_name="myclmu")
+
+
+def test_parse_template_argv():
+    assert parse_template("docker exec {container_name} bash -c '{command}'") == \
+        ["docker", "exec", "{container_name}", "bash", "-c", "{command}"]
+
+
+@pytest.mark.parametrize("template", ["docker run {image_name} chmod +x {command} && bash -c {command}",
+                                      "cat {command} | grep x",
+                                      "echo {command} > out.log"])
+def test_parse_template_shell(template):
+    # a template with a shell token is kept as a shell string
+    assert parse_template(template) == template
+
+
+def test_command_argv(tmp_path):
+    values = _values(tmp_path, command="cd /p/scripts && ls -l 'a b'")
+    values['image_name'] = "junjieyuuom/clmu-app:1.2"
+    docker = docker_backend(values['image_name'])
+
+    argv = docker.command('usp', values)
+
+    # the command stays one argument, whatever its quotes and shell tokens
+    assert argv[0:2] == ["docker", "run"] and argv[-3:] == ["bash", "-c", values['command']]
+    assert f"{values['scripts_path']}:/p/scripts" in argv
+    assert docker.command('usp', values, password="pw")[:2] == ["sudo", "-S"]
+    assert isinstance(docker.command('case', values), str)
+    with pytest.raises(ValueError):
+        docker.command('unknown', values)
+    # a bare "{command}" of docker_in is a bash script
+    assert docker_in_backend().command('exec', values) == ["bash", "-c", values['command']]
+
+
+def test_fake_backend_records_the_commands(tmp_path):
+    app = usp_clmu(pwd=str(tmp_path / 'work'), container_type="fake")
+    seen = []
+    app.backend = fake_backend(app.image_name, returncode=3, handler=seen.append)
+    app.docker(cmd='exec', dockersript="ls /p/scripts")
+
+    async def _start():
+        return await app.docker_async(cmd='exec', dockersript="ls /p/clmuapp")
+
+    assert asyncio.run(_start()) == 3
+    assert [argv[-1] for argv in app.backend.calls] == ["ls /p/scripts", "ls /p/clmuapp"]
+    assert seen == app.backend.calls
+
+
+def test_map_paths_longest_prefix_first():
+    mapping = {"/p/scratch": "/s",
+               "/p/scratch/CESMDATAROOT": "/d",
+               "/p/scratch/CESMDATAROOT/inputdata": "/in"}
+    text = "cd /p/scratch/CESMDATAROOT/inputdata/x && ls /p/scratch/CESMDATAROOT/Archive /p/scratch/tmp /tmp/p/scratch"
+    assert native_backend(paths={}).map_paths(text, mapping) == \
+        "cd /in/x && ls /d/Archive /s/tmp /tmp/p/scratch"
+
+
+def test_map_paths_unmapped_prefix_raises():
+    with pytest.raises(ValueError, match="/p/project/clm5.0"):
+        native_backend(paths={}).map_paths("cd /p/project/clm5.0/cime", {"/p/scripts": "/s"})
+
+
+def test_map_scripts_writes_a_native_copy(tmp_path):
+    values = _values(tmp_path, command="bash /p/clmuapp/usp/run.sh --case_name /p/scripts/a")
+    script = os.path.join(values['input_path'], 'usp', 'run.sh')
+    os.makedirs(os.path.dirname(script))
+    with open(script, 'w') as f:
+        f.write("ls /p/clmuapp/usp /p/scratch/CESMDATAROOT/Archive\n")
+
+    argv = native_backend(paths={}).command('usp', values)
+
+    native = os.path.join(values['input_path'], 'usp', 'run.native.sh')
+    assert argv == ["bash", "-c", f"bash {native} --case_name {values['scripts_path']}/a"]
+    assert os.access(native, os.X_OK)
+    with open(native) as f:
+        content = f.read()
+    assert f"ls {values['input_path']}/usp " in content and "/p/" not in content
+    with open(script) as f:
+        assert f.read().startswith("ls /p/clmuapp/usp")
+
+
+def test_data_root_links(tmp_path):
+    inputdata = tmp_path / 'inputdata'
+    inputdata.mkdir()
+    native = native_backend(paths={"/p/scratch/CESMDATAROOT/inputdata": str(inputdata)})
+    values = _values(tmp_path)
+
+    mapping = native.mapping(values)
+
+    root = mapping["/p/scratch/CESMDATAROOT"]
+    assert os.path.dirname(root) == str(tmp_path)
+    assert os.readlink(os.path.join(root, 'Archive')) == values['output_path']
+    assert os.readlink(os.path.join(root, 'CaseOutputs')) == values['log_path']
+    assert os.readlink(os.path.join(root, 'inputdata')) == str(inputdata)
+    assert mapping["/p/scratch"] == str(tmp_path)
+    # the same folders give the same root, other output folders another one
+    assert native.mapping(values)["/p/scratch/CESMDATAROOT"] == root
+    other = dict(values, output_path=str(tmp_path / 'other'))
+    assert native.mapping(other)["/p/scratch/CESMDATAROOT"] != root
+
+
+def test_get_backend_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, '_backends', {})
+    paths = {"/p/project/clm5.0": str(tmp_path)}
+    native = get_backend("native", paths=paths)
+    assert native.paths == paths
+    assert get_backend("native", paths=dict(paths)) is native
+    with pytest.raises(ValueError):
+        get_backend("docker", paths=paths)
+
+
+def test_native_usp_run(tmp_path, monkeypatch, native_env, stub_usp):
+    # the paths are given to the app instead of $PYCLMUAPP_NATIVE_PATHS
+    monkeypatch.delenv('PYCLMUAPP_NATIVE_PATHS')
+    app = usp_clmu(pwd=str(tmp_path / 'work'), container_type="native", native_paths=native_env['paths'])
+    stub_usp(app.input_path)
+    app.check_forcing(usr_forcing=native_env['forcing'])
+
+    outputs = app.run(case_name="native_case", RUN_STARTDATE="2012-08-08", STOP_N="1")
+
+    assert len(outputs) == 1 and os.path.exists(outputs[0])
+    assert os.path.isdir(os.path.join(app.scripts_path, "native_case"))
+    assert os.path.exists(os.path.join(app.input_path, 'usp', 'usp.native.sh'))
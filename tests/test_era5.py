@@ -0,0 +1,108 @@
+import zipfile
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from pyclmuapp.era5_forcing import era5_download_pool, arco_era5_to_forcing
+
+
+def _month(year, month, instant):
+    time = pd.date_range(f"{year}-{month:02d}-01", periods=3, freq="h")
+    names = ['t2m', 'sp'] if instant else ['tp']
+    data = {name: (('valid_time', 'latitude', 'longitude'), np.full((3, 2, 2), year * 100 + month, dtype=float))
+            for name in names}
+    return xr.Dataset(data, coords={'valid_time': time, 'latitude': [51.75, 51.5], 'longitude': [0., 0.25]})
+
+
+class stub_client:
+
+    """
+    A CDS client that writes a zip of two NetCDF files, as the CDS does, and fails
+    the first `failures` requests of each month.
+    The files are made beforehand, as HDF5 is not thread safe and the requests run in threads.
+    """
+
+    def __init__(self, months, failures=None):
+        self.failures = dict(failures or {})
+        self.calls = []
+        self._lock = threading.Lock()
+        self.files = {key: (_month(*key, True).to_netcdf(), _month(*key, False).to_netcdf()) for key in months}
+
+    def retrieve(self, name, request, target):
+        key = (int(request['year'][0]), int(request['month'][0]))
+        with self._lock:
+            self.calls.append(key)
+            if self.failures.get(key, 0) > 0:
+                self.failures[key] -= 1
+                raise RuntimeError("queue timeout")
+        with zipfile.ZipFile(target, 'w') as z:
+            z.writestr('data_stream-oper_stepType-instant.nc', self.files[key][0])
+            z.writestr('data_stream-oper_stepType-accum.nc', self.files[key][1])
+
+
+def test_download_pool_retries(tmp_path):
+    months = [(2020, 1), (2020, 2), (2020, 3)]
+    client = stub_client(months, failures={(2020, 2): 2})
+    pool = era5_download_pool(51.5, 0.1, outputfolder=str(tmp_path), max_workers=2,
+                              retries=2, backoff=0, client_factory=lambda: client)
+
+    months = list(pool.download(months))
+
+    assert [(year, month) for year, month, _ in months] == [(2020, 1), (2020, 2), (2020, 3)]
+    assert sorted(client.calls) == [(2020, 1), (2020, 2), (2020, 2), (2020, 2), (2020, 3)]
+    assert set(pool.status.values()) == {"done"}
+    assert str(pool.errors[(2020, 2)]) == "queue timeout"
+    # the zips are merged into one NetCDF per month, in time
+    for year, month, single in months:
+        with xr.open_dataset(single) as ds:
+            assert 'time' in ds.dims and {'t2m', 'sp', 'tp'} <= set(ds.data_vars)
+            assert float(ds['tp'].max()) == year * 100 + month
+
+
+def test_download_pool_gives_up(tmp_path):
+    client = stub_client([(2020, 1)], failures={(2020, 1): 5})
+    pool = era5_download_pool(51.5, 0.1, outputfolder=str(tmp_path), retries=1, backoff=0,
+                              client_factory=lambda: client)
+
+    with pytest.raises(RuntimeError, match="queue timeout"):
+        list(pool.download([(2020, 1)]))
+    assert client.calls == [(2020, 1), (2020, 1)]
+    assert pool.status[(2020, 1)] == "failed"
+
+
+def _arco_store(hours=60):
+    time = pd.date_range("2020-01-30", periods=hours, freq="h")
+    rng = np.random.default_rng(0)
+    shape = (hours, 3, 4)
+    values = {
+        '2m_temperature': 280 + rng.random(shape),
+        '2m_dewpoint_temperature': 275 + rng.random(shape),
+        'surface_pressure': 1e5 + rng.random(shape),
+        '10m_u_component_of_wind': rng.random(shape),
+        '10m_v_component_of_wind': rng.random(shape),
+        'surface_solar_radiation_downwards': 1e5 * rng.random(shape),
+        'surface_thermal_radiation_downwards': 1e6 + 1e5 * rng.random(shape),
+        'total_precipitation': 1e-4 * rng.random(shape),
+        'forecast_surface_roughness': 0.5 + 0.1 * rng.random(shape),
+    }
+    return xr.Dataset({name: (('time', 'latitude', 'longitude'), value) for name, value in values.items()},
+                      coords={'time': time, 'latitude': [52., 51.75, 51.5], 'longitude': [0., 0.25, 359.5, 359.75]})
+
+
+def test_arco_blocks_match_one_block(tmp_path):
+    pytest.importorskip('zarr')
+    store = _arco_store()
+    # a local Zarr store, opened by path as the ARCO-ERA5 one
+    path = str(tmp_path / 'era5.zarr')
+    store.to_zarr(path)
+    files = [arco_era5_to_forcing(2020, 2020, 1, 2, 51.6, -0.3, 30, str(tmp_path / f'forcing_{size}.nc'),
+                                  store=path, block_size=size)
+             for size in (7, 10000)]
+
+    with xr.open_dataset(files[0]) as blocks, xr.open_dataset(files[1]) as whole:
+        assert blocks.sizes['time'] == 60
+        xr.testing.assert_allclose(blocks, whole)
+        # the point west of Greenwich is found on the 0-360 grid
+        t2m = store['2m_temperature'].sel(latitude=51.5, longitude=359.75)
+        np.testing.assert_allclose(blocks['Tair'].values[:, 0, 0], t2m.values - 0.006 * 28)
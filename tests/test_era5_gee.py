@@ -0,0 +1,49 @@
+import sys
+import types
+import importlib
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+
+@pytest.fixture
+def gee(monkeypatch):
+    # the requests are stubbed, the Earth Engine API is only imported
+    monkeypatch.setitem(sys.modules, 'ee', types.ModuleType('ee'))
+    monkeypatch.delitem(sys.modules, 'pyclmuapp.era5_forcing_gee', raising=False)
+    return importlib.import_module('pyclmuapp.era5_forcing_gee')
+
+
+def test_gee_retries_a_failed_month(tmp_path, monkeypatch, gee):
+    calls = []
+    lock = threading.Lock()
+
+    def _get_era5_ee(ee, lat, lon, start, end):
+        with lock:
+            calls.append(start)
+            if start == '2020-02-01' and calls.count(start) < 3:
+                raise RuntimeError("Too many concurrent aggregations")
+        time = pd.date_range(start, end, freq="h", inclusive='left')
+        return xr.Dataset({'t2m': ('time', np.full(len(time), 280.))}, coords={'time': time})
+
+    monkeypatch.setattr(gee, 'get_era5_ee', _get_era5_ee)
+    monkeypatch.setattr(gee, 'era5_to_forcing', lambda ds, zbot, lapse_rate: ds)
+
+    ds = gee.gee_era5s_to_forcing(None, 51.5, 0.1, '2020-01-01', '2020-03-10', outputfile=str(tmp_path / 'forcing.nc'),
+                                  max_workers=2, max_rate=1000, retries=2, backoff=0)
+
+    assert sorted(calls) == ['2020-01-01', '2020-02-01', '2020-02-01', '2020-02-01', '2020-03-01']
+    assert ds.sizes['time'] == (pd.Timestamp('2020-03-10') - pd.Timestamp('2020-01-01')) // pd.Timedelta('1h')
+    assert ds.indexes['time'].is_monotonic_increasing
+
+
+def test_gee_gives_up(tmp_path, monkeypatch, gee):
+    def _get_era5_ee(ee, lat, lon, start, end):
+        raise RuntimeError("Computation timed out")
+
+    monkeypatch.setattr(gee, 'get_era5_ee', _get_era5_ee)
+    with pytest.raises(RuntimeError, match="timed out"):
+        gee.gee_era5s_to_forcing(None, 51.5, 0.1, '2020-01-01', '2020-02-01', outputfile=str(tmp_path / 'forcing.nc'),
+                                 retries=1, backoff=0)
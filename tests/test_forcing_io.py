@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from pyclmuapp.forcing_io import append_netcdf
+from pyclmuapp.era_forcing import era5s_to_forcing
+
+
+def _forcing(hours=30):
+    time = pd.date_range("2020-01-31", periods=hours, freq="h")
+    rng = np.random.default_rng(0)
+    return xr.Dataset({'Tair': (('time', 'lat', 'lon'), 280 + rng.random((hours, 1, 1))),
+                       'PSurf': (('time', 'lat', 'lon'), 1e5 + rng.random((hours, 1, 1))),
+                       'LONGXY': (('lat', 'lon'), [[0.1]])},
+                      coords={'time': time, 'lat': [51.5], 'lon': [0.1]})
+
+
+@pytest.mark.parametrize("profile", ['default', 'compressed'])
+def test_append_blocks_match_the_whole(tmp_path, profile):
+    ds = _forcing()
+    path = str(tmp_path / 'forcing.nc')
+    for start, end in ((0, 7), (7, 20), (20, 30)):
+        append_netcdf(ds.isel(time=slice(start, end)), path, profile=profile)
+
+    with xr.open_dataset(path) as out:
+        assert out.sizes['time'] == 30
+        np.testing.assert_array_equal(out['time'].values, ds['time'].values)
+        # the compressed profile stores float32
+        xr.testing.assert_allclose(out[['Tair', 'PSurf', 'LONGXY']], ds.astype(out['Tair'].dtype), rtol=1e-6)
+
+
+def test_append_missing_variable_raises(tmp_path):
+    ds = _forcing()
+    path = str(tmp_path / 'forcing.nc')
+    append_netcdf(ds[['Tair']].isel(time=slice(0, 10)), path)
+    with pytest.raises(ValueError, match="PSurf"):
+        append_netcdf(ds.isel(time=slice(10, 20)), path)
+
+
+def _era5_land(hours=6):
+    time = pd.date_range("2020-01-01", periods=hours, freq="h")
+    values = dict(t2m=280., d2m=275., sp=1e5, u10=1., v10=2., ssrd=1e5, strd=1e6, tp=1e-4)
+    return xr.Dataset({name: ('valid_time', np.full(hours, value)) for name, value in values.items()},
+                      coords={'valid_time': time})
+
+
+def test_era5s_to_forcing_profile(tmp_path):
+    path = str(tmp_path / 'forcing.nc')
+    era5s_to_forcing(_era5_land(), zbot=30, outputfile=path, profile='compressed')
+    with xr.open_dataset(path) as out:
+        assert out['Tair'].encoding['zlib'] and out['Tair'].encoding['dtype'] == np.float32
+
+    # a bad profile is reported as is, and nothing is written
+    with pytest.raises(ValueError, match="profile"):
+        era5s_to_forcing(_era5_land(), zbot=30, outputfile=str(tmp_path / 'bad.nc'), profile='fast')
+    assert not (tmp_path / 'bad.nc').exists()
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from pyclmuapp.forcing_kernel import era5_forcing_kernel, FORCING_VARS
+from pyclmuapp.era5_forcing import era5_to_forcing
+from pyclmuapp.era_forcing import era5s_to_forcing
+
+# the formulas of the converters before the shared kernel
+RAIR = 6.02214e26 * 1.38065e-23 / 28.966
+GRAV = 9.80616
+ES_WATER = (6.11213476, 0.444007856, 0.143064234e-01, 0.264461437e-03, 0.305903558e-05,
+            0.196237241e-07, 0.892344772e-10, -0.373208410e-12, 0.209339997e-15)
+ES_ICE = (6.11123516, 0.503109514, 0.188369801e-01, 0.420547422e-03, 0.614396778e-05,
+          0.602780717e-07, 0.387940929e-09, 0.149436277e-11, 0.262655803e-14)
+
+
+def _polynomial(coeffs, x):
+    value = coeffs[-1]
+    for c in coeffs[-2::-1]:
+        value = c + x * value
+    return value
+
+
+def _baseline(single, zbot, lapse_rate, wind_profile, clip_lwdown):
+    out = {}
+    out['Tair'] = single['t2m'] - lapse_rate * (zbot - 2.0)
+    out['PSurf'] = single['sp'] * np.exp(-(zbot - 2.0) / (RAIR * out['Tair'] / GRAV))
+    wind = (single['u10']**2 + single['v10']**2)**0.5
+    if wind_profile == "log":
+        out['Wind'] = wind * (np.log(zbot / single['fsr']) / np.log(10 / single['fsr']))
+    else:
+        out['Wind'] = wind * (zbot / 10.0)**(1/7)
+    d2m = single['d2m'] - 273.15 - 1.8/1000 * (zbot - 2.0)
+    es = xr.where(d2m >= 0, _polynomial(ES_WATER, d2m) * 100, _polynomial(ES_ICE, d2m) * 100)
+    qair = 0.622 * es / (out['PSurf'] - (1 - 0.622) * es)
+    out['Qair'] = qair.where(qair > 0, 1e-16)
+    out['Zbot'] = xr.full_like(single['sp'], zbot)
+    out['SWdown'] = (single['ssrd'] / 3600).where(single['ssrd'] / 3600 > 0, 1e-16)
+    out['LWdown'] = single['strd'] / 3600
+    if clip_lwdown:
+        out['LWdown'] = out['LWdown'].where(out['LWdown'] > 0, 1e-16)
+    prec = single['tp'] * 1000 / 3600
+    out['Prectmms'] = prec.where(prec > 0, 1e-16)
+    return out
+
+
+def _era5(hours=48, time_name='time'):
+    rng = np.random.default_rng(1)
+    values = {
+        't2m': 265 + 20 * rng.random(hours),
+        # dew points below and above 0 degC, for the ice and the water saturation
+        'd2m': 260 + 20 * rng.random(hours),
+        'sp': 9.8e4 + 3e3 * rng.random(hours),
+        'u10': rng.normal(size=hours) * 5,
+        'v10': rng.normal(size=hours) * 5,
+        # negative accumulations, as in the ERA5 files, are floored
+        'ssrd': 1e6 * rng.random(hours) - 2e5,
+        'strd': 1.2e6 * rng.random(hours) - 1e5,
+        'tp': 1e-3 * rng.random(hours) - 2e-4,
+        'fsr': 0.05 + rng.random(hours),
+    }
+    time = pd.date_range("2020-01-01", periods=hours, freq="h")
+    return xr.Dataset({name: (time_name, value) for name, value in values.items()}, coords={time_name: time})
+
+
+@pytest.mark.parametrize("wind_profile, clip_lwdown", [("log", True), ("power", False)])
+def test_kernel_matches_the_baseline(wind_profile, clip_lwdown):
+    single = _era5()
+    expected = _baseline(single, 30, 0.006, wind_profile, clip_lwdown)
+    fields = era5_forcing_kernel(*[single[name].values for name in ('t2m', 'd2m', 'sp', 'u10', 'v10', 'ssrd', 'strd', 'tp')],
+                                 fsr=single['fsr'].values, zbot=30, lapse_rate=0.006,
+                                 wind_profile=wind_profile, clip_lwdown=clip_lwdown, block_size=7)
+    for var in FORCING_VARS:
+        np.testing.assert_allclose(fields[var], expected[var].values, rtol=1e-12, err_msg=var)
+    assert (fields['LWdown'] < 0).any() != clip_lwdown
+
+
+def test_era5_to_forcing_matches_the_baseline():
+    # a 2 x 2 grid, the nearest cell of the point is read
+    single = _era5().expand_dims(latitude=[51.75, 51.5], longitude=[0., 0.25]).transpose('time', ...)
+    forcing = era5_to_forcing(single, 51.6, 0.2, zbot=30)
+    expected = _baseline(single.sel(latitude=51.5, longitude=0.25), 30, 0.006, "log", True)
+    assert forcing['Tair'].dims == ('time', 'y', 'x')
+    for var in FORCING_VARS:
+        np.testing.assert_allclose(forcing[var].values[:, 0, 0], expected[var].values, rtol=1e-12, err_msg=var)
+    # the scalar latitude and longitude are dropped, as before
+    assert set(forcing.coords) == {'time', 'x', 'y'}
+
+
+def test_era5s_to_forcing_matches_the_baseline(tmp_path):
+    # ERA5-Land: no fsr, the power wind profile and no floor of LWdown
+    single = _era5(time_name='valid_time').drop_vars('fsr').assign_coords(latitude=51.5, longitude=0.1)
+    forcing = era5s_to_forcing(single, zbot=30, outputfile=str(tmp_path / 'forcing.nc'))
+    expected = _baseline(single.rename(valid_time='time'), 30, 0.006, "power", False)
+    for var in FORCING_VARS:
+        np.testing.assert_allclose(forcing[var].values[:, 0, 0], expected[var].values, rtol=1e-12, err_msg=var)
+    assert set(forcing.coords) == {'time', 'x', 'y'}
+    with xr.open_dataset(tmp_path / 'forcing.nc') as out:
+        assert set(out.coords) == {'time', 'x', 'y'}
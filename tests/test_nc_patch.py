@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from pyclmuapp import nc_patch
+from pyclmuapp.nc_patch import patch_netcdf, recover_netcdf, journal_path
+from pyclmuapp.usp import usp_clmu
+from pyclmuapp.clmu import cesm_run
+
+
+def _forcing(path, hours=50):
+    time = pd.date_range("2020-01-01", periods=hours, freq="h")
+    rng = np.random.default_rng(0)
+    ds = xr.Dataset({'Tair': (('time', 'y', 'x'), 280 + rng.random((hours, 1, 1))),
+                     'Prectmms': (('time', 'y', 'x'), rng.random((hours, 1, 1)))},
+                    coords={'time': time, 'y': [1], 'x': [1]})
+    ds.to_netcdf(path)
+    return ds
+
+
+def test_patch_blocks(tmp_path):
+    path = str(tmp_path / 'forcing.nc')
+    ds = _forcing(path)
+    patch_netcdf(path, {'Tair': 1., 'Prectmms': 2.}, mode={'Tair': 'add', 'Prectmms': 'scale'}, block_size=7)
+    with xr.open_dataset(path) as out:
+        np.testing.assert_allclose(out['Tair'], ds['Tair'] + 1)
+        np.testing.assert_allclose(out['Prectmms'], ds['Prectmms'] * 2)
+    assert not os.path.exists(journal_path(path))
+
+
+def test_failed_patch_is_rolled_back(tmp_path):
+    path = str(tmp_path / 'forcing.nc')
+    ds = _forcing(path)
+    # Tair is revised, then the values of Prectmms do not fit
+    with pytest.raises(ValueError):
+        patch_netcdf(path, {'Tair': 1., 'Prectmms': np.ones(3)}, block_size=7)
+    with xr.open_dataset(path) as out:
+        xr.testing.assert_identical(out.load(), ds)
+    assert not os.path.exists(journal_path(path))
+
+
+def test_leftover_journal_is_recovered(tmp_path, monkeypatch):
+    path = str(tmp_path / 'forcing.nc')
+    ds = _forcing(path)
+    # the process is killed half way: no rollback, the journal stays on disk
+    monkeypatch.setattr(nc_patch, 'recover_netcdf', lambda path: False)
+    with pytest.raises(ValueError):
+        patch_netcdf(path, {'Tair': 1., 'Prectmms': np.ones(3)}, block_size=7)
+    monkeypatch.undo()
+    with xr.open_dataset(path) as out:
+        np.testing.assert_allclose(out['Tair'], ds['Tair'] + 1)
+
+    # the journal has one array per block of 7 hours
+    with np.load(journal_path(path)) as saved:
+        assert len([key for key in saved.files if key.startswith('data_')]) == 2 * 8
+
+    # the next patch starts from the original values
+    patch_netcdf(path, {'Tair': 2.})
+    with xr.open_dataset(path) as out:
+        np.testing.assert_allclose(out['Tair'], ds['Tair'] + 2)
+        np.testing.assert_allclose(out['Prectmms'], ds['Prectmms'])
+    assert not os.path.exists(journal_path(path))
+    assert not recover_netcdf(path)
+
+
+def test_recover_netcdf(tmp_path, monkeypatch):
+    path = str(tmp_path / 'forcing.nc')
+    ds = _forcing(path)
+    monkeypatch.setattr(nc_patch, 'recover_netcdf', lambda path: False)
+    with pytest.raises(ValueError):
+        patch_netcdf(path, {'Tair': 1., 'Prectmms': np.ones(3)})
+    monkeypatch.undo()
+
+    assert recover_netcdf(path)
+    with xr.open_dataset(path) as out:
+        xr.testing.assert_identical(out.load(), ds)
+    assert not os.path.exists(journal_path(path))
+
+
+def _modified_usp(tmp_path, name, source, forcing_name, inplace, calls):
+    app = usp_clmu(pwd=str(tmp_path / name), container_type="fake")
+    app.check_forcing(usr_forcing=source)
+    for action in calls:
+        app.modify_forcing(action=action, mode="add", forcing_name=forcing_name, inplace=inplace)
+    path = os.path.join(app.input_path, 'usp', forcing_name)
+    with xr.open_dataset(path) as ds:
+        return app.usr_forcing_file, ds.load()
+
+
+@pytest.mark.parametrize("forcing_name", ["forcing.nc", "revised.nc"])
+def test_usp_modify_forcing_inplace(tmp_path, capsys, forcing_name):
+    # the forcing named forcing.nc is revised again by each call, another name starts from the copy
+    source = str(tmp_path / 'forcing.nc')
+    _forcing(source)
+    calls = [{'Tair': 1.}, {'Tair': 0.5, 'Prectmms': 1e-3}]
+
+    baseline = _modified_usp(tmp_path, 'baseline', source, forcing_name, False, calls)
+    inplace = _modified_usp(tmp_path, 'inplace', source, forcing_name, True, calls)
+
+    assert inplace[0] == baseline[0] == forcing_name
+    # the file was revised in place, not rewritten by the fallback
+    assert "Can not revise" not in capsys.readouterr().out
+    xr.testing.assert_identical(inplace[1], baseline[1])
+
+
+def test_cesm_run_modify_forcing_inplace(tmp_path, capsys):
+    files = {}
+    for inplace in (False, True):
+        path = str(tmp_path / f'forcing_{inplace}.nc')
+        _forcing(path)
+        case = cesm_run(str(tmp_path), str(tmp_path), str(tmp_path),
+                        {'case_lat': 51.5, 'case_lon': 0.1, 'case_name': 'case'})
+        case.modify_forcing('Tair', 1., path, inplace=inplace)
+        case.modify_forcing('Tair', {'Tair': 0.5, 'Prectmms': 1e-3}, path, inplace=inplace)
+        with xr.open_dataset(path) as ds:
+            files[inplace] = ds.load()
+    xr.testing.assert_identical(files[True], files[False])
+    assert "Can not revise" not in capsys.readouterr().out
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import threading
+import pytest
+from pyclmuapp import scheduler
+from pyclmuapp.scheduler import job_array, run_task
+
+# a fake sbatch: the tasks of the array run one after the other, then the job id is printed
+# as by "sbatch --parsable"
+FAKE_SBATCH = """#! /bin/bash
+script="${@: -1}"
+range=$(sed -n 's/^#SBATCH --array=\\([0-9]*\\)-\\([0-9]*\\).*/\\1 \\2/p' "$script")
+set -- $range
+for i in $(seq $1 $2); do
+   SLURM_ARRAY_JOB_ID=4242 SLURM_ARRAY_TASK_ID=$i bash "$script" > /dev/null 2>&1
+done
+echo "4242;cluster"
+"""
+
+
+@pytest.fixture
+def sbatch(tmp_path, monkeypatch):
+    folder = tmp_path / 'bin'
+    folder.mkdir()
+    path = folder / 'sbatch'
+    path.write_text(FAKE_SBATCH)
+    path.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{folder}{os.pathsep}{os.environ['PATH']}")
+    # the tasks import pyclmuapp from this tree
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    return str(path)
+
+
+def _jobs(pwd, forcing, stub_usp, names=('ok', 'fail')):
+    jobs = job_array([{'name': name} for name in names], pwd=str(pwd), container_type="native",
+                     forcing=forcing, RUN_STARTDATE="2012-08-08", STOP_N="1")
+    for name in names:
+        stub_usp(os.path.join(jobs.pwd, 'cases', name, 'inputfolder'))
+    return jobs
+
+
+def test_job_array_markers_outputs_and_resubmit(tmp_path, monkeypatch, native_env, stub_usp, sbatch):
+    flag = tmp_path / 'fail_flag'
+    flag.touch()
+    monkeypatch.setenv('FAIL_FLAG', str(flag))
+    jobs = _jobs(tmp_path / 'jobs', native_env['forcing'], stub_usp)
+
+    assert jobs.submit() == "4242"
+    assert jobs.status() == {'ok': 'done', 'fail': 'failed'}
+    assert jobs.failed() == [1]
+    outputs = jobs.outputs()
+    assert len(outputs['ok']) == 1 and os.path.exists(outputs['ok'][0])
+    assert outputs['fail'] == []
+    with open(jobs._marker(1, 'failed')) as f:
+        assert json.load(f)['error'].startswith("Traceback")
+
+    # the job ids are saved with the cases, a new session sees them
+    loaded = job_array.load(jobs.pwd)
+    assert loaded.job_ids == ["4242"]
+    assert loaded.status() == jobs.status()
+
+    # only the failed case runs again
+    flag.unlink()
+    loaded.submit(loaded.failed())
+    with open(loaded.script) as f:
+        assert "TASKS=(1)" in f.read()
+    assert loaded.status() == {'ok': 'done', 'fail': 'done'}
+    assert all(len(files) == 1 for files in loaded.outputs().values())
+    assert job_array.load(jobs.pwd).job_ids == ["4242", "4242"]
+
+
+def test_running_marker_has_the_scheduler_ids(tmp_path, monkeypatch, native_env, stub_usp):
+    jobs = _jobs(tmp_path / 'jobs', native_env['forcing'], stub_usp, names=('ok',))
+    monkeypatch.setenv('SLURM_ARRAY_JOB_ID', "77")
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', "0")
+    markers = []
+    write_marker = scheduler._write_marker
+
+    def _record(path, content):
+        markers.append((os.path.basename(path), content))
+        write_marker(path, content)
+
+    monkeypatch.setattr(scheduler, '_write_marker', _record)
+    assert len(run_task(jobs.pwd, 0)) == 1
+    running = dict(markers)['0.running']
+    assert (running['job_id'], running['task_id']) == ("77", "0")
+    assert [name for name, _ in markers] == ['0.running', '0.done']
+    assert not os.path.exists(jobs._marker(0, 'running'))
+
+
+def test_stale_running_marker_is_failed(tmp_path):
+    jobs = job_array([{'name': 'a'}, {'name': 'b'}], pwd=str(tmp_path / 'jobs'), forcing="forcing.nc")
+    for i in (0, 1):
+        scheduler._write_marker(jobs._marker(i, 'running'), {"name": jobs.names[i], "job_id": "1", "task_id": str(i)})
+    # the task of b was killed an hour ago, its marker is not touched any more
+    old = time.time() - 3600
+    os.utime(jobs._marker(1, 'running'), (old, old))
+
+    assert jobs.status() == {'a': 'running', 'b': 'failed'}
+    assert jobs.failed() == [1]
+    assert jobs.wait(interval=0, stale=0) == {'a': 'failed', 'b': 'failed'}
+    assert jobs.running()['b']['task_id'] == "1"
+
+
+def test_heartbeat_touches_the_marker(tmp_path):
+    marker = tmp_path / '0.running'
+    marker.write_text("{}")
+    old = time.time() - 3600
+    os.utime(marker, (old, old))
+    stop = threading.Event()
+    thread = threading.Thread(target=scheduler._heartbeat, args=(str(marker), stop, 0.01))
+    thread.start()
+    time.sleep(0.1)
+    stop.set()
+    thread.join()
+    assert time.time() - marker.stat().st_mtime < 60